@@ -0,0 +1,86 @@
+"""
+Benchmark of the generation pipeline.
+
+Plays many sessions concurrently against a :class:`FakeBackend` with a fixed latency
+and token rate, so the whole pipeline of :meth:`Story.continue_story` is measured
+offline: building the messages, the message log, streaming and parsing of the result.
+The time to the first token, the latency of a whole dialog and the throughput in
+tokens per second are reported.
+
+Run with
+
+.. code-block:: console
+
+    python -m benchmarks.bench_generation [sessions] [steps]
+
+"""
+import asyncio
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import storytime_ai.messagelog as messagelog
+from storytime_ai import Story
+from storytime_ai.backends import FakeBackend
+
+LATENCY = 0.2
+TOKEN_RATE = 200
+
+
+async def play(steps: int, ttfts: list[float], latencies: list[float]) -> int:
+    """Play a story for `steps` generated dialogs and return the number of received tokens."""
+    story = Story.from_markdown_file("storytime_ai/templates/minimal.md")
+    ntokens = 0
+    for step in range(steps):
+        nextdialogid = f"Generated {step}"
+        story.addchoice("Continue", nextdialogid)
+        start = time.perf_counter()
+        first = None
+        async for _ in story.continue_story(nextdialogid):
+            if first is None:
+                first = time.perf_counter() - start
+            ntokens += 1
+        latencies.append(time.perf_counter() - start)
+        ttfts.append(first if first is not None else latencies[-1])
+    return ntokens
+
+
+async def run(sessions: int, steps: int) -> dict:
+    """Play `sessions` stories concurrently and return the statistics."""
+    ttfts: list[float] = []
+    latencies: list[float] = []
+    start = time.perf_counter()
+    ntokens = sum(await asyncio.gather(*[play(steps, ttfts, latencies) for _ in range(sessions)]))
+    wall = time.perf_counter() - start
+    return {
+        "sessions": sessions,
+        "dialogs": len(latencies),
+        "tokens": ntokens,
+        "wall_seconds": wall,
+        "tokens_per_second": ntokens / wall,
+        "ttft_median": statistics.median(ttfts),
+        "latency_median": statistics.median(latencies),
+        "latency_max": max(latencies),
+    }
+
+
+def main():
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    steps = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    Story.backend = FakeBackend(latency=LATENCY, token_rate=TOKEN_RATE)
+    with tempfile.TemporaryDirectory() as tmp:
+        messagelog.set_filename(Path(tmp) / "messagelog.html")
+        result = asyncio.run(run(sessions, steps))
+        messagelog.flush()
+    print(
+        f"{result['sessions']} sessions, {result['dialogs']} dialogs, {result['tokens']} tokens "
+        f"in {result['wall_seconds']:.2f} s: {result['tokens_per_second']:.0f} tokens/s, "
+        f"TTFT median {result['ttft_median'] * 1000:.0f} ms, "
+        f"latency median {result['latency_median'] * 1000:.0f} ms, max {result['latency_max'] * 1000:.0f} ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Benchmark of the memory of the dialogs of large stories.
+
+Generates stories with 1k to 100k dialogs and measures the memory with :mod:`tracemalloc`
+for four layouts:
+
+- dict: the previous layout, Dialog and Choice objects with a `__dict__` each
+- slots: the current :class:`Dialog` and :class:`Choice` with `__slots__` and interned ids
+- table: the dialogs without choice objects and the choices in a :class:`ChoiceTable`
+- saved: the slots layout after the markdown of each dialog was rendered, like by a save,
+  which must not keep more memory than the slots layout
+
+Run with
+
+.. code-block:: console
+
+    python -m benchmarks.bench_memory
+
+"""
+import gc
+import tracemalloc
+
+from storytime_ai import Choice, Dialog
+from storytime_ai.choicetable import ChoiceTable
+
+SIZES = [1_000, 10_000, 100_000]
+
+
+class DictChoice:
+    """A choice with a `__dict__` like the previous layout."""
+
+    def __init__(self, text: str, nextdialogid: str):
+        self.nextdialogid = nextdialogid
+        self.text = text
+
+
+class DictDialog:
+    """A dialog with a `__dict__` like the previous layout."""
+
+    def __init__(self, dialogid: str, text: str, choices: dict, logic: str = ""):
+        self.dialogid = dialogid
+        self.text = text
+        self.choices = choices
+        self._logic = logic
+        self._compiled_logic = None
+
+
+def generate_data(ndialogs: int) -> list[tuple[str, str, str, list[tuple[str, str]]]]:
+    """Generate the fields of the dialogs, each with logic, text and two choices.
+
+    Each id is a new string like in the parser, the strings are kept alive by the caller,
+    so only the objects and the strings stored by a layout are measured.
+    """
+    return [
+        (
+            f"Dialog {i}",
+            f"Text of dialog {i}, which is long enough to be a realistic paragraph of a story.\n",
+            f'PROPERTY "visits {i}" = 1',
+            [
+                (f"Dialog {(i + 1) % ndialogs}", "Go to the next dialog"),
+                (f"Dialog {(i + 2) % ndialogs}", "Skip one dialog"),
+            ],
+        )
+        for i in range(ndialogs)
+    ]
+
+
+def build_dict(data):
+    return {
+        dialogid: DictDialog(dialogid, text, {nextid: DictChoice(t, nextid) for nextid, t in choices}, logic)
+        for dialogid, text, logic, choices in data
+    }
+
+
+def build_slots(data):
+    dialogs = {}
+    for dialogid, text, logic, choices in data:
+        dialog = Dialog(dialogid, text, {}, logic)
+        for nextid, t in choices:
+            choice = Choice(t, nextid)
+            dialog.choices[choice.nextdialogid] = choice
+        dialogs[dialog.dialogid] = dialog
+    return dialogs
+
+
+def build_table(data):
+    dialogs = build_slots(data)
+    table = ChoiceTable.from_dialogs(dialogs)
+    for dialog in dialogs.values():
+        dialog.choices = {}
+    return dialogs, table
+
+
+def build_saved(data):
+    dialogs = build_slots(data)
+    for dialog in dialogs.values():
+        dialog.to_markdown()
+    return dialogs
+
+
+def measure(build, data) -> int:
+    """Return the bytes allocated by `build(data)`, which are still alive."""
+    gc.collect()
+    tracemalloc.start()
+    result = build(data)
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current
+
+
+def main():
+    layouts = {"dict": build_dict, "slots": build_slots, "table": build_table, "saved": build_saved}
+    print(f"{'dialogs':>10}" + "".join(f"{name + ' B/dlg':>14}" for name in layouts) + f"{'saving':>10}")
+    for n in SIZES:
+        data = generate_data(n)
+        res = {name: measure(build, data) for name, build in layouts.items()}
+        saving = 1 - min(res["slots"], res["table"]) / res["dict"]
+        print(f"{n:>10}" + "".join(f"{res[name] / n:>14.0f}" for name in layouts) + f"{saving:>10.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Benchmark of the markdown parser.
+
+Generates stories with 100 to 100k dialogs and measures the time of
+`Story.from_markdown`. The time per dialog must stay roughly constant,
+i.e. the parser scales linearly with the size of the story.
+
+Run with
+
+.. code-block:: console
+
+    python -m benchmarks.bench_parser
+
+"""
+import sys
+import time
+
+from storytime_ai import Story
+
+SIZES = [100, 1_000, 10_000, 100_000]
+
+
+def generate_markdown(ndialogs: int) -> str:
+    """Generate a story with `ndialogs` dialogs, each with logic, text and two choices."""
+    lines = ["# Benchmark story", "SECRET A very long story"]
+    for i in range(ndialogs):
+        lines.append(f"## Dialog {i}")
+        lines.append(f'LOGIC PROPERTY "visits {i}" = 1')
+        lines.append(f"Text of dialog {i}, which is long enough to be a realistic paragraph of a story.")
+        lines.append("It has a second line with some **markdown**.")
+        lines.append("")
+        lines.append(f"- Dialog {(i + 1) % ndialogs}: Go to the next dialog")
+        lines.append("with a description over two lines")
+        lines.append(f"- Dialog {(i + 2) % ndialogs}: Skip one dialog")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def measure(ndialogs: int, repeat: int = 3) -> float:
+    """Return the best time in seconds to parse a story with `ndialogs` dialogs."""
+    markdown = generate_markdown(ndialogs)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        story = Story.from_markdown(markdown)
+        best = min(best, time.perf_counter() - start)
+    assert len(story.dialogs) == ndialogs
+    return best
+
+
+def main():
+    print(f"{'dialogs':>10} {'seconds':>10} {'us/dialog':>10}")
+    per_dialog = []
+    for n in SIZES:
+        t = measure(n)
+        per_dialog.append(t / n)
+        print(f"{n:>10} {t:>10.4f} {t / n * 1e6:>10.2f}")
+    # Linear scaling: the time per dialog of the largest story is at most a few times
+    # the time per dialog of the smallest story with measurable overhead.
+    ratio = per_dialog[-1] / min(per_dialog)
+    print(f"Ratio of time per dialog (largest/best): {ratio:.2f}")
+    if ratio > 3:
+        print("Parser does not scale linearly")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
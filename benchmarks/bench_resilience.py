@@ -0,0 +1,68 @@
+"""
+Benchmark of the tail latency with retries and hedged requests.
+
+Streams many completions from a :class:`FakeBackend`, which stalls or fails a fraction of
+the requests, with the same :class:`RetryPolicy` once without and once with hedging.
+The percentiles of the time to the first token and of the duration of the streams are
+reported, together with the number of retries and hedged requests.
+
+Run with
+
+.. code-block:: console
+
+    python -m benchmarks.bench_resilience [streams] [concurrency]
+
+"""
+import asyncio
+import sys
+import time
+from typing import Optional
+
+from storytime_ai.backends import FakeBackend
+from storytime_ai.clients import ClientManager
+from storytime_ai.resilience import RetryPolicy
+
+LATENCY = 0.05
+TOKEN_RATE = 1000
+FAULT_RATES = {"stall": 0.05, "error": 0.05}
+FIRST_TOKEN_TIMEOUT = 1.0
+HEDGE_AFTER = 0.15
+MESSAGES = [{"role": "user", "content": "Write the next dialogue with the heading 'Cave'."}]
+
+
+async def run(streams: int, concurrency: int, hedge_after: Optional[float]) -> RetryPolicy:
+    """Stream the completions and return the policy with its metrics."""
+    backend = FakeBackend(latency=LATENCY, token_rate=TOKEN_RATE, fault_rates=FAULT_RATES, seed=0)
+    clients = ClientManager(max_in_flight=concurrency)
+    policy = RetryPolicy(first_token_timeout=FIRST_TOKEN_TIMEOUT, backoff=0.05, max_retries=3, hedge_after=hedge_after)
+
+    async def stream():
+        async for _ in policy.stream(lambda: clients.stream(backend, MESSAGES, model="fake")):
+            pass
+
+    await asyncio.gather(*[stream() for _ in range(streams)], return_exceptions=True)
+    return policy
+
+
+def report(name: str, policy: RetryPolicy, wall: float):
+    m = policy.metrics
+    ttft = ", ".join(f"p{q}={v * 1000:.0f}" for q, v in m.ttft.percentiles((50, 90, 99)).items())
+    duration = ", ".join(f"p{q}={v * 1000:.0f}" for q, v in m.duration.percentiles((50, 90, 99)).items())
+    print(
+        f"{name:12s} {m.streams} streams in {wall:.2f} s, {m.attempts} requests, {m.retries} retries, "
+        f"{m.hedges} hedges ({m.hedge_wins} won), {m.failures} failed\n"
+        f"{'':12s} TTFT ms {ttft}; duration ms {duration}"
+    )
+
+
+def main():
+    streams = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    for name, hedge_after in [("retries", None), ("hedged", HEDGE_AFTER)]:
+        start = time.perf_counter()
+        policy = asyncio.run(run(streams, concurrency, hedge_after))
+        report(name, policy, time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
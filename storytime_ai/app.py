@@ -1,15 +1,20 @@
-import asyncio
 import re
 from importlib.resources import files
 from io import StringIO
 from pathlib import Path
-from typing import Optional
+from typing import Iterator, Optional
 
 import streamlit as st
 
 from storytime_ai import Dialog, Story
+from storytime_ai.discovery import DEFAULT_IGNORE, StoryDiscovery
+from storytime_ai.eventloop import BackgroundLoop, get_background_loop
 from storytime_ai.mylog import get_log
-from storytime_ai.utils import getfilelist
+from storytime_ai.parser import CHOICE_COMPLETED, HEADING, TEXT, StreamingDialogParser
+from storytime_ai.resilience import RetryPolicy
+from storytime_ai.session import StorySession
+from storytime_ai.storycache import StoryCache
+from storytime_ai.streaming import CoalescedStream
 
 log = get_log("st")
 
@@ -24,13 +29,39 @@ st.markdown(hide_label, unsafe_allow_html=True)
 
 
 # Callbacks
+@st.cache_resource
+def get_event_loop() -> BackgroundLoop:
+    # one event loop per server process, which keeps the HTTP connections of the backend alive
+    loop = get_background_loop()
+    if Story.retry is None:
+        # a stalled request should not block the player
+        Story.retry = RetryPolicy()
+    try:
+        loop.run(Story.clients.open(Story.backend))
+    except Exception as e:
+        log.warning(f"Cannot open the backend {Story.backend}: {e}")
+    return loop
+
+
+@st.cache_resource
+def get_storycache() -> StoryCache:
+    return StoryCache()
+
+
+# The template stories are shared by all sessions, each session plays a StorySession
+# with its own copy-on-write overlay of the dialogs
+@st.cache_resource
+def load_story(fname: str) -> Story:
+    return get_storycache().load(fname)
+
+
 @st.cache_data
 def load_stories():
-    storyfiles = getfilelist(Path(str(files("storytime_ai.templates").joinpath(""))), "md", withpath=True)
-    stories = [
-        Story.from_markdown_file(fname=f) for f in storyfiles if f.name != "README.md" and f.parent.name != "docs"
-    ]
-    storystats = {s.title + " (" + str(len(s.dialogs)) + " dialogues)": s for s in stories}
+    templates = Path(str(files("storytime_ai.templates").joinpath("")))
+    discovery = StoryDiscovery(templates, ignore=DEFAULT_IGNORE + ["docs"])
+    discovery.scan()
+    storyfiles = discovery.paths()
+    storystats = {m.title + " (" + str(m.ndialogs) + " dialogues)": m.path for m in get_storycache().scan(storyfiles)}
     return storystats
 
 
@@ -43,16 +74,47 @@ def uploadstory():
 
 
 def switch_story():
-    st.session_state["story"] = storystats[st.session_state.templates]
-
-
-async def aync_next_dialog(nextdialog: Optional[str] = None, t=None):
-    async for currentresult, _ in st.session_state.story.continue_story(nextdialog, override_existing=False):
-        t.markdown(currentresult)
+    st.session_state["story"] = StorySession(load_story(storystats[st.session_state.templates]))
+
+
+def show_next_dialog(frames: Iterator[tuple[str, str]], t=None):
+    # Only the new content is sent: each completed line and choice is its own element,
+    # the incomplete line is a placeholder, which is updated with each delta.
+    parser = StreamingDialogParser()
+    container = t.container()
+    line = container.empty()
+    current = ""
+    for _, delta in frames:
+        for event in parser.push(delta):
+            if event.kind == HEADING:
+                container = t.container()
+                container.markdown("### " + event.text)
+                line = container.empty()
+                current = ""
+            elif event.kind == TEXT:
+                current += event.text
+                if current.endswith("\n"):
+                    line.markdown(current)
+                    line = container.empty()
+                    current = ""
+                else:
+                    line.markdown(current)
+            elif event.kind == CHOICE_COMPLETED:
+                container.markdown(f"__{event.choice.nextdialogid}__:&nbsp; *{event.choice.text}*")
 
 
 def next_dialog(nextdialog: Optional[str] = None, t=None):
-    asyncio.run(aync_next_dialog(nextdialog, t))
+    # The generation runs in the event loop of the server, the frames are rendered in this
+    # thread, which has the context of the Streamlit session.
+    stream = CoalescedStream(st.session_state.story.continue_story(nextdialog, override_existing=False), max_fps=10)
+    try:
+        show_next_dialog(get_event_loop().iterate(stream), t)
+    except Exception as e:
+        # the half-written dialog is not added to the story
+        log.warning(f"Generation of {nextdialog} failed: {e!r}")
+        st.error(f"The next dialogue could not be written, please try again. ({e})")
+        return
+    log.debug(f"Streamed {nextdialog}: {stream.metrics}, requests: {Story.clients.metrics}")
 
 
 def back_dialog():
@@ -150,7 +212,7 @@ with st.sidebar.expander("Select template stories"):
 
 # Main page
 if st.session_state.story is None:
-    st.session_state["story"] = list(storystats.values())[0]
+    st.session_state["story"] = StorySession(load_story(list(storystats.values())[0]))
 
 
 def menu_callback(key):
@@ -0,0 +1,260 @@
+"""
+Backends
+========
+
+Backends for the language model, which writes the stories.
+
+A backend streams the completion of a list of chat messages as strings. The
+:class:`Story` uses the backend in the class attribute `Story.backend` for
+:meth:`Story.generate_story` and :meth:`Story.continue_story`.
+
+- :class:`OpenAIBackend` uses the openai API, the default
+- :class:`FakeBackend` streams from the markdown templates without network,
+  with configurable latency, token rate and injected faults. It is used for tests and benchmarks.
+
+.. code-block:: python
+
+    from storytime_ai import Story
+    from storytime_ai.backends import FakeBackend
+    Story.backend = FakeBackend(latency=0.5, token_rate=50)
+
+"""
+import abc
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import re
+from importlib.resources import files
+from pathlib import Path
+from typing import AsyncIterator, Iterable, Optional
+
+from .parser import MarkdownParser
+from .require_decorator import Requirement, requires
+
+log = logging.getLogger("st." + __name__)
+
+try:
+    import openai
+except ImportError:
+    log.info("No openai support available")
+    _openai = False
+else:
+    _openai = True
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    apikey = os.getenv("OPENAI_API_KEY")
+    if apikey is None:
+        log.warning("OPENAI_API_KEY not available, check .env")
+        _openai = False
+    openai.api_key = apikey
+    log.info(f"OpenAI API key {openai.api_key}")
+
+openai_req = Requirement("openai", _openai, "OpenAI API", raise_error=True)
+
+HEADING_PATTERN = re.compile(r"with the heading '(.+?)'")
+TOKEN_PATTERN = re.compile(r"\S+\s*|\s+")
+
+FAULTS = ("error", "stall", "drop", "hang")
+"""The faults of the :class:`FakeBackend`: a connection error before the first chunk, no first chunk
+at all, a connection error and a stall after half of the chunks"""
+
+
+class Backend(abc.ABC):
+    """Base class of the backends."""
+
+    @abc.abstractmethod
+    async def stream(self, messages: list[dict], model: str, **kwargs) -> AsyncIterator[str]:
+        """Stream the completion of the messages.
+
+        Parameters
+        ----------
+        messages : list[dict]
+            The chat messages
+        model : str
+            The name of the model
+        kwargs
+            Further parameters of the request
+
+        Yields
+        ------
+        str
+            The string that was just added to the completion
+        """
+
+    async def open(self):
+        """Open the resources, which are reused by the requests in the running event loop.
+
+        Only useful for a long-lived event loop, see :mod:`storytime_ai.eventloop`.
+        """
+
+    async def aclose(self):
+        """Close the resources opened by :meth:`open`."""
+
+
+class OpenAIBackend(Backend):
+    """
+    Backend with the chat completion of the openai API.
+
+    Without :meth:`open` each request creates and closes its own HTTP session. After :meth:`open`
+    the requests in the same event loop share one HTTP session, whose connections are kept alive.
+
+    Parameters
+    ----------
+    max_connections : int, optional
+        The size of the connection pool of the shared HTTP session
+    """
+
+    def __init__(self, max_connections: int = 20):
+        self.max_connections = max_connections
+        self.session = None
+        self._session_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @requires(openai_req)
+    async def open(self):
+        import aiohttp
+
+        await self.aclose()
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_connections))
+        self._session_loop = asyncio.get_running_loop()
+
+    async def aclose(self):
+        if self.session is not None and asyncio.get_running_loop() is self._session_loop:
+            await self.session.close()
+        self.session = None
+        self._session_loop = None
+
+    @requires(openai_req)
+    async def stream(self, messages: list[dict], model: str, **kwargs) -> AsyncIterator[str]:
+        token = None
+        if self.session is not None and asyncio.get_running_loop() is self._session_loop:
+            # the request is sent with the session of this context variable, it is only read by acreate
+            token = openai.aiosession.set(self.session)
+        try:
+            response = await openai.ChatCompletion.acreate(
+                model=model,
+                messages=messages,
+                stream=True,
+                **kwargs,
+            )
+        finally:
+            if token is not None:
+                openai.aiosession.reset(token)
+        async for chunk in response:
+            delta = chunk.get("choices", [{}])[0].get("delta", {}).get("content")
+            if delta is None:
+                delta = ""
+            yield delta
+
+
+class FakeBackend(Backend):
+    """
+    Local deterministic stand-in for a language model, which streams from a markdown template.
+
+    If the last message asks for a dialog "with the heading '...'", like
+    :meth:`Story.continue_story` does, a single dialog of the template is streamed with this
+    heading. The dialog is chosen by the hash of the heading, so the same request gives
+    the same result. Otherwise, the whole template is streamed, like for :meth:`Story.generate_story`.
+
+    Parameters
+    ----------
+    fname : str or Path, optional
+        The markdown template, by default the story template of the package
+    latency : float, optional
+        Seconds until the first chunk is sent
+    token_rate : float, optional
+        Chunks per second, None for no delay between the chunks
+    split : str, optional
+        "tokens" to send words with the following whitespace as chunks, "lines" to send lines
+    faults : Iterable[str], optional
+        The faults of the next requests in order, one of :data:`FAULTS` or None for no fault
+    fault_rates : dict[str, float], optional
+        The probabilities of the faults of the requests after the scripted `faults`
+    seed : int, optional
+        The seed of the random faults
+
+    Attributes
+    ----------
+    requests : int
+        The number of requests so far
+    injected : list[str]
+        The faults injected so far
+    """
+
+    def __init__(
+        self,
+        fname: Optional[str | Path] = None,
+        latency: float = 0.0,
+        token_rate: Optional[float] = None,
+        split: str = "tokens",
+        faults: Optional[Iterable[Optional[str]]] = None,
+        fault_rates: Optional[dict[str, float]] = None,
+        seed: Optional[int] = None,
+    ):
+        if fname is None:
+            fname = Path(str(files("storytime_ai.templates").joinpath("story.md")))
+        self.template = Path(fname).read_text()
+        self.latency = latency
+        self.token_rate = token_rate
+        self.split = split
+        self.requests = 0
+        self.faults = list(faults or [])
+        self.fault_rates = dict(fault_rates or {})
+        for fault in self.faults + list(self.fault_rates):
+            if fault is not None and fault not in FAULTS:
+                raise ValueError(f"Unknown fault {fault}, use one of {FAULTS}")
+        self.injected: list[str] = []
+        self._random = random.Random(seed)
+        parser = MarkdownParser()
+        self._dialogs = list(parser.parse(self.template).values())
+
+    def completion(self, messages: list[dict]) -> str:
+        """The complete text, which is streamed for the messages."""
+        x = HEADING_PATTERN.search(messages[-1].get("content", "")) if len(messages) > 0 else None
+        if x is None or len(self._dialogs) == 0:
+            return self.template
+        heading = x.group(1)
+        index = int(hashlib.sha256(heading.encode("utf-8")).hexdigest(), 16) % len(self._dialogs)
+        dialog = self._dialogs[index]
+        return f"## {heading}\n{dialog.text}\n{dialog.choices_to_markdown()}"
+
+    def chunks(self, text: str) -> list[str]:
+        """Split the text in the chunks to stream."""
+        if self.split == "lines":
+            return text.splitlines(keepends=True)
+        return TOKEN_PATTERN.findall(text)
+
+    def next_fault(self) -> Optional[str]:
+        """The fault of the next request, None for no fault."""
+        if len(self.faults) > 0:
+            return self.faults.pop(0)
+        x = self._random.random()
+        for fault, rate in self.fault_rates.items():
+            if x < rate:
+                return fault
+            x -= rate
+        return None
+
+    async def stream(self, messages: list[dict], model: str = "", **kwargs) -> AsyncIterator[str]:
+        self.requests += 1
+        fault = self.next_fault()
+        if fault is not None:
+            self.injected.append(fault)
+        delay = 1 / self.token_rate if self.token_rate else 0.0
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        if fault == "error":
+            raise ConnectionError("Injected connection error")
+        if fault == "stall":
+            # wait until cancelled
+            await asyncio.get_running_loop().create_future()
+        chunks = self.chunks(self.completion(messages))
+        for i, chunk in enumerate(chunks):
+            if i == len(chunks) // 2 and fault == "drop":
+                raise ConnectionError("Injected dropped connection")
+            if i == len(chunks) // 2 and fault == "hang":
+                await asyncio.get_running_loop().create_future()
+            await asyncio.sleep(delay)
+            yield chunk
@@ -0,0 +1,207 @@
+"""
+Completion cache
+================
+
+Cache for the completions of the language model.
+
+The key of a completion is a hash of the exact messages sent to the model and the
+parameters of the request, e.g. the model. Two backends are available:
+
+- :class:`LRUCompletionCache` keeps the completions in memory
+- :class:`SQLiteCompletionCache` keeps the completions in a SQLite database on disk
+
+Both evict entries after a time to live (TTL) and if the maximum size is exceeded,
+the least recently used entries first. The cache is used by :meth:`Story.continue_story`
+and :meth:`Story.generate_story`, if it is set as class attribute `Story.cache`.
+
+.. code-block:: python
+
+    from storytime_ai import Story
+    from storytime_ai.cache import SQLiteCompletionCache
+    Story.cache = SQLiteCompletionCache("log/completions.sqlite", maxsize=10000, ttl=24 * 3600)
+
+"""
+import abc
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import AsyncIterator, Optional
+
+
+def cache_key(messages: list[dict], **params) -> str:
+    """Hash of the messages and the parameters of a request to the model.
+
+    Parameters
+    ----------
+    messages : list[dict]
+        The messages sent to the model
+    params
+        The parameters of the request, e.g. model and temperature
+
+    Returns
+    -------
+    str
+        The hex digest of the SHA-256 hash
+    """
+    payload = json.dumps({"messages": messages, "params": params}, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+async def replay(completion: str) -> AsyncIterator[tuple[str, str]]:
+    """Replay a cached completion line by line like a streamed completion.
+
+    Yields
+    ------
+    current_result: str
+        The completion up to the current line
+    delta: str
+        The current line
+    """
+    current_result = ""
+    for delta in completion.splitlines(keepends=True):
+        current_result += delta
+        yield current_result, delta
+
+
+class CompletionCache(abc.ABC):
+    """
+    Base class of the completion caches.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        The maximum number of completions
+    ttl : float, optional
+        The time to live of a completion in seconds, None for no expiry
+    """
+
+    def __init__(self, maxsize: int = 1000, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @abc.abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        """Return the completion for the key, None if it is not cached or expired."""
+
+    @abc.abstractmethod
+    def set(self, key: str, completion: str):
+        """Store the completion for the key."""
+
+    @abc.abstractmethod
+    def clear(self):
+        """Remove all completions."""
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def _count(self, completion: Optional[str]) -> Optional[str]:
+        if completion is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return completion
+
+
+class LRUCompletionCache(CompletionCache):
+    """In memory cache, which evicts the least recently used completion first."""
+
+    def __init__(self, maxsize: int = 1000, ttl: Optional[float] = None):
+        super().__init__(maxsize, ttl)
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return self._count(None)
+        created, completion = entry
+        if self._expired(created):
+            del self._entries[key]
+            return self._count(None)
+        self._entries.move_to_end(key)
+        return self._count(completion)
+
+    def set(self, key: str, completion: str):
+        self._entries[key] = (time.time(), completion)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+class SQLiteCompletionCache(CompletionCache):
+    """
+    Cache in a SQLite database, which evicts the least recently used completion first.
+
+    Parameters
+    ----------
+    path : str or Path
+        The file of the database, ":memory:" for an in-memory database
+    maxsize : int, optional
+        The maximum number of completions
+    ttl : float, optional
+        The time to live of a completion in seconds, None for no expiry
+    """
+
+    def __init__(self, path: str | Path = "log/completions.sqlite", maxsize: int = 10000, ttl: Optional[float] = None):
+        super().__init__(maxsize, ttl)
+        if str(path) != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS completions "
+                "(key TEXT PRIMARY KEY, completion TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS completions_accessed ON completions (accessed)")
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock, self._db:
+            row = self._db.execute("SELECT completion, created FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return self._count(None)
+            completion, created = row
+            if self._expired(created):
+                self._db.execute("DELETE FROM completions WHERE key = ?", (key,))
+                return self._count(None)
+            self._db.execute("UPDATE completions SET accessed = ? WHERE key = ?", (time.time(), key))
+        return self._count(completion)
+
+    def set(self, key: str, completion: str):
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO completions (key, completion, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, completion, now, now),
+            )
+            if self.ttl is not None:
+                self._db.execute("DELETE FROM completions WHERE created < ?", (now - self.ttl,))
+            self._db.execute(
+                "DELETE FROM completions WHERE key IN "
+                "(SELECT key FROM completions ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.maxsize,),
+            )
+
+    def clear(self):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM completions")
+
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,155 @@
+"""
+Story checker
+=============
+
+Command line tool to check the integrity of many stories in parallel.
+
+Files and directories are given on the command line. Directories are searched
+recursively for markdown files. Parsing and checking is distributed over a pool of
+processes. The result of each file is printed as soon as it is available, either
+as text or as one JSON object per line. Finally, a summary with the aggregate timing
+is printed.
+
+.. code-block:: console
+
+    storytime-checker --jobs 4 --json stories/ other_story.md
+
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Iterator, Optional, Sequence
+
+from .discovery import find_story_files
+from .story import Story
+
+
+def check_file(fname: str | Path) -> dict:
+    """Parse a story and check its integrity.
+
+    Parameters
+    ----------
+    fname : str or Path
+        The markdown file of the story
+
+    Returns
+    -------
+    dict
+        The result with the keys file, ok, title, ndialogs, errors, warnings and seconds.
+        The messages, which the story prints while it is parsed, e.g. errors in its logic,
+        are added to the warnings, so they do not mix with the output of the checker.
+    """
+    start = time.perf_counter()
+    result: dict = {"file": str(fname)}
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            story = Story.from_markdown_file(fname)
+            report = story.integrity_report()
+    except Exception as e:
+        result.update(ok=False, title="", ndialogs=0, errors=[f"Cannot read story: {e!r}"], warnings=[])
+    else:
+        result.update(
+            ok=report.ok,
+            title=report.title,
+            ndialogs=report.ndialogs,
+            errors=report.errors,
+            warnings=report.warnings,
+        )
+    result["warnings"] = [line.strip() for line in output.getvalue().splitlines() if line.strip()] + result["warnings"]
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def check_files(files: Sequence[Path], jobs: int = 1) -> Iterator[dict]:
+    """Check many stories, in parallel if `jobs` is larger than one.
+
+    Parameters
+    ----------
+    files : Sequence[Path]
+        The markdown files of the stories
+    jobs : int, optional
+        The number of worker processes
+
+    Yields
+    ------
+    dict
+        The result of :func:`check_file` for each file, in the order of completion
+    """
+    if jobs <= 1 or len(files) <= 1:
+        for fname in files:
+            yield check_file(fname)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(check_file, fname) for fname in files]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def print_result(result: dict, asjson: bool = False):
+    """Print the result of a single file."""
+    if asjson:
+        print(json.dumps(result, ensure_ascii=False), flush=True)
+        return
+    for warning in result["warnings"]:
+        print(f"{result['file']}: Warning: {warning}")
+    for error in result["errors"]:
+        print(f"{result['file']}: Integrity check failed: {error}")
+    if result["ok"]:
+        print(f"{result['file']}: Integrity check passed")
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    """Entry point of the `storytime-checker` command line tool.
+
+    The exit code is 1, if the check of any story fails.
+    """
+    parser = argparse.ArgumentParser(
+        prog="storytime-checker", description="Check the integrity of stories in markdown files"
+    )
+    parser.add_argument("paths", nargs="+", help="markdown files or directories with markdown files")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=os.cpu_count() or 1, help="number of worker processes (default: all cores)"
+    )
+    parser.add_argument("--json", action="store_true", help="print one JSON object per file and for the summary")
+    args = parser.parse_args(argv)
+
+    files = find_story_files(args.paths)
+    jobs = max(1, min(args.jobs, len(files)))
+    start = time.perf_counter()
+    nfiles = nfailed = ndialogs = 0
+    busy = 0.0
+    for result in check_files(files, jobs=jobs):
+        print_result(result, asjson=args.json)
+        nfiles += 1
+        nfailed += not result["ok"]
+        ndialogs += result["ndialogs"]
+        busy += result["seconds"]
+    wall = time.perf_counter() - start
+    summary = {
+        "files": nfiles,
+        "failed": nfailed,
+        "dialogs": ndialogs,
+        "jobs": jobs,
+        "wall_seconds": wall,
+        "busy_seconds": busy,
+        "files_per_second": nfiles / wall if wall > 0 else 0.0,
+        "files_per_second_per_job": nfiles / wall / jobs if wall > 0 else 0.0,
+    }
+    if args.json:
+        print(json.dumps({"summary": summary}), file=sys.stderr)
+    else:
+        print(
+            f"Checked {nfiles} files with {ndialogs} dialogs in {wall:.3f} s using {jobs} jobs "
+            f"({summary['files_per_second']:.1f} files/s, {summary['files_per_second_per_job']:.1f} files/s per job), "
+            f"{nfailed} failed",
+            file=sys.stderr,
+        )
+    if nfailed > 0:
+        sys.exit(1)
@@ -3,6 +3,7 @@ Choice class
 ============
 """
 import logging
+import sys
 
 log = logging.getLogger("st." + __name__)
 
@@ -16,11 +17,20 @@ class Choice:
     text : str
         The text of the choice
     nextdialogid : str
-        The id of the next dialog, which is the heading of the next dialogue
+        The id of the next dialog, which is the heading of the next dialogue.
+        It is interned, so it shares its memory with the heading of the dialog and
+        the keys of the choices.
+
+    Notes
+    -----
+    Choices are compared and hashed by their fields. They are treated as immutable,
+    to change a choice of a dialog add a new one with :meth:`Dialog.addchoice`.
     """
 
+    __slots__ = ("text", "nextdialogid")
+
     def __init__(self, text: str, nextdialogid: str):
-        self.nextdialogid = nextdialogid
+        self.nextdialogid = sys.intern(nextdialogid)
         self.text = text
 
     def __repr__(self):
@@ -36,4 +46,9 @@ class Choice:
         return f"- {self.nextdialogid}: {self.text}"
 
     def __eq__(self, other):
-        return self.to_markdown() == other.to_markdown()
+        if not isinstance(other, Choice):
+            return NotImplemented
+        return self.nextdialogid == other.nextdialogid and self.text == other.text
+
+    def __hash__(self):
+        return hash((self.nextdialogid, self.text))
@@ -0,0 +1,136 @@
+"""
+Choice table
+============
+
+Compact struct-of-arrays representation of the choices of a story.
+
+Each :class:`Choice` object costs an object header, two references and an entry in the
+dictionary of its dialog. For stories with 100k+ dialogs this overhead dominates the memory.
+A :class:`ChoiceTable` numbers the interned dialog ids and stores the choices of all dialogs
+in flat arrays, in the layout of a compressed sparse row matrix: the choices of dialog ``i``
+are the entries ``offsets[i]`` to ``offsets[i + 1]`` of ``targets`` (the numbers of the next
+dialogs) and ``texts``.
+
+The table is an immutable snapshot, which is built from the dialogs with
+:meth:`ChoiceTable.from_dialogs` or :meth:`Story.choice_table`. Choice objects are only
+created on demand by :meth:`ChoiceTable.choices`.
+
+.. code-block:: python
+
+    from storytime_ai import Story
+    story = Story.from_markdown_file("storytime_ai/templates/story.md")
+    table = story.choice_table()
+    print(table.successors("And so it begins ..."), table.nbytes(), "bytes")
+
+"""
+import sys
+from array import array
+from typing import Iterator, Mapping
+
+from .choice import Choice
+from .dialog import Dialog
+
+
+class ChoiceTable:
+    """
+    The choices of many dialogs in flat arrays.
+
+    Attributes
+    ----------
+    ids : list[str]
+        The interned dialog ids, the position is the number of the dialog.
+        Dialogs, which only appear as target of a choice, are appended after the dialogs.
+    ndialogs : int
+        The number of dialogs with choices in the table, i.e. the rows
+    offsets : array
+        The start of the choices of each dialog in `targets` and `texts`, with one extra
+        entry for the end of the last dialog
+    targets : array
+        The number of the next dialog of each choice
+    texts : list[str]
+        The text of each choice
+    """
+
+    __slots__ = ("ids", "ndialogs", "offsets", "targets", "texts", "_numbers")
+
+    def __init__(self):
+        self.ids: list[str] = []
+        self.ndialogs = 0
+        self.offsets = array("L", [0])
+        self.targets = array("L")
+        self.texts: list[str] = []
+        self._numbers: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        """The number of choices."""
+        return len(self.targets)
+
+    def __contains__(self, dialogid) -> bool:
+        number = self._numbers.get(dialogid)
+        return number is not None and number < self.ndialogs
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.ids[: self.ndialogs])
+
+    def __repr__(self):
+        return f"ChoiceTable({self.ndialogs} dialogs, {len(self)} choices)"
+
+    def _number(self, dialogid: str) -> int:
+        number = self._numbers.get(dialogid)
+        if number is None:
+            number = len(self.ids)
+            dialogid = sys.intern(dialogid)
+            self.ids.append(dialogid)
+            self._numbers[dialogid] = number
+        return number
+
+    @classmethod
+    def from_dialogs(cls, dialogs: Mapping[str, Dialog]) -> "ChoiceTable":
+        """Build the table of the choices of the dialogs.
+
+        Parameters
+        ----------
+        dialogs : Mapping[str, Dialog]
+            The dialogs with the heading of each dialog as key, e.g. :attr:`Story.dialogs`
+
+        Returns
+        -------
+        ChoiceTable
+            The table with one row for each dialog in the order of the dialogs
+        """
+        table = cls()
+        # the dialogs get the first numbers, so the rows are 0 .. ndialogs - 1
+        for dialogid in dialogs:
+            table._number(dialogid)
+        table.ndialogs = len(table.ids)
+        for dialogid in table.ids[: table.ndialogs]:
+            for nextdialogid, choice in dialogs[dialogid].choices.items():
+                table.targets.append(table._number(nextdialogid))
+                table.texts.append(choice.text)
+            table.offsets.append(len(table.targets))
+        return table
+
+    def _row(self, dialogid: str) -> range:
+        number = self._numbers.get(dialogid)
+        if number is None or number >= self.ndialogs:
+            raise KeyError(dialogid)
+        return range(self.offsets[number], self.offsets[number + 1])
+
+    def successors(self, dialogid: str) -> list[str]:
+        """The ids of the next dialogs of the choices of a dialog."""
+        return [self.ids[self.targets[i]] for i in self._row(dialogid)]
+
+    def choices(self, dialogid: str) -> dict[str, Choice]:
+        """The choices of a dialog as new Choice objects, like :attr:`Dialog.choices`."""
+        res = {}
+        for i in self._row(dialogid):
+            nextdialogid = self.ids[self.targets[i]]
+            res[nextdialogid] = Choice(self.texts[i], nextdialogid)
+        return res
+
+    def nbytes(self) -> int:
+        """Estimate the memory of the table in bytes, including the strings."""
+        nbytes = sys.getsizeof(self.ids) + sum(sys.getsizeof(d) for d in self.ids)
+        nbytes += sys.getsizeof(self._numbers) + sys.getsizeof(self.offsets) + sys.getsizeof(self.targets)
+        nbytes += sys.getsizeof(self.texts) + sum(sys.getsizeof(t) for t in self.texts)
+        return nbytes
@@ -0,0 +1,298 @@
+"""
+Clients
+=======
+
+Process-wide limits for the requests to the language model.
+
+Many players share the same API key. The :class:`ClientManager` in the class attribute
+`Story.clients` is used by all generations of :class:`Story`, i.e. :meth:`Story.generate_story`,
+:meth:`Story.continue_story` and the prefetching. It
+
+- limits the number of requests in flight with a semaphore, further requests wait in a queue,
+- limits the rate of the requests per model with a :class:`TokenBucket`,
+- opens the keep-alive connection pool of the backend, see :meth:`ClientManager.open`,
+- counts the queue depth and the waiting times in :class:`ClientMetrics`.
+
+.. code-block:: python
+
+    from storytime_ai import Story
+    from storytime_ai.clients import ClientManager
+    Story.clients = ClientManager(max_in_flight=8, rate_limits={"gpt-4": 0.5})
+    ...
+    print(Story.clients.metrics)
+
+"""
+import asyncio
+import contextlib
+import logging
+import threading
+import time
+import weakref
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Optional
+
+from .backends import Backend
+
+log = logging.getLogger("st." + __name__)
+
+
+class TokenBucket:
+    """
+    Rate limit with a token bucket. Each request takes one token, the tokens are refilled
+    with a constant rate up to the capacity of the bucket.
+
+    The tokens are reserved in the order of the requests, so the waiting requests are served
+    first in, first out. The bucket does not depend on an event loop and can be shared by threads.
+
+    Parameters
+    ----------
+    rate : float
+        The tokens refilled per second, i.e. the sustained requests per second
+    burst : float, optional
+        The capacity of the bucket, i.e. the requests which can be sent at once, by default
+        one second of the rate, but at least one
+    clock : Callable[[], float], optional
+        The clock in seconds
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None, clock: Callable[[], float] = time.monotonic):
+        if rate <= 0:
+            raise ValueError(f"The rate must be positive, not {rate}")
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """Take a token and return the seconds until it is available."""
+        with self._lock:
+            self._refill()
+            self.tokens -= 1
+            tokens = self.tokens
+        if tokens >= 0:
+            return 0.0
+        return -tokens / self.rate
+
+    def release(self):
+        """Give back a reserved token, which was not used."""
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+    async def acquire(self) -> float:
+        """Wait for a token.
+
+        Returns
+        -------
+        float
+            The seconds waited
+        """
+        delay = self.reserve()
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                self.release()
+                raise
+        return delay
+
+
+@dataclass
+class ClientMetrics:
+    """
+    Metrics of the requests of a :class:`ClientManager`.
+
+    Attributes
+    ----------
+    requests : int
+        The number of started requests
+    in_flight : int
+        The number of requests running now
+    max_in_flight : int
+        The maximum number of requests running at the same time
+    queued : int
+        The number of requests waiting now, the queue depth
+    max_queued : int
+        The maximum queue depth
+    total_wait : float
+        The seconds all requests waited for the semaphore and the rate limit
+    max_wait : float
+        The maximum seconds a request waited
+    rate_limited : int
+        The number of requests delayed by the rate limit
+    """
+
+    requests: int = 0
+    in_flight: int = 0
+    max_in_flight: int = 0
+    queued: int = 0
+    max_queued: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+    rate_limited: int = 0
+
+    @property
+    def mean_wait(self) -> float:
+        return self.total_wait / self.requests if self.requests > 0 else 0.0
+
+
+class ClientManager:
+    """
+    Limits the concurrency and the rate of the requests to the language model.
+
+    The semaphore is created for each event loop, so `max_in_flight` applies to the requests
+    in one event loop, e.g. the :func:`~storytime_ai.eventloop.get_background_loop` of the
+    Streamlit app. The rate limits and the metrics are shared by all event loops and their
+    threads, they are changed under a lock.
+
+    Parameters
+    ----------
+    max_in_flight : int, optional
+        The maximum number of requests running at the same time
+    rate_limits : dict[str, float], optional
+        The maximum requests per second for each model, see :meth:`set_rate_limit`
+    clock : Callable[[], float], optional
+        The clock in seconds
+
+    Attributes
+    ----------
+    metrics : ClientMetrics
+        The counts of the requests and the waiting times
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int = 16,
+        rate_limits: Optional[dict[str, float]] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if max_in_flight < 1:
+            raise ValueError(f"max_in_flight must be at least 1, not {max_in_flight}")
+        self.max_in_flight = max_in_flight
+        self.clock = clock
+        self.metrics = ClientMetrics()
+        self.buckets: dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+        for model, rate in (rate_limits or {}).items():
+            self.set_rate_limit(model, rate)
+        self._semaphores: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore] = (
+            weakref.WeakKeyDictionary()
+        )
+
+    def set_rate_limit(self, model: str, rate: Optional[float], burst: Optional[float] = None):
+        """Set the rate limit of a model.
+
+        Parameters
+        ----------
+        model : str
+            The name of the model
+        rate : float, optional
+            The maximum requests per second, None to remove the limit
+        burst : float, optional
+            The requests which can be sent at once, see :class:`TokenBucket`
+        """
+        if rate is None:
+            self.buckets.pop(model, None)
+        else:
+            self.buckets[model] = TokenBucket(rate, burst, clock=self.clock)
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            semaphore = self._semaphores.get(loop)
+            if semaphore is None:
+                semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_in_flight)
+        return semaphore
+
+    @contextlib.asynccontextmanager
+    async def slot(self, model: str):
+        """Wait until a request to the model may be sent and hold its place while it is running.
+
+        Parameters
+        ----------
+        model : str
+            The name of the model
+
+        Yields
+        ------
+        float
+            The seconds waited
+        """
+        metrics = self.metrics
+        semaphore = self._semaphore()
+        start = self.clock()
+        with self._lock:
+            metrics.queued += 1
+            metrics.max_queued = max(metrics.max_queued, metrics.queued)
+        try:
+            await semaphore.acquire()
+            try:
+                bucket = self.buckets.get(model)
+                if bucket is not None and await bucket.acquire() > 0:
+                    with self._lock:
+                        metrics.rate_limited += 1
+            except BaseException:
+                semaphore.release()
+                raise
+        finally:
+            with self._lock:
+                metrics.queued -= 1
+        wait = self.clock() - start
+        with self._lock:
+            metrics.requests += 1
+            metrics.total_wait += wait
+            metrics.max_wait = max(metrics.max_wait, wait)
+            metrics.in_flight += 1
+            metrics.max_in_flight = max(metrics.max_in_flight, metrics.in_flight)
+        if wait > 0.1:
+            log.debug(f"Request to {model} waited {wait:.2f} s, {metrics.queued} requests queued")
+        try:
+            yield wait
+        finally:
+            with self._lock:
+                metrics.in_flight -= 1
+            semaphore.release()
+
+    async def stream(self, backend: Backend, messages: list[dict], model: str, **kwargs) -> AsyncIterator[str]:
+        """Stream the completion of the messages from the backend within the limits.
+
+        The place of the request is held until the stream is finished or closed.
+
+        Parameters
+        ----------
+        backend : Backend
+            The backend, e.g. `Story.backend`
+        messages : list[dict]
+            The chat messages
+        model : str
+            The name of the model
+        kwargs
+            Further parameters of the request
+
+        Yields
+        ------
+        str
+            The string that was just added to the completion
+        """
+        async with self.slot(model):
+            async for delta in backend.stream(messages, model=model, **kwargs):
+                yield delta
+
+    async def open(self, backend: Backend):
+        """Open the keep-alive connection pool of the backend in the running event loop.
+
+        The pool of the backend is enlarged to `max_in_flight` connections, if it is smaller.
+        """
+        if getattr(backend, "max_connections", self.max_in_flight) < self.max_in_flight:
+            backend.max_connections = self.max_in_flight
+        await backend.open()
+
+    async def aclose(self, backend: Backend):
+        """Close the connection pool of the backend."""
+        await backend.aclose()
@@ -0,0 +1,249 @@
+"""
+Context window
+==============
+
+Token budgeted context of the messages sent to the language model.
+
+The :class:`ContextWindow` keeps the system prompt, the most recent dialogs as messages and
+a rolling summary of the older dialogs. Each message is stored with an estimate of its
+number of tokens, see :func:`estimate_tokens`, so the size of a prompt is known without
+a tokenizer. If the recent messages exceed the token budget or the maximum number of
+recent messages, the oldest ones are replaced by a single line in the summary. The summary
+itself is limited by its own budget, so the prompt size stays flat no matter how long
+the story runs.
+
+The messages are plain dicts, which are never changed after they were added. Prompts are
+built by concatenating the lists, no deep copy is needed.
+
+.. code-block:: python
+
+    from storytime_ai import Story
+    story = Story.from_markdown_file("storytime_ai/templates/story.md")
+    story.context.budget = 2000
+    messages = story.build_messages("Weg nach links")
+
+"""
+import re
+from collections import deque
+from typing import Iterable, Optional
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+MESSAGE_OVERHEAD = 4
+"""Tokens added by the chat format for each message"""
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens of a text without a tokenizer.
+
+    Each word and each punctuation character counts as one token, long words count
+    as one token per eight characters.
+
+    Parameters
+    ----------
+    text : str
+        The text
+
+    Returns
+    -------
+    int
+        The estimated number of tokens
+    """
+    return sum(1 + len(word) // 8 for word in TOKEN_PATTERN.findall(text))
+
+
+def message_tokens(message: dict) -> int:
+    """Estimate the number of tokens of a chat message including the overhead of the format."""
+    return estimate_tokens(message["content"]) + MESSAGE_OVERHEAD
+
+
+def summarize_dialog(dialog, maxlength: int = 200) -> str:
+    """Summary of a dialog in a single line: the heading and the first sentence of the text.
+
+    Parameters
+    ----------
+    dialog : Dialog
+        The dialog
+    maxlength : int, optional
+        The maximum number of characters of the text
+
+    Returns
+    -------
+    str
+        The summary line
+    """
+    text = " ".join(dialog.text.split())
+    x = re.search(r"[.!?](\s|$)", text)
+    if x is not None:
+        text = text[: x.start() + 1]
+    if len(text) > maxlength:
+        text = text[: maxlength - 3].rstrip() + "..."
+    return f"- {dialog.dialogid}: {text}" if text else f"- {dialog.dialogid}"
+
+
+class _Entry:
+    """A recent message with the dialog it contains."""
+
+    __slots__ = ("message", "tokens", "dialogid", "summary")
+
+    def __init__(self, message: dict, dialogid: Optional[str], summary: Optional[str]):
+        self.message = message
+        self.tokens = message_tokens(message)
+        self.dialogid = dialogid
+        self.summary = summary
+
+
+class ContextWindow:
+    """
+    Messages for the language model within a token budget.
+
+    Parameters
+    ----------
+    budget : int, optional
+        The maximum number of tokens of a prompt, including the messages given to :meth:`build`
+    max_recent : int, optional
+        The maximum number of recent messages, older messages are summarised
+    summary_budget : int, optional
+        The maximum number of tokens of the summary, the oldest lines are dropped first
+
+    Attributes
+    ----------
+    system : dict or None
+        The system prompt, always the first message
+    summary : deque[str]
+        The lines of the rolling summary of the older dialogs
+    """
+
+    summary_header = "Summary of the story so far:"
+
+    def __init__(self, budget: int = 3000, max_recent: int = 5, summary_budget: int = 500):
+        self.budget = budget
+        self.max_recent = max_recent
+        self.summary_budget = summary_budget
+        self.system: Optional[dict] = None
+        self.summary: deque[str] = deque()
+        self._summary_tokens = 0
+        self._recent: deque[_Entry] = deque()
+        self._recent_tokens = 0
+
+    def __len__(self):
+        return len(self._recent)
+
+    @property
+    def last_dialogid(self) -> Optional[str]:
+        """The heading of the dialog in the last message, if any."""
+        return self._recent[-1].dialogid if len(self._recent) > 0 else None
+
+    @property
+    def messages(self) -> list[dict]:
+        """The system prompt and the recent messages, without the summary."""
+        res = [self.system] if self.system is not None else []
+        return res + [entry.message for entry in self._recent]
+
+    def copy(self) -> "ContextWindow":
+        """Copy of the window, the messages are shared."""
+        res = ContextWindow(self.budget, self.max_recent, self.summary_budget)
+        res.system = self.system
+        res.summary = deque(self.summary)
+        res._summary_tokens = self._summary_tokens
+        res._recent = deque(self._recent)
+        res._recent_tokens = self._recent_tokens
+        return res
+
+    def clear(self):
+        """Remove all messages and the summary."""
+        self.system = None
+        self.summary.clear()
+        self._summary_tokens = 0
+        self._recent.clear()
+        self._recent_tokens = 0
+
+    def add(self, message: dict, dialog=None):
+        """Add a message and summarise the oldest messages, if the window is full.
+
+        Parameters
+        ----------
+        message : dict
+            The message, which must not be changed afterwards
+        dialog : Dialog, optional
+            The dialog in the message, used for the summary when the message is removed
+        """
+        summary = summarize_dialog(dialog) if dialog is not None else None
+        entry = _Entry(message, dialog.dialogid if dialog is not None else None, summary)
+        self._recent.append(entry)
+        self._recent_tokens += entry.tokens
+        while len(self._recent) > 1 and (
+            len(self._recent) > self.max_recent or self._fixed_tokens() + self._recent_tokens > self.budget
+        ):
+            self._evict()
+
+    def add_dialog(self, dialog):
+        """Add a dialog as system message in markdown, unless it is already the last message."""
+        if dialog.dialogid == self.last_dialogid:
+            return
+        self.add({"role": "system", "content": dialog.to_markdown()}, dialog)
+
+    def summarize_history(self, dialogs: Iterable):
+        """Add the dialogs to the summary, e.g. the result of :meth:`Story.list_from_history`."""
+        for dialog in dialogs:
+            self._add_summary(summarize_dialog(dialog))
+
+    def summary_message(self) -> Optional[dict]:
+        """The summary as system message, None if it is empty."""
+        if len(self.summary) == 0:
+            return None
+        return {"role": "system", "content": self.summary_header + "\n" + "\n".join(self.summary)}
+
+    def tokens(self, messages: Iterable[dict]) -> int:
+        """Estimate the number of tokens of messages."""
+        return sum(message_tokens(m) for m in messages)
+
+    def build(self, extra: Iterable[dict] = ()) -> list[dict]:
+        """Build the messages of a prompt within the token budget without changing the window.
+
+        If the budget is exceeded, the oldest recent messages are left out and summarised
+        in the summary message of this prompt.
+
+        Parameters
+        ----------
+        extra : Iterable[dict]
+            Messages appended at the end of the prompt, e.g. the instruction for the model
+
+        Returns
+        -------
+        list[dict]
+            The system prompt, the summary, the recent messages and the extra messages
+        """
+        extra = list(extra)
+        available = self.budget - self._fixed_tokens() - self.tokens(extra)
+        recent = list(self._recent)
+        used = self._recent_tokens
+        dropped = []
+        while len(recent) > 1 and used > available:
+            entry = recent.pop(0)
+            used -= entry.tokens
+            if entry.summary is not None:
+                dropped.append(entry.summary)
+        res = [self.system] if self.system is not None else []
+        lines = list(self.summary) + dropped
+        if len(lines) > 0:
+            res.append({"role": "system", "content": self.summary_header + "\n" + "\n".join(lines)})
+        return res + [entry.message for entry in recent] + extra
+
+    def _fixed_tokens(self) -> int:
+        tokens = message_tokens(self.system) if self.system is not None else 0
+        if len(self.summary) > 0:
+            tokens += self._summary_tokens + estimate_tokens(self.summary_header) + MESSAGE_OVERHEAD
+        return tokens
+
+    def _evict(self):
+        entry = self._recent.popleft()
+        self._recent_tokens -= entry.tokens
+        if entry.summary is not None:
+            self._add_summary(entry.summary)
+
+    def _add_summary(self, line: str):
+        self.summary.append(line)
+        self._summary_tokens += estimate_tokens(line)
+        while len(self.summary) > 1 and self._summary_tokens > self.summary_budget:
+            self._summary_tokens -= estimate_tokens(self.summary.popleft())
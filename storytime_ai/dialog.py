@@ -3,9 +3,12 @@ Dialog class
 ============
 
 """
+import hashlib
+import sys
+from typing import Iterable
+
 from .choice import Choice
-import re
-import os
+from .logic import CompiledLogic
 
 
 class Dialog:
@@ -19,6 +22,7 @@ class Dialog:
     ----------
     dialogid : str
         The unique identifier of the dialog. It is a heading in the markdown output.
+        It is interned like the next dialog ids of the choices.
     text : str
         Dialog text. It is a paragraph in the markdown output. Markdown is supported,
         if the heading level is not higher than three ('###')
@@ -27,9 +31,19 @@ class Dialog:
         the value is the Choice object.
     logic : str
         A string containing the logic. It is parsed by the Story.exec_logic() method.
-
+    compiled_logic : CompiledLogic
+        The logic compiled once on first use. It is recompiled, if the logic changes.
+
+    Notes
+    -----
+    Dialogs are compared by their :meth:`fingerprint`, which is computed once and cached.
+    Setting an attribute, :meth:`addchoice` and :meth:`removechoice` clear the cache. If the
+    dictionary of choices is changed in place, call :meth:`changed` afterwards.
     """
 
+    # no __dict__ per dialog, stories can have 100k+ dialogs
+    __slots__ = ("_dialogid", "_text", "_choices", "_logic", "_compiled_logic", "_fingerprint")
+
     def __init__(self, dialogid: str, text: str, choices: dict[str, Choice], logic: str = ""):
         """
         Parameters
@@ -44,9 +58,74 @@ class Dialog:
         self.choices = choices
         self.logic = logic
 
+    @property
+    def dialogid(self) -> str:
+        return self._dialogid
+
+    @dialogid.setter
+    def dialogid(self, dialogid: str):
+        self._dialogid = sys.intern(dialogid)
+        self.changed()
+
+    @property
+    def text(self) -> str:
+        return self._text
+
+    @text.setter
+    def text(self, text: str):
+        self._text = text
+        self.changed()
+
+    @property
+    def choices(self) -> dict[str, Choice]:
+        return self._choices
+
+    @choices.setter
+    def choices(self, choices: dict[str, Choice]):
+        self._choices = choices
+        self.changed()
+
+    @property
+    def logic(self) -> str:
+        return self._logic
+
+    @logic.setter
+    def logic(self, logic: str):
+        self._logic = logic
+        self._compiled_logic = None
+        self.changed()
+
+    @property
+    def compiled_logic(self) -> CompiledLogic:
+        if self._compiled_logic is None:
+            self._compiled_logic = CompiledLogic.compile(self._logic)
+        return self._compiled_logic
+
     def addchoice(self, text: str, nextdialogid: str):
         choice = Choice(text, nextdialogid)
-        self.choices[choice.nextdialogid] = choice
+        self._choices[choice.nextdialogid] = choice
+        self.changed()
+
+    def removechoice(self, nextdialogid: str) -> Choice:
+        """Remove the choice to the dialog with the heading `nextdialogid` and return it."""
+        choice = self._choices.pop(nextdialogid)
+        self.changed()
+        return choice
+
+    def changed(self):
+        """Clear the cached fingerprint after an in-place change."""
+        self._fingerprint = None
+
+    def copy(self) -> "Dialog":
+        """Copy of the dialog with its own dictionary of choices.
+
+        The choices, the compiled logic and the cached fingerprint are shared with the original dialog.
+        """
+        res = Dialog(self.dialogid, self.text, dict(self.choices))
+        res._logic = self._logic
+        res._compiled_logic = self._compiled_logic
+        res._fingerprint = self._fingerprint
+        return res
 
     def __repr__(self):
         return f"Dialog({self.dialogid}, {self.text}, {self.choices})"
@@ -85,65 +164,52 @@ class Dialog:
             return f"## {self.dialogid}\n{self.text}\n{self.choices_to_markdown()}"
 
     @classmethod
-    def from_markdown(cls, markdown: str):
+    def from_markdown(cls, markdown: str | Iterable[str]):
         """Create a Dialog object from a markdown string.
 
+        Only the last heading is used as dialogid, everything before it is ignored.
+
         Parameters
         ----------
-        markdown : str
-            The markdown string to parse.
+        markdown : str or Iterable[str]
+            The markdown string to parse or an iterable of lines, e.g. a file object.
+        """
+        from .parser import parse_dialog
+
+        return parse_dialog(markdown)
+
+    def normalized(self) -> str:
+        """The markdown of the dialog without empty lines and without leading and trailing spaces."""
+        return "\n".join([line.strip() for line in self.to_markdown().splitlines() if line])
+
+    def fingerprint(self) -> str:
+        """Stable hash of the normalised markdown, equal dialogs have the same fingerprint.
+
+        The fingerprint is computed once and cached until the dialog is changed. It is the same
+        in all processes, e.g. to find duplicates of generated dialogs.
+
+        Returns
+        -------
+        str
+            The BLAKE2b hash with 16 bytes in hex
         """
-        # Use only the last heading as dialogid
-        markdown = markdown.split("\n## ")[-1]
-        if not markdown.startswith("## "):
-            markdown = "## " + markdown
-        lines = markdown.split("\n")
-        dialogid = ""
-        text = ""
-        choices = {}
-        choicetext = ""
-        nextdialogid = ""
-        logic = ""
-        for line in lines:
-            if line == "":
-                pass
-            elif line.startswith("# "):
-                print("WARNING! Title given in markdown string. This is ignored.")
-                pass
-            elif line.startswith("## "):
-                if dialogid != "":
-                    print("WARNING: multiple dialog ids found in markdown string.")
-                    break
-                dialogid = line[3:].strip()
-            elif line.startswith("LOGIC "):
-                logic += line[6:] + "\n"
-            elif line.startswith("- "):
-                if nextdialogid != "":
-                    # a new choice is found, so the previous one is added to the dictionary
-                    choices[nextdialogid] = Choice(choicetext, nextdialogid)
-                x = re.search(r"- (.+): (.+)", line)
-                if x is not None:
-                    nextdialogid = x.group(1).strip()
-                    choicetext = x.group(2).strip()
-            elif len(nextdialogid) > 0:
-                # the line is in the choices section
-                choicetext += "\n" + line
-            else:
-                # then line is in the dialog section
-                text += line + "\n"
-        if len(nextdialogid) > 0:
-            choices[nextdialogid] = Choice(choicetext, nextdialogid)
-        if len(logic) > 0 and logic[-1] == "\n":
-            logic = logic[:-1]
-        return cls(dialogid, text, choices, logic)
+        if self._fingerprint is None:
+            self._fingerprint = hashlib.blake2b(self.normalized().encode("utf-8"), digest_size=16).hexdigest()
+        return self._fingerprint
 
     def __eq__(self, other):
         """Equal operator for the Dialog object.
 
-        Empty lines are ignored and leading and trailing spaces are removed.
+        Empty lines are ignored and leading and trailing spaces are removed. The cached
+        fingerprints are compared, the normalised markdown is only computed once per change.
+        """
+        if not isinstance(other, Dialog):
+            return NotImplemented
+        return self is other or self.fingerprint() == other.fingerprint()
+
+    def __hash__(self):
+        """Hash of the heading, which stays the same, when the text or the choices are changed.
+
+        Equal dialogs have the same heading, up to leading and trailing spaces.
         """
-        a = self.to_markdown()
-        b = other.to_markdown()
-        a = os.linesep.join([s.strip() for s in a.splitlines() if s])
-        b = os.linesep.join([s.strip() for s in b.splitlines() if s])
-        return a == b
+        return hash(self.dialogid.strip())
@@ -0,0 +1,294 @@
+"""
+Dialog store
+============
+
+The container for the dialogs of a story.
+
+A DialogStore behaves like a dictionary of Dialog objects with the heading of each dialog
+as key. It owns the :class:`StoryGraph` of the dialogs, which is built on first use and
+afterwards updated incrementally, whenever a dialog is added, replaced or removed.
+If the choices or the logic of a dialog are changed in place, :meth:`DialogStore.changed`
+updates the graph.
+
+A :class:`LayeredDialogStore` is a private copy-on-write overlay over a shared store, e.g. the
+dialogs of a template, which are played by many players. Added, replaced and removed dialogs
+are kept in the overlay, all other dialogs are looked up in the shared store. Dialogs, which
+are changed in place, are copied to the overlay first with :meth:`DialogStore.writable`.
+The graph of an overlay is a :class:`~storytime_ai.graph.LayeredStoryGraph` over the graph of the
+shared store. The memory of an overlay is proportional to the changed dialogs, not to the size
+of the story.
+
+.. code-block:: python
+
+    shared = DialogStore(dialogs)
+    private = shared.fork()
+    private["New dialog"] = Dialog("New dialog", "Generated text", {})
+    private.writable("Start").addchoice("Go on", "New dialog")
+    private.changed("Start")
+    print(private.nbytes(), "bytes in the overlay")
+    private.merge()  # publish the changes to the shared store
+
+"""
+import hashlib
+import sys
+from collections.abc import ValuesView
+from typing import Iterator, Mapping, MutableMapping, Optional
+
+from .dialog import Dialog
+from .graph import LayeredStoryGraph, StoryGraph
+
+
+def dialog_nbytes(dialog: Dialog) -> int:
+    """Estimate the memory of a dialog in bytes, including its strings and choices.
+
+    The interned dialog ids of the choices are shared with the headings and are not counted.
+    """
+    nbytes = sys.getsizeof(dialog)
+    nbytes += sys.getsizeof(dialog.dialogid) + sys.getsizeof(dialog.text) + sys.getsizeof(dialog.logic)
+    nbytes += sys.getsizeof(dialog.choices)
+    for choice in dialog.choices.values():
+        nbytes += sys.getsizeof(choice) + sys.getsizeof(choice.text)
+    return nbytes
+
+
+class DialogStore(MutableMapping):
+    """
+    Dictionary of dialogs with an incrementally updated graph.
+
+    Parameters
+    ----------
+    dialogs : Mapping[str, Dialog], optional
+        The initial dialogs
+    """
+
+    def __init__(self, dialogs: Mapping[str, Dialog] = {}):
+        self._dialogs: dict[str, Dialog] = dict(dialogs)
+        self._graph: Optional[StoryGraph | LayeredStoryGraph] = None
+        self.version = 0
+        self._fingerprint: Optional[tuple] = None
+
+    def __getitem__(self, dialogid: str) -> Dialog:
+        return self._dialogs[dialogid]
+
+    def __setitem__(self, dialogid: str, dialog: Dialog):
+        self._dialogs[dialogid] = dialog
+        self.version += 1
+        if self._graph is not None:
+            self._graph.set_dialog(dialogid, dialog)
+
+    def __delitem__(self, dialogid: str):
+        del self._dialogs[dialogid]
+        self.version += 1
+        if self._graph is not None:
+            self._graph.remove_dialog(dialogid)
+
+    def __contains__(self, dialogid) -> bool:
+        return dialogid in self._dialogs
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._dialogs)
+
+    def __len__(self) -> int:
+        return len(self._dialogs)
+
+    def __repr__(self):
+        return f"DialogStore({self._dialogs})"
+
+    def values(self) -> ValuesView[Dialog]:
+        # the view of the dict, without a lookup of each dialog
+        return self._dialogs.values()
+
+    @property
+    def graph(self) -> StoryGraph | LayeredStoryGraph:
+        """The graph of the dialogs, built on first access."""
+        if self._graph is None:
+            self._graph = StoryGraph(self._dialogs)
+        return self._graph
+
+    def changed(self, dialogid: str):
+        """Update the graph after the choices or the logic of a dialog were changed in place.
+
+        Parameters
+        ----------
+        dialogid : str
+            The heading of the changed dialog
+        """
+        self[dialogid].changed()
+        self.version += 1
+        if self._graph is not None:
+            self._graph.set_dialog(dialogid, self[dialogid])
+
+    def fingerprint(self) -> str:
+        """Stable hash of the dialogs in their order.
+
+        The hash is cached for the cached fingerprints of the dialogs, so it also changes,
+        if a dialog is changed in place without :meth:`changed`, e.g. with :meth:`Dialog.addchoice`.
+
+        Returns
+        -------
+        str
+            The BLAKE2b hash of the fingerprints of the dialogs with 16 bytes in hex
+        """
+        fingerprints = tuple(dialog.fingerprint() for dialog in self.values())
+        if self._fingerprint is None or self._fingerprint[0] != fingerprints:
+            h = hashlib.blake2b(digest_size=16)
+            for fingerprint in fingerprints:
+                h.update(fingerprint.encode("ascii"))
+            self._fingerprint = (fingerprints, h.hexdigest())
+        return self._fingerprint[1]
+
+    def writable(self, dialogid: str) -> Dialog:
+        """Return the dialog to change it in place, call :meth:`changed` afterwards.
+
+        Parameters
+        ----------
+        dialogid : str
+            The heading of the dialog
+
+        Returns
+        -------
+        Dialog
+            The dialog, which is owned by this store
+        """
+        return self._dialogs[dialogid]
+
+    def fork(self) -> "LayeredDialogStore":
+        """Return a private copy-on-write overlay over this store."""
+        return LayeredDialogStore(self)
+
+    def nbytes(self) -> int:
+        """Estimate the memory of the dialogs owned by this store in bytes."""
+        return sys.getsizeof(self._dialogs) + sum(dialog_nbytes(d) for d in self._dialogs.values())
+
+
+class LayeredDialogStore(DialogStore):
+    """
+    Copy-on-write overlay over a shared dialog store.
+
+    Reads fall through to the shared store, writes only change the overlay. The shared store
+    is never changed, except by :meth:`merge`.
+
+    Parameters
+    ----------
+    base : DialogStore
+        The shared store
+
+    Attributes
+    ----------
+    base : DialogStore
+        The shared store
+    deleted : set[str]
+        The headings of the dialogs of the shared store, which are removed in the overlay
+    """
+
+    def __init__(self, base: DialogStore):
+        super().__init__()
+        self.base = base
+        self.deleted: set[str] = set()
+        # dialogs in the overlay, which are not shared with a fork
+        self._owned: set[str] = set()
+
+    def __getitem__(self, dialogid: str) -> Dialog:
+        if dialogid in self._dialogs:
+            return self._dialogs[dialogid]
+        if dialogid in self.deleted:
+            raise KeyError(dialogid)
+        return self.base[dialogid]
+
+    def __setitem__(self, dialogid: str, dialog: Dialog):
+        self.deleted.discard(dialogid)
+        self._owned.add(dialogid)
+        super().__setitem__(dialogid, dialog)
+
+    def __delitem__(self, dialogid: str):
+        if dialogid not in self:
+            raise KeyError(dialogid)
+        self._dialogs.pop(dialogid, None)
+        self._owned.discard(dialogid)
+        if dialogid in self.base:
+            self.deleted.add(dialogid)
+        self.version += 1
+        if self._graph is not None:
+            self._graph.remove_dialog(dialogid)
+
+    def __contains__(self, dialogid) -> bool:
+        return dialogid in self._dialogs or (dialogid not in self.deleted and dialogid in self.base)
+
+    def __iter__(self) -> Iterator[str]:
+        for dialogid in self.base:
+            if dialogid not in self.deleted:
+                yield dialogid
+        for dialogid in self._dialogs:
+            if dialogid not in self.base:
+                yield dialogid
+
+    def __len__(self) -> int:
+        n = len(self.base) - sum(1 for d in self.deleted if d in self.base)
+        return n + sum(1 for d in self._dialogs if d not in self.base)
+
+    def __repr__(self):
+        return f"LayeredDialogStore({self._dialogs}, deleted={self.deleted}, base={len(self.base)} dialogs)"
+
+    def values(self) -> ValuesView[Dialog]:
+        return ValuesView(self)
+
+    @property
+    def overlay(self) -> dict[str, Dialog]:
+        """The added and replaced dialogs of this store."""
+        return self._dialogs
+
+    @property
+    def graph(self) -> LayeredStoryGraph:
+        """The graph of the dialogs, which shares the graph of the shared store and only keeps the overlay."""
+        if self._graph is None:
+            graph = LayeredStoryGraph(self.base.graph)
+            for dialogid in self.deleted:
+                graph.remove_dialog(dialogid)
+            for dialogid, dialog in self._dialogs.items():
+                graph.set_dialog(dialogid, dialog)
+            self._graph = graph
+        return self._graph
+
+    def writable(self, dialogid: str) -> Dialog:
+        """Return the dialog to change it in place, a shared dialog is copied to the overlay first."""
+        if dialogid not in self._owned:
+            self._dialogs[dialogid] = self[dialogid].copy()
+            self._owned.add(dialogid)
+        return self._dialogs[dialogid]
+
+    def fork(self) -> "LayeredDialogStore":
+        """Return a private overlay over this overlay.
+
+        :meth:`merge` of the fork applies its changes to this overlay, not to the shared store.
+        The dialogs of this overlay are copied by :meth:`writable` before they are changed
+        in place again, so the fork keeps the dialogs it has seen.
+        """
+        self._owned.clear()
+        return LayeredDialogStore(self)
+
+    def merge(self) -> list[str]:
+        """Apply the changes of the overlay to the shared store and clear the overlay.
+
+        Returns
+        -------
+        list[str]
+            The headings of the added, replaced and removed dialogs
+        """
+        changed = list(self._dialogs) + list(self.deleted)
+        for dialogid, dialog in self._dialogs.items():
+            self.base[dialogid] = dialog
+        for dialogid in self.deleted:
+            if dialogid in self.base:
+                del self.base[dialogid]
+        self._dialogs.clear()
+        self.deleted.clear()
+        self._owned.clear()
+        if self._graph is not None:
+            # the graphs of the forks of this store are layered over it
+            self._graph.clear()
+        self.version += 1
+        return changed
+
+    def nbytes(self) -> int:
+        """Estimate the memory of the overlay in bytes, the shared store is not included."""
+        return super().nbytes() + sys.getsizeof(self.deleted) + sum(sys.getsizeof(d) for d in self.deleted)
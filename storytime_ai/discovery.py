@@ -0,0 +1,308 @@
+"""
+Story discovery
+===============
+
+Recursive discovery of the story files in directory trees.
+
+:class:`StoryDiscovery` walks a directory tree with :func:`os.scandir` and finds the markdown
+files of stories. Files and directories matching the ignore patterns are skipped, without
+descending into ignored directories, e.g. the directories of version control and virtual
+environments. The depth of the walk can be limited with `max_depth`. The discovered files
+with their modification times, and the listing of each directory, are kept in an index,
+which can be saved to a JSON file.
+
+A rescan is incremental: directories, whose modification time did not change, are not listed
+again, only their known files are checked with a stat. The result of a scan are the
+:class:`Changes` since the previous scan. With :meth:`StoryDiscovery.watch` a background
+thread rescans the tree periodically and reports the changes to a callback.
+
+.. code-block:: python
+
+    from storytime_ai.discovery import StoryDiscovery
+    discovery = StoryDiscovery("stories", indexfile="log/storyindex.json")
+    discovery.scan()
+    for path in discovery.paths():
+        print(path)
+    watcher = discovery.watch(print, interval=2.0)
+
+"""
+import fnmatch
+import json
+import logging
+import os
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+
+log = logging.getLogger("st." + __name__)
+
+DEFAULT_IGNORE = [".*", "README.md", "__pycache__", "node_modules", "venv", "site-packages"]
+"""Hidden files and directories like .git and .venv, READMEs and directories of tools"""
+
+INDEX_VERSION = 2
+
+
+@dataclass
+class Changes:
+    """
+    The changes of the story files since the previous scan.
+
+    Attributes
+    ----------
+    added : list[str]
+        New files
+    modified : list[str]
+        Files with a changed modification time or size
+    removed : list[str]
+        Files, which do not exist anymore or are ignored now
+    """
+
+    added: list[str] = field(default_factory=list)
+    modified: list[str] = field(default_factory=list)
+    removed: list[str] = field(default_factory=list)
+
+    def __bool__(self):
+        return len(self.added) + len(self.modified) + len(self.removed) > 0
+
+
+class StoryDiscovery:
+    """
+    Finds the story files in a directory tree and keeps an index of them.
+
+    Parameters
+    ----------
+    root : str or Path
+        The root directory
+    ignore : Iterable[str], optional
+        Patterns of files and directories to skip, see :meth:`ignored`
+    suffix : str, optional
+        The suffix of the story files
+    indexfile : str or Path, optional
+        The JSON file of the persistent index, None to keep the index only in memory
+    max_depth : int, optional
+        The maximum depth of the directories below the root, 0 to search only the root,
+        None for no limit
+
+    Attributes
+    ----------
+    files : dict[str, tuple[int, int]]
+        The modification time in nanoseconds and the size of each discovered file
+    """
+
+    def __init__(
+        self,
+        root: str | Path,
+        ignore: Iterable[str] = DEFAULT_IGNORE,
+        suffix: str = ".md",
+        indexfile: Optional[str | Path] = None,
+        max_depth: Optional[int] = None,
+    ):
+        self.root = os.path.abspath(root)
+        self.ignore = list(ignore)
+        self.suffix = suffix
+        self.max_depth = max_depth
+        self.indexfile = Path(indexfile) if indexfile is not None else None
+        self.files: dict[str, tuple[int, int]] = {}
+        # directory -> (mtime_ns, subdirectories, files)
+        self._dirs: dict[str, tuple[int, list[str], list[str]]] = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def __len__(self):
+        return len(self.files)
+
+    def ignored(self, path: str) -> bool:
+        """Check if a file or directory matches one of the ignore patterns.
+
+        Patterns without a slash are matched against the name, patterns with a slash
+        against the path relative to the root, both with :mod:`fnmatch`.
+        """
+        name = os.path.basename(path)
+        relpath = None
+        for pattern in self.ignore:
+            if "/" in pattern:
+                if relpath is None:
+                    relpath = os.path.relpath(path, self.root).replace(os.sep, "/")
+                if fnmatch.fnmatchcase(relpath, pattern.strip("/")):
+                    return True
+            elif fnmatch.fnmatchcase(name, pattern):
+                return True
+        return False
+
+    def _list(self, directory: str) -> tuple[list[str], list[str]]:
+        subdirs = []
+        files = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if self.ignored(entry.path):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.name.endswith(self.suffix) and entry.is_file():
+                    files.append(entry.path)
+        return subdirs, files
+
+    def scan(self) -> Changes:
+        """Walk the directory tree and update the index.
+
+        Directories, which did not change since the previous scan, are not listed again.
+
+        Returns
+        -------
+        Changes
+            The added, modified and removed files since the previous scan
+        """
+        files: dict[str, tuple[int, int]] = {}
+        dirs: dict[str, tuple[int, list[str], list[str]]] = {}
+        stack = [(self.root, 0)]
+        while stack:
+            directory, depth = stack.pop()
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+                known = self._dirs.get(directory)
+                if known is not None and known[0] == mtime:
+                    subdirs, dirfiles = known[1], known[2]
+                else:
+                    subdirs, dirfiles = self._list(directory)
+            except OSError as e:
+                log.warning(f"Cannot list {directory}: {e!r}")
+                continue
+            dirs[directory] = (mtime, subdirs, dirfiles)
+            if self.max_depth is None or depth < self.max_depth:
+                stack.extend((subdir, depth + 1) for subdir in subdirs)
+            for path in dirfiles:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files[path] = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            changes = Changes(
+                added=sorted(p for p in files if p not in self.files),
+                modified=sorted(p for p, s in files.items() if p in self.files and self.files[p] != s),
+                removed=sorted(p for p in self.files if p not in files),
+            )
+            self.files = files
+            self._dirs = dirs
+        if changes:
+            self.save()
+        return changes
+
+    def paths(self) -> list[Path]:
+        """The discovered story files, sorted by path."""
+        with self._lock:
+            return [Path(p) for p in sorted(self.files)]
+
+    def load(self):
+        """Load the index from the index file, if it exists and matches the settings."""
+        if self.indexfile is None or not self.indexfile.is_file():
+            return
+        try:
+            index = json.loads(self.indexfile.read_text())
+            if (index["version"], index["root"], index["ignore"], index["suffix"], index["max_depth"]) != (
+                INDEX_VERSION,
+                self.root,
+                self.ignore,
+                self.suffix,
+                self.max_depth,
+            ):
+                return
+            self.files = {p: (s[0], s[1]) for p, s in index["files"].items()}
+            self._dirs = {d: (s[0], s[1], s[2]) for d, s in index["dirs"].items()}
+        except (ValueError, TypeError, KeyError, IndexError) as e:
+            log.warning(f"Ignore broken story index {self.indexfile}: {e}")
+
+    def save(self):
+        """Save the index to the index file."""
+        if self.indexfile is None:
+            return
+        with self._lock:
+            index = {
+                "version": INDEX_VERSION,
+                "root": self.root,
+                "ignore": self.ignore,
+                "suffix": self.suffix,
+                "max_depth": self.max_depth,
+                "files": self.files,
+                "dirs": self._dirs,
+            }
+            self.indexfile.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.indexfile.with_name(self.indexfile.name + ".tmp")
+            tmp.write_text(json.dumps(index, ensure_ascii=False))
+            os.replace(tmp, self.indexfile)
+
+    def watch(self, callback: Callable[[Changes], None], interval: float = 1.0) -> "StoryWatcher":
+        """Rescan the tree periodically in a background thread.
+
+        Parameters
+        ----------
+        callback : Callable[[Changes], None]
+            Called in the background thread with the changes of each rescan with changes
+        interval : float, optional
+            Seconds between the rescans
+
+        Returns
+        -------
+        StoryWatcher
+            The running thread, stop it with :meth:`StoryWatcher.stop`
+        """
+        watcher = StoryWatcher(self, callback, interval)
+        watcher.start()
+        return watcher
+
+
+class StoryWatcher(threading.Thread):
+    """Daemon thread, which rescans a :class:`StoryDiscovery` and reports the changes."""
+
+    def __init__(self, discovery: StoryDiscovery, callback: Callable[[Changes], None], interval: float = 1.0):
+        super().__init__(daemon=True, name="storytime-watcher")
+        self.discovery = discovery
+        self.callback = callback
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                changes = self.discovery.scan()
+                if changes:
+                    self.callback(changes)
+            except Exception as e:
+                log.warning(f"Rescan of {self.discovery.root} failed: {e!r}")
+
+    def stop(self):
+        """Stop the thread and wait for it."""
+        self._stop_event.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+
+def find_story_files(paths: Iterable[str | Path], ignore: Iterable[str] = DEFAULT_IGNORE) -> list[Path]:
+    """Find the story files in files and directories.
+
+    Directories are searched recursively, skipping the ignored files and directories.
+    Files are returned as given.
+
+    Parameters
+    ----------
+    paths : Iterable[str or Path]
+        Files and directories
+    ignore : Iterable[str], optional
+        Patterns of files and directories to skip in the directories
+
+    Returns
+    -------
+    list[Path]
+        The markdown files
+    """
+    files: list[Path] = []
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            discovery = StoryDiscovery(path, ignore=ignore)
+            discovery.scan()
+            files += [path / p.relative_to(discovery.root) for p in discovery.paths()]
+        else:
+            files.append(path)
+    return files
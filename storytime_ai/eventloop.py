@@ -0,0 +1,183 @@
+"""
+Event loop
+==========
+
+Long-lived asyncio event loop in a background thread.
+
+Synchronous code, like the callbacks of the Streamlit app, cannot await the generation of a
+dialog. Instead of a new event loop with :func:`asyncio.run` for each call, the coroutines are
+submitted to a :class:`BackgroundLoop`, which runs in a daemon thread for the lifetime of the
+process. Resources bound to the event loop, like the HTTP session of the
+:class:`~storytime_ai.backends.OpenAIBackend`, are opened once and reused, so the connections
+are kept alive between the requests.
+
+:meth:`BackgroundLoop.iterate` streams the items of an async iterator back to the calling thread.
+
+.. code-block:: python
+
+    from storytime_ai.eventloop import get_background_loop
+    loop = get_background_loop()
+    loop.run(Story.clients.open(Story.backend))
+    for current_result, delta in loop.iterate(story.continue_story(nextdialogid)):
+        print(delta, end="")
+
+"""
+import asyncio
+import concurrent.futures
+import logging
+import queue
+import threading
+from typing import AsyncIterable, Coroutine, Iterator, Optional, TypeVar
+
+log = logging.getLogger("st." + __name__)
+
+T = TypeVar("T")
+
+
+class _Done:
+    """End of the items of :meth:`BackgroundLoop.iterate`, with the error of the iterator, if any."""
+
+    __slots__ = ("error",)
+
+    def __init__(self, error: Optional[BaseException] = None):
+        self.error = error
+
+
+class BackgroundLoop:
+    """
+    Event loop, which runs forever in a daemon thread.
+
+    Parameters
+    ----------
+    name : str, optional
+        The name of the thread
+
+    Attributes
+    ----------
+    loop : asyncio.AbstractEventLoop
+        The event loop
+    """
+
+    def __init__(self, name: str = "storytime-loop"):
+        self.name = name
+        self.loop = asyncio.new_event_loop()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> "BackgroundLoop":
+        """Start the thread of the event loop, if it is not running yet."""
+        with self._lock:
+            if self.loop.is_closed():
+                raise RuntimeError(f"The event loop {self.name} was stopped")
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+        return self
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+            self.loop.close()
+
+    def submit(self, coro: Coroutine) -> concurrent.futures.Future:
+        """Run a coroutine in the event loop and return its future, which can be used from any thread."""
+        if not self.running:
+            coro.close()
+            raise RuntimeError(f"The event loop {self.name} is not running")
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro: Coroutine[object, object, T], timeout: Optional[float] = None) -> T:
+        """Run a coroutine in the event loop and wait for its result in the calling thread."""
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def iterate(self, iterable: AsyncIterable[T], timeout: Optional[float] = None) -> Iterator[T]:
+        """Iterate over an async iterator in the event loop and yield its items in the calling thread.
+
+        If the iteration in the calling thread is stopped early, the async iterator is cancelled
+        and closed. Errors of the async iterator are raised in the calling thread.
+
+        Parameters
+        ----------
+        iterable : AsyncIterable
+            The async iterator, e.g. of :meth:`Story.continue_story`
+        timeout : float, optional
+            The maximum seconds to wait for each item, None to wait forever
+
+        Yields
+        ------
+        object
+            The items of the async iterator
+        """
+        items: queue.SimpleQueue = queue.SimpleQueue()
+
+        async def consume():
+            iterator = aiter(iterable)
+            try:
+                async for item in iterator:
+                    items.put(item)
+            except BaseException as e:
+                items.put(_Done(e))
+                raise
+            else:
+                items.put(_Done())
+            finally:
+                aclose = getattr(iterator, "aclose", None)
+                if aclose is not None:
+                    await aclose()
+
+        future = self.submit(consume())
+        try:
+            while True:
+                try:
+                    item = items.get(timeout=timeout)
+                except queue.Empty:
+                    raise TimeoutError(f"No item within {timeout} seconds") from None
+                if isinstance(item, _Done):
+                    if item.error is not None:
+                        raise item.error
+                    return
+                yield item
+        finally:
+            if not future.done():
+                future.cancel()
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stop the event loop, cancel its tasks and wait for the thread. The loop cannot be started again."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            if not self.loop.is_closed():
+                self.loop.close()
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        thread.join(timeout)
+
+
+_background_loop: Optional[BackgroundLoop] = None
+_background_lock = threading.Lock()
+
+
+def get_background_loop() -> BackgroundLoop:
+    """The running background loop of this process, which is started on the first call."""
+    global _background_loop
+    with _background_lock:
+        if _background_loop is None or not _background_loop.running:
+            _background_loop = BackgroundLoop().start()
+            log.info("Started the background event loop")
+        return _background_loop
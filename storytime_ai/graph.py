@@ -0,0 +1,325 @@
+"""
+Story graph
+===========
+
+A lightweight adjacency index of the dialogs of a story.
+
+The nodes of the graph are the headings of the dialogs and the headings of choices,
+that point to dialogs which do not exist (yet). The edges are the choices and the
+NEXTDIALOG statements of the logic of each dialog.
+
+The index is updated incrementally, when dialogs are added, changed or removed,
+see :class:`storytime_ai.dialogstore.DialogStore`. Successors and predecessors are
+available in constant time. The weakly connected components are maintained with a
+union-find structure, which is only rebuilt when edges or nodes are removed.
+A :class:`LayeredStoryGraph` is the graph of a copy-on-write overlay: it shares the graph
+of the shared dialogs and only keeps the edges of the dialogs in the overlay.
+No networkx is needed, a networkx graph is only created on demand by
+:meth:`Story.create_graph`.
+"""
+from typing import Hashable, Iterable, Iterator, KeysView, Mapping
+
+
+class UnionFind:
+    """
+    Union-find (disjoint set) structure with path halving and union by size.
+
+    Attributes
+    ----------
+    count : int
+        The number of disjoint sets
+    """
+
+    def __init__(self, elements: Iterable[Hashable] = ()):
+        self._parent: dict = {}
+        self._size: dict = {}
+        self.count = 0
+        for element in elements:
+            self.add(element)
+
+    def __contains__(self, element):
+        return element in self._parent
+
+    def add(self, element: Hashable):
+        """Add an element as a new set, if it is not known yet."""
+        if element not in self._parent:
+            self._parent[element] = element
+            self._size[element] = 1
+            self.count += 1
+
+    def find(self, element: Hashable):
+        """Return the representative of the set of the element."""
+        parent = self._parent
+        while parent[element] != element:
+            parent[element] = parent[parent[element]]
+            element = parent[element]
+        return element
+
+    def union(self, a: Hashable, b: Hashable):
+        """Merge the sets of the elements a and b. Unknown elements are added."""
+        self.add(a)
+        self.add(b)
+        ra = self.find(a)
+        rb = self.find(b)
+        if ra == rb:
+            return
+        if self._size[ra] < self._size[rb]:
+            ra, rb = rb, ra
+        self._parent[rb] = ra
+        self._size[ra] += self._size[rb]
+        self.count -= 1
+
+    def groups(self) -> list[set]:
+        """Return the sets in the order of the first element of each set."""
+        groups: dict = {}
+        for element in self._parent:
+            groups.setdefault(self.find(element), set()).add(element)
+        return list(groups.values())
+
+
+class StoryGraph:
+    """
+    Directed graph of the dialogs of a story, updated incrementally.
+
+    Parameters
+    ----------
+    dialogs : Mapping[str, Dialog], optional
+        The dialogs to index
+    """
+
+    def __init__(self, dialogs: Mapping = {}):
+        self._successors: dict[str, dict[str, None]] = {}
+        self._predecessors: dict[str, dict[str, None]] = {}
+        self._dialogids: set[str] = set()
+        self._components = UnionFind()
+        self._dirty = False
+        for dialogid, dialog in dialogs.items():
+            self.set_dialog(dialogid, dialog)
+
+    def __contains__(self, node):
+        return node in self._successors
+
+    def __len__(self):
+        return len(self._successors)
+
+    @staticmethod
+    def targets(dialog) -> dict[str, None]:
+        """The headings a dialog leads to, by NEXTDIALOG statements and choices."""
+        targets = dict.fromkeys(dialog.compiled_logic.nextdialogids)
+        targets.update(dict.fromkeys(dialog.choices))
+        return targets
+
+    def _add_node(self, node: str):
+        if node not in self._successors:
+            self._successors[node] = {}
+            self._predecessors[node] = {}
+            if not self._dirty:
+                self._components.add(node)
+
+    def _drop_node_if_unused(self, node: str):
+        if node not in self._dialogids and len(self._predecessors[node]) == 0 and len(self._successors[node]) == 0:
+            del self._successors[node]
+            del self._predecessors[node]
+            self._dirty = True
+
+    def _add_edge(self, source: str, target: str):
+        self._add_node(target)
+        self._successors[source][target] = None
+        self._predecessors[target][source] = None
+        if not self._dirty:
+            self._components.union(source, target)
+
+    def _remove_edge(self, source: str, target: str):
+        del self._successors[source][target]
+        del self._predecessors[target][source]
+        self._dirty = True
+        self._drop_node_if_unused(target)
+
+    def set_dialog(self, dialogid: str, dialog):
+        """Add a dialog or update the edges of a changed dialog.
+
+        Parameters
+        ----------
+        dialogid : str
+            The heading of the dialog
+        dialog : Dialog
+            The dialog with its choices and logic
+        """
+        self._dialogids.add(dialogid)
+        self._add_node(dialogid)
+        new = self.targets(dialog)
+        old = self._successors[dialogid]
+        for target in [t for t in old if t not in new]:
+            self._remove_edge(dialogid, target)
+        for target in new:
+            if target not in old:
+                self._add_edge(dialogid, target)
+
+    def remove_dialog(self, dialogid: str):
+        """Remove a dialog and its outgoing edges.
+
+        The node stays in the graph, if choices of other dialogs still point to it.
+        """
+        if dialogid not in self._dialogids:
+            return
+        for target in list(self._successors[dialogid]):
+            self._remove_edge(dialogid, target)
+        self._dialogids.discard(dialogid)
+        self._drop_node_if_unused(dialogid)
+
+    def is_dialog(self, node: str) -> bool:
+        """True, if the node is a dialog and not only the target of a choice."""
+        return node in self._dialogids
+
+    def successors(self, node: str) -> KeysView[str]:
+        """The headings the node leads to."""
+        return self._successors[node].keys()
+
+    def predecessors(self, node: str) -> KeysView[str]:
+        """The headings that lead to the node."""
+        return self._predecessors[node].keys()
+
+    def nodes(self) -> KeysView[str]:
+        """All nodes: the dialogs and the targets of choices that do not exist."""
+        return self._successors.keys()
+
+    def edges(self) -> Iterator[tuple[str, str]]:
+        """All edges as tuples (source, target)."""
+        for source, targets in self._successors.items():
+            for target in targets:
+                yield source, target
+
+    def _update_components(self):
+        if self._dirty:
+            self._components = UnionFind(self._successors)
+            for source, target in self.edges():
+                self._components.union(source, target)
+            self._dirty = False
+
+    def number_of_components(self) -> int:
+        """The number of weakly connected components."""
+        self._update_components()
+        return self._components.count
+
+    def components(self) -> list[set[str]]:
+        """The weakly connected components as sets of nodes."""
+        self._update_components()
+        return self._components.groups()
+
+
+class LayeredStoryGraph:
+    """
+    Graph of a copy-on-write overlay of dialogs over the graph of the shared dialogs.
+
+    The shared graph is not changed and not copied. Only the outgoing edges of the dialogs,
+    which are added, replaced or removed in the overlay, are kept, so the memory is
+    proportional to the overlay. The edges of the shared graph, which start at such a dialog,
+    are hidden. Changes of the shared graph are seen immediately. The weakly connected
+    components are computed on demand.
+
+    Parameters
+    ----------
+    base : StoryGraph or LayeredStoryGraph
+        The graph of the shared dialogs
+    """
+
+    def __init__(self, base: "StoryGraph | LayeredStoryGraph"):
+        self.base = base
+        # outgoing edges of the dialogs of the overlay, removed dialogs have no edges
+        self._successors: dict[str, dict[str, None]] = {}
+        self._predecessors: dict[str, dict[str, None]] = {}
+        self._removed: set[str] = set()
+
+    targets = staticmethod(StoryGraph.targets)
+
+    def __contains__(self, node):
+        return self.is_dialog(node) or len(self._sources(node)) > 0
+
+    def __len__(self):
+        return sum(1 for _ in self.nodes())
+
+    def is_dialog(self, node: str) -> bool:
+        """True, if the node is a dialog and not only the target of a choice."""
+        if node in self._removed:
+            return False
+        return node in self._successors or self.base.is_dialog(node)
+
+    def _remove_edges(self, dialogid: str):
+        for target in self._successors.pop(dialogid, {}):
+            sources = self._predecessors[target]
+            del sources[dialogid]
+            if len(sources) == 0:
+                del self._predecessors[target]
+
+    def set_dialog(self, dialogid: str, dialog):
+        """Add a dialog or update the edges of a changed dialog of the overlay."""
+        self._remove_edges(dialogid)
+        self._removed.discard(dialogid)
+        self._successors[dialogid] = self.targets(dialog)
+        for target in self._successors[dialogid]:
+            self._predecessors.setdefault(target, {})[dialogid] = None
+
+    def remove_dialog(self, dialogid: str):
+        """Remove a dialog of the overlay or hide a dialog of the shared graph."""
+        self._remove_edges(dialogid)
+        if self.base.is_dialog(dialogid):
+            self._successors[dialogid] = {}
+            self._removed.add(dialogid)
+
+    def clear(self):
+        """Remove the changes of the overlay, e.g. after they were applied to the shared graph."""
+        self._successors.clear()
+        self._predecessors.clear()
+        self._removed.clear()
+
+    def _sources(self, node: str) -> dict[str, None]:
+        sources: dict[str, None] = {}
+        if node in self.base:
+            sources = {source: None for source in self.base.predecessors(node) if source not in self._successors}
+        sources.update(self._predecessors.get(node, {}))
+        return sources
+
+    def successors(self, node: str) -> KeysView[str]:
+        """The headings the node leads to."""
+        if node not in self:
+            raise KeyError(node)
+        if node in self._successors:
+            return self._successors[node].keys()
+        if node not in self.base:
+            return {}.keys()
+        return self.base.successors(node)
+
+    def predecessors(self, node: str) -> KeysView[str]:
+        """The headings that lead to the node."""
+        if node not in self:
+            raise KeyError(node)
+        return self._sources(node).keys()
+
+    def nodes(self) -> Iterator[str]:
+        """All nodes: the dialogs and the targets of choices that do not exist."""
+        for node in self.base.nodes():
+            if node in self:
+                yield node
+        for node in {**self._successors, **self._predecessors}:
+            if node not in self.base and node in self:
+                yield node
+
+    def edges(self) -> Iterator[tuple[str, str]]:
+        """All edges as tuples (source, target)."""
+        for source in self.nodes():
+            for target in self.successors(source):
+                yield source, target
+
+    def _components(self) -> UnionFind:
+        components = UnionFind(self.nodes())
+        for source, target in self.edges():
+            components.union(source, target)
+        return components
+
+    def number_of_components(self) -> int:
+        """The number of weakly connected components."""
+        return self._components().count
+
+    def components(self) -> list[set[str]]:
+        """The weakly connected components as sets of nodes."""
+        return self._components().groups()
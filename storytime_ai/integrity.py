@@ -0,0 +1,162 @@
+"""
+Integrity checks
+================
+
+Pure python integrity checks for stories, no networkx needed.
+
+All the checks are computed in a single pass over the dialogs with a union-find structure
+for the weakly connected components, followed by a breadth first search from the start dialog
+for the reachable dialogs. The result is an :class:`IntegrityReport`.
+
+.. code-block:: python
+
+    from storytime_ai import Story
+    story = Story.from_markdown_file("storytime_ai/templates/broken.md")
+    report = story.integrity_report()
+    print(report.ok, report.dangling_choices)
+
+"""
+from collections import deque
+from dataclasses import asdict, dataclass, field
+from typing import Mapping, Optional
+
+from .graph import UnionFind
+
+
+@dataclass
+class IntegrityReport:
+    """
+    The result of the integrity checks of a story.
+
+    The story is consistent (`ok`), if it has no multiple subgraphs and no dangling choices.
+    Unreachable dialogs, dead ends and errors in the logic are reported as warnings.
+
+    Attributes
+    ----------
+    title : str
+        The title of the story
+    startdialogid : str
+        The heading of the dialog, where the story starts
+    ndialogs : int
+        The number of dialogs
+    components : list[list[str]]
+        The weakly connected components, largest first
+    dangling_choices : list[tuple[str, str]]
+        Choices (dialogid, nextdialogid) pointing to dialogs that do not exist
+    dangling_nextdialogs : list[tuple[str, str]]
+        NEXTDIALOG statements (dialogid, nextdialogid) pointing to dialogs that do not exist
+    nextdialog_targets : dict[str, list[str]]
+        The targets of the NEXTDIALOG statements of each dialog with such statements
+    unreachable : list[str]
+        Dialogs that cannot be reached from the start dialog
+    dead_ends : list[str]
+        Dialogs without choices and without NEXTDIALOG statements
+    logic_errors : list[tuple[str, str]]
+        Statements (dialogid, error) of the logic, that can not be compiled
+    """
+
+    title: str = ""
+    startdialogid: str = ""
+    ndialogs: int = 0
+    components: list[list[str]] = field(default_factory=list)
+    dangling_choices: list[tuple[str, str]] = field(default_factory=list)
+    dangling_nextdialogs: list[tuple[str, str]] = field(default_factory=list)
+    nextdialog_targets: dict[str, list[str]] = field(default_factory=dict)
+    unreachable: list[str] = field(default_factory=list)
+    dead_ends: list[str] = field(default_factory=list)
+    logic_errors: list[tuple[str, str]] = field(default_factory=list)
+
+    @property
+    def has_subgraphs(self) -> bool:
+        return len(self.components) > 1
+
+    @property
+    def ok(self) -> bool:
+        return not self.has_subgraphs and len(self.dangling_choices) == 0
+
+    @property
+    def errors(self) -> list[str]:
+        """The reasons, why the integrity check failed."""
+        errors = []
+        if self.has_subgraphs:
+            errors.append("The story has multiple subgraphs")
+        for _, choiceid in self.dangling_choices:
+            errors.append(f"Impossible choice: {choiceid} does not exist")
+        return errors
+
+    @property
+    def warnings(self) -> list[str]:
+        """Findings, which do not break the story."""
+        warnings = []
+        for dialogid, nextdialogid in self.dangling_nextdialogs:
+            warnings.append(f"NEXTDIALOG in {dialogid}: {nextdialogid} does not exist")
+        for dialogid in self.unreachable:
+            warnings.append(f"Unreachable dialog: {dialogid}")
+        for dialogid, error in self.logic_errors:
+            warnings.append(f"Error in logic of {dialogid}: {error}")
+        return warnings
+
+    def to_dict(self) -> dict:
+        """The report as dictionary, which can be serialized to JSON."""
+        res = asdict(self)
+        res["ok"] = self.ok
+        return res
+
+
+def check_dialogs(dialogs: Mapping, startdialogid: Optional[str] = None, title: str = "") -> IntegrityReport:
+    """Check the integrity of dialogs in a single pass.
+
+    Parameters
+    ----------
+    dialogs : Mapping[str, Dialog]
+        The dialogs of the story
+    startdialogid : str, optional
+        The heading of the start dialog, by default the first dialog
+    title : str, optional
+        The title of the story, only used in the report
+
+    Returns
+    -------
+    IntegrityReport
+        The report with all findings
+    """
+    report = IntegrityReport(title=title, ndialogs=len(dialogs))
+    if len(dialogs) == 0:
+        return report
+    if startdialogid is None:
+        startdialogid = next(iter(dialogs))
+    report.startdialogid = startdialogid
+    components = UnionFind()
+    successors: dict[str, list[str]] = {}
+    for dialogid, dialog in dialogs.items():
+        components.add(dialogid)
+        nextdialogids = []
+        for statement in dialog.compiled_logic:
+            if statement.error is not None:
+                report.logic_errors.append((dialogid, statement.error))
+            if statement.keyword == "NEXTDIALOG" and statement.target != "":
+                nextdialogids.append(statement.target)
+                if statement.target not in dialogs:
+                    report.dangling_nextdialogs.append((dialogid, statement.target))
+        if len(nextdialogids) > 0:
+            report.nextdialog_targets[dialogid] = nextdialogids
+        for choiceid in dialog.choices:
+            if choiceid not in dialogs:
+                report.dangling_choices.append((dialogid, choiceid))
+        targets = nextdialogids + list(dialog.choices)
+        if len(targets) == 0:
+            report.dead_ends.append(dialogid)
+        for target in targets:
+            components.union(dialogid, target)
+        successors[dialogid] = targets
+    report.components = sorted([sorted(c) for c in components.groups()], key=len, reverse=True)
+    # breadth first search from the start dialog
+    reachable = {startdialogid}
+    queue = deque([startdialogid])
+    while queue:
+        for target in successors.get(queue.popleft(), []):
+            if target not in reachable:
+                reachable.add(target)
+                queue.append(target)
+    report.unreachable = [d for d in dialogs if d not in reachable]
+    return report
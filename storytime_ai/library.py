@@ -0,0 +1,168 @@
+"""
+Story library
+=============
+
+Fast scan of the metadata of story files without parsing them.
+
+Only the headings of a markdown file are needed for the story lists: the title ('# ')
+and the number of dialogs ('## '). :func:`scan_bytes` finds them with a single regular
+expression over the raw bytes, files are memory mapped by :func:`scan_file`, so no
+lines are split, decoded or parsed. The result is a lightweight :class:`StoryInfo`.
+:func:`scan_directory` scans all stories of a directory concurrently. The story is only
+parsed, when it is opened.
+
+.. code-block:: python
+
+    from storytime_ai import Story
+    from storytime_ai.library import scan_directory
+    info = Story.scan_metadata("storytime_ai/templates/story.md")
+    print(info.title, info.ndialogs)
+    for info in scan_directory("storytime_ai/templates"):
+        print(info.path, info.title, info.ndialogs)
+
+"""
+import logging
+import mmap
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Optional
+
+from .discovery import find_story_files
+
+log = logging.getLogger("st." + __name__)
+
+HEADING_PATTERN = re.compile(rb"^(##?) ([^\n]*)", re.MULTILINE)
+
+
+@dataclass(frozen=True)
+class StoryInfo:
+    """
+    Metadata of a story file.
+
+    Attributes
+    ----------
+    path : str
+        The path of the markdown file
+    title : str
+        The title of the story
+    ndialogs : int
+        The number of dialogs
+    size : int
+        The size of the file in bytes
+    mtime_ns : int
+        The modification time of the file in nanoseconds
+    """
+
+    path: str
+    title: str
+    ndialogs: int
+    size: int = 0
+    mtime_ns: int = 0
+
+
+def scan_bytes(data) -> tuple[str, int]:
+    """Find the title and the number of dialogs in the content of a markdown file.
+
+    The result is the same as the title and the number of dialogs of :meth:`Story.from_markdown`.
+
+    Parameters
+    ----------
+    data : bytes or mmap.mmap
+        The content of the markdown file
+
+    Returns
+    -------
+    title : str
+        The title of the story
+    ndialogs : int
+        The number of dialogs
+    """
+    title = ""
+    dialogids: set[str] = set()
+    lastid = ""
+    for x in HEADING_PATTERN.finditer(data):
+        text = x.group(2).decode("utf-8", errors="replace").strip()
+        if len(x.group(1)) == 1:
+            title = text
+        else:
+            # a heading without text continues the previous dialog, like in the parser
+            if text != "":
+                dialogids.add(text)
+            lastid = text
+    dialogids.add(lastid)
+    return title, len(dialogids)
+
+
+def scan_file(path: str | Path) -> StoryInfo:
+    """Scan the metadata of a story file, which is memory mapped.
+
+    Parameters
+    ----------
+    path : str or Path
+        The markdown file
+
+    Returns
+    -------
+    StoryInfo
+        The title and the number of dialogs
+    """
+    with open(path, "rb") as f:
+        stat = os.fstat(f.fileno())
+        if stat.st_size == 0:
+            title, ndialogs = scan_bytes(b"")
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                title, ndialogs = scan_bytes(data)
+    return StoryInfo(str(path), title, ndialogs, stat.st_size, stat.st_mtime_ns)
+
+
+def scan_files(paths: Iterable[str | Path], jobs: Optional[int] = None) -> list[StoryInfo]:
+    """Scan the metadata of many story files concurrently.
+
+    Files, which cannot be read, are skipped with a warning.
+
+    Parameters
+    ----------
+    paths : Iterable[str or Path]
+        The markdown files
+    jobs : int, optional
+        The number of threads, by default chosen by :class:`ThreadPoolExecutor`
+
+    Returns
+    -------
+    list[StoryInfo]
+        The metadata in the order of the files
+    """
+
+    def scan(path):
+        try:
+            return scan_file(path)
+        except OSError as e:
+            log.warning(f"Cannot scan story {path}: {e!r}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return [info for info in executor.map(scan, paths) if info is not None]
+
+
+def scan_directory(directory: str | Path, jobs: Optional[int] = None) -> list[StoryInfo]:
+    """Scan the metadata of all stories in a directory and its subdirectories.
+
+    Hidden files and directories and README.md are skipped, see :mod:`storytime_ai.discovery`.
+
+    Parameters
+    ----------
+    directory : str or Path
+        The directory
+    jobs : int, optional
+        The number of threads
+
+    Returns
+    -------
+    list[StoryInfo]
+        The metadata sorted by path
+    """
+    return scan_files(find_story_files([directory]), jobs=jobs)
@@ -0,0 +1,195 @@
+"""
+Logic
+=====
+
+Compiler for the LOGIC mini-language of the dialogs.
+
+Each line of the logic of a dialog is one statement:
+
+- ``PROPERTY "name" = expression`` sets the property "name" to the value of the expression.
+- ``NEXTDIALOG "heading" IF condition`` goes to the dialog "heading" if the condition is true.
+
+Quoted names of properties within expressions refer to the value of the property.
+The expressions are compiled once to python code objects. Property names are looked up
+in the properties dictionary, when the code is evaluated, so no string rewriting is needed.
+
+.. code-block:: python
+
+    from storytime_ai.logic import CompiledLogic
+    logic = CompiledLogic.compile('PROPERTY "Health Points" = "Health Points" - 10')
+    properties = {"Health Points": 100}
+    for statement in logic:
+        properties[statement.target] = statement.evaluate(properties)
+
+"""
+import ast
+import re
+from dataclasses import dataclass, field
+from types import CodeType
+from typing import Iterator, Optional
+
+PROPERTY_PATTERN = re.compile(r"PROPERTY [\"\'](.*)[\"\'] = (.*)")
+NEXTDIALOG_PATTERN = re.compile(r"NEXTDIALOG [\"\'](.*)[\"\'] IF (.*)")
+
+PROPERTIES_NAME = "__properties__"
+
+
+class LogicError(Exception):
+    """Error in a statement of the logic of a dialog."""
+
+
+class _PropertyLookup(ast.NodeTransformer):
+    """Replace every string constant "x" with `__properties__.get("x", "x")`.
+
+    So quoted strings are the value of the property with this name, if it exists
+    at the time of the evaluation, and the string itself otherwise.
+    """
+
+    def visit_JoinedStr(self, node):
+        # Do not touch the parts of f-strings
+        return node
+
+    def visit_Constant(self, node):
+        if not isinstance(node.value, str):
+            return node
+        call = ast.Call(
+            func=ast.Attribute(value=ast.Name(id=PROPERTIES_NAME, ctx=ast.Load()), attr="get", ctx=ast.Load()),
+            args=[ast.Constant(node.value), ast.Constant(node.value)],
+            keywords=[],
+        )
+        return ast.copy_location(call, node)
+
+
+def compile_expression(expression: str) -> CodeType:
+    """Compile an expression of the logic to a code object.
+
+    Parameters
+    ----------
+    expression : str
+        The python expression with quoted property names
+
+    Returns
+    -------
+    CodeType
+        The code object to be evaluated with the properties as `__properties__`
+
+    Raises
+    ------
+    SyntaxError
+        If the expression is not a valid python expression
+    """
+    tree = ast.parse(expression, filename="<string>", mode="eval")
+    tree = ast.fix_missing_locations(_PropertyLookup().visit(tree))
+    return compile(tree, "<string>", "eval")
+
+
+@dataclass
+class LogicStatement:
+    """
+    A single compiled statement of the logic.
+
+    Attributes
+    ----------
+    keyword : str
+        Either "PROPERTY" or "NEXTDIALOG"
+    target : str
+        The name of the property or the heading of the next dialog
+    source : str
+        The line of the logic, which was compiled
+    code : CodeType, optional
+        The compiled expression, None if the compilation failed
+    error : str, optional
+        The error message, if the compilation failed
+    """
+
+    keyword: str
+    target: str
+    source: str
+    code: Optional[CodeType] = None
+    error: Optional[str] = None
+
+    def evaluate(self, properties: dict):
+        """Evaluate the expression of the statement.
+
+        Parameters
+        ----------
+        properties : dict
+            The properties of the story
+
+        Returns
+        -------
+        Any
+            The value of the property or the condition of the next dialog
+
+        Raises
+        ------
+        LogicError
+            If the statement could not be compiled
+        """
+        if self.code is None:
+            raise LogicError(self.error)
+        return eval(self.code, {"__builtins__": None}, {PROPERTIES_NAME: properties})
+
+
+@dataclass
+class CompiledLogic:
+    """
+    The compiled logic of a dialog, a sequence of statements.
+
+    Attributes
+    ----------
+    statements : list[LogicStatement]
+        The statements in the order of the lines of the logic
+    """
+
+    statements: list[LogicStatement] = field(default_factory=list)
+
+    def __iter__(self) -> Iterator[LogicStatement]:
+        return iter(self.statements)
+
+    def __len__(self):
+        return len(self.statements)
+
+    @property
+    def nextdialogids(self) -> list[str]:
+        """The headings of all dialogs that can be reached by NEXTDIALOG statements."""
+        return [s.target for s in self.statements if s.keyword == "NEXTDIALOG" and s.target != ""]
+
+    @classmethod
+    def compile(cls, logic: str):
+        """Compile the logic of a dialog.
+
+        Lines that start neither with PROPERTY nor with NEXTDIALOG are ignored.
+        Errors are not raised, but stored in the statement and raised on evaluation.
+
+        Parameters
+        ----------
+        logic : str
+            The logic, one statement per line
+
+        Returns
+        -------
+        CompiledLogic
+            The compiled logic
+        """
+        statements = []
+        if len(logic) <= 1:
+            return cls(statements)
+        for line in logic.split("\n"):
+            if line.startswith("PROPERTY"):
+                keyword, pattern = "PROPERTY", PROPERTY_PATTERN
+            elif line.startswith("NEXTDIALOG"):
+                keyword, pattern = "NEXTDIALOG", NEXTDIALOG_PATTERN
+            else:
+                continue
+            x = pattern.search(line)
+            if x is None:
+                statements.append(LogicStatement(keyword, "", line, error=f"invalid {keyword} statement"))
+                continue
+            try:
+                code = compile_expression(x.group(2))
+            except Exception as e:
+                statements.append(LogicStatement(keyword, x.group(1), line, error=str(e)))
+            else:
+                statements.append(LogicStatement(keyword, x.group(1), line, code=code))
+        return cls(statements)
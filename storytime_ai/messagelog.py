@@ -1,18 +1,119 @@
+"""
+Message log
+===========
+
+Log of the messages sent to the language model, viewable as HTML page.
+
+Each entry is appended to the HTML file as a fragment, so the cost of logging does not
+grow with the length of the session. Only the last entries are kept in memory in a ring
+buffer of configurable size. A complete HTML page of these entries is rendered on demand
+with :func:`render_log` or :func:`write_log`.
+
+Logging does not block on disk: entries are put in a queue and a background thread renders
+and appends them to the file in batches. Call :func:`flush` to wait until all queued entries
+are written. This is done automatically at exit.
+
+The file does not grow without bound: it is truncated by the first write of each process,
+and if it exceeds `max_bytes`, it is moved to a backup with the suffix `.1`, e.g.
+`log/output.1.html`, and a new file is started.
+"""
+import atexit
 import copy
+import queue
+import threading
+from collections import deque
 from datetime import datetime
 from importlib.resources import files
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Deque, Dict, List, Optional, Set, Tuple
 
 from jinja2 import Environment, FileSystemLoader
 
-entry_storage: List[Dict] = []
-env = Environment(loader=FileSystemLoader("/"))
-template_file = Path(str(files("storytime_ai.templates").joinpath("messagelog.html")))
-template = env.get_template(str(template_file))
+entry_storage: Deque[Dict] = deque(maxlen=100)
+entry_count = 0
+entry_lock = threading.Lock()
+template_dir = Path(str(files("storytime_ai.templates").joinpath("")))
+env = Environment(loader=FileSystemLoader(str(template_dir)))
+template = env.get_template("messagelog.html")
+head_template = env.get_template("messagelog_head.html")
+entry_template = env.get_template("messagelog_entry.html")
 filename: Path = Path("log/output.html")
 
 
+class LogWriter:
+    """
+    Background thread, which appends queued log entries to their files in batches.
+
+    Parameters
+    ----------
+    batch_size : int, optional
+        The maximum number of entries written with one opening of the file
+    max_bytes : int, optional
+        The size of a file in bytes, after which it is moved to a backup, None for no limit
+    """
+
+    def __init__(self, batch_size: int = 50, max_bytes: Optional[int] = 10_000_000):
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self._queue: queue.Queue[Tuple[Path, Dict]] = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        # the files written by this process, they are truncated by the first write
+        self._written: Set[Path] = set()
+
+    def put(self, fname: Path, entry: Dict):
+        """Queue an entry to be appended to the file `fname`."""
+        self._start()
+        self._queue.put((fname, entry))
+
+    def flush(self):
+        """Block until all queued entries are written."""
+        self._queue.join()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="messagelog", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                print(f"messagelog: ERROR: cannot write log entries: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, batch: List[Tuple[Path, Dict]]):
+        # keep the order of the entries, but open each file only once per run of entries
+        i = 0
+        while i < len(batch):
+            fname = batch[i][0]
+            fname.parent.mkdir(parents=True, exist_ok=True)
+            mode = "a" if fname in self._written else "w"
+            if mode == "a" and self.max_bytes is not None and fname.exists() and fname.stat().st_size >= self.max_bytes:
+                fname.replace(fname.with_name(fname.stem + ".1" + fname.suffix))
+            self._written.add(fname)
+            with open(fname, mode) as f:
+                if f.tell() == 0:
+                    f.write(head_template.render())
+                while i < len(batch) and batch[i][0] == fname:
+                    f.write(entry_template.render(entry=batch[i][1]))
+                    i += 1
+
+
+writer = LogWriter()
+atexit.register(writer.flush)
+
+
 def add_to_log(log_items: Dict | List[Dict] = {}):
     if isinstance(log_items, Dict):
         add_one_to_log(log_items)
@@ -31,15 +132,47 @@ def add_one_to_log(log_item: Dict = {}, heading: Optional[str] = None):
     assert isinstance(log_item, Dict), "log_item must be of type Dict"
     if heading is not None:
         log_item[heading] = heading
-    if "heading" not in log_item:
-        log_item["heading"] = "query " + str(len(entry_storage)) + " " + datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    entry_storage.append(copy.deepcopy(log_item))
+    store_entry(copy.deepcopy(log_item))
+
+
+def store_entry(entry: Dict):
+    """Add an entry to the ring buffer and queue it to be appended to the log file.
+
+    The entry is not copied, so it must not be changed afterwards.
+    """
+    global entry_count
+    # entries are stored from the threads of the apps and of the background event loop
+    with entry_lock:
+        if "heading" not in entry:
+            entry["heading"] = "query " + str(entry_count) + " " + datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        entry_count += 1
+        entry_storage.append(entry)
+        writer.put(filename, entry)
+
 
+def flush():
+    """Wait until all queued entries are written to the log file."""
+    writer.flush()
 
-def write_log():
-    output = template.render(log_entries=entry_storage)
-    with open(filename, "w") as f:
-        f.write(output)
+
+def render_log() -> str:
+    """Render a complete HTML page with the entries in the ring buffer."""
+    return template.render(log_entries=entry_storage)
+
+
+def write_log(fname: Optional[Path] = None):
+    """Write the HTML page of the entries in the ring buffer to a file.
+
+    Parameters
+    ----------
+    fname : Path, optional
+        The file to write to. By default, the name of the log file with the suffix `_recent`.
+    """
+    if fname is None:
+        fname = filename.with_name(filename.stem + "_recent" + filename.suffix)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    with open(fname, "w") as f:
+        f.write(render_log())
 
 
 def set_filename(_filename: Path = Path("log/output.html")):
@@ -47,24 +180,29 @@ def set_filename(_filename: Path = Path("log/output.html")):
     filename = _filename
 
 
+def set_maxlen(maxlen: int = 100):
+    """Set the number of entries, which are kept in memory."""
+    global entry_storage
+    with entry_lock:
+        entry_storage = deque(entry_storage, maxlen=maxlen)
+
+
 def messagelog(msgs: List[Dict]):
-    mymsg = copy.deepcopy(msgs)
-    for x in mymsg:
+    mymsg = []
+    for x in msgs:
         # replace every line that starts with "-" with a "<p>" and end the line with "</p>"
         con = x.get("content")
         if not con:
+            mymsg.append(dict(x))
             continue
         con_lines = con.splitlines()
         new_con_lines = ["<p class='item'>" + line[1:] + "</p>" if line.startswith("-") else line for line in con_lines]
-        new_con = "\n".join(new_con_lines)
-        x["content"] = new_con
-    add_to_log(dict(content=mymsg))
-    write_log()
+        mymsg.append({**x, "content": "\n".join(new_con_lines)})
+    store_entry(dict(content=mymsg))
 
 
 def log(log_item: Dict | List[Dict] = {}):
     add_to_log(log_item)
-    write_log()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,393 @@
+"""
+Markdown parser
+===============
+
+Single pass parser for the markdown format of stories and dialogs.
+
+The parser consumes lines one by one from any iterable (a string, a file object,
+a generator, ...) and accumulates the text of each dialog in lists, which are joined
+only once per dialog. Both :meth:`Story.from_markdown` and :meth:`Dialog.from_markdown`
+use this parser.
+
+.. code-block:: python
+
+    from storytime_ai.parser import MarkdownParser
+    with open("storytime_ai/templates/story.md") as f:
+        parser = MarkdownParser()
+        dialogs = parser.parse(f)
+    print(parser.title, len(dialogs))
+
+The :class:`StreamingDialogParser` parses a dialog, while it is generated. It consumes the
+deltas of the stream and returns :class:`DialogEvent` objects, so a user interface can append
+only the new text and show each choice as soon as it is complete:
+
+.. code-block:: python
+
+    parser = StreamingDialogParser()
+    async for _, delta in story.continue_story(nextdialogid):
+        for event in parser.push(delta):
+            if event.kind == TEXT:
+                print(event.text, end="")
+            elif event.kind == CHOICE_COMPLETED:
+                print(event.choice.to_markdown())
+    dialog = parser.finish()
+
+"""
+import re
+from dataclasses import dataclass
+from typing import Iterable, Iterator, Optional
+
+from .choice import Choice
+from .dialog import Dialog
+
+CHOICE_PATTERN = re.compile(r"- (.+): (.+)")
+
+
+def iter_lines(markdown: str | Iterable[str]) -> Iterator[str]:
+    """Iterate over the lines of a markdown string or an iterable of lines.
+
+    Trailing newline characters are removed from each line.
+
+    Parameters
+    ----------
+    markdown : str or Iterable[str]
+        A markdown string or an iterable of lines, e.g. a file object or a generator
+
+    Yields
+    ------
+    str
+        A line without its trailing newline
+    """
+    if isinstance(markdown, str):
+        yield from markdown.split("\n")
+        return
+    for line in markdown:
+        if line.endswith("\n"):
+            yield line[:-1]
+        else:
+            yield line
+
+
+class MarkdownParser:
+    """
+    Streaming parser for the story markdown format.
+
+    Lines are passed to :meth:`feed` one at a time. Whenever a dialog is complete,
+    i.e. the next heading is found, the finished dialog is returned. The last dialog
+    is returned by :meth:`close`.
+
+    Attributes
+    ----------
+    title : str
+        The title of the story, given by the heading of level one ('# ')
+    secretsummary : str
+        The secret summary, given by the lines starting with 'SECRET '
+    dialogs : dict[str, Dialog]
+        The dialogs that were completed so far
+    """
+
+    def __init__(self, single_dialog: bool = False):
+        """
+        Parameters
+        ----------
+        single_dialog : bool, optional
+            If True, the markdown is parsed as a single dialog: only the last heading is used,
+            a title is ignored with a warning and lines starting with 'SECRET ' are dialog text.
+            If there is no heading at all, the first line is used as heading.
+        """
+        self.single_dialog = single_dialog
+        self.title = ""
+        self.secretsummary = ""
+        self.dialogs: dict = {}
+        self._secretlines: list[str] = []
+        self._dialogid = ""
+        self._text: list[str] = []
+        self._logic: list[str] = []
+        self._choices: dict[str, Choice] = {}
+        self._nextdialogid = ""
+        self._choicetext: list[str] = []
+        self._buffer = self._text
+        self._firstline = True
+        self._titlewarnings = 0
+
+    def _reset(self):
+        self._titlewarnings = 0
+        self._text = []
+        self._logic = []
+        self._choices = {}
+        self._nextdialogid = ""
+        self._buffer = self._text
+
+    def _add_choice(self):
+        choice = Choice("\n".join(self._choicetext), self._nextdialogid)
+        # the key is the interned id of the choice
+        self._choices[choice.nextdialogid] = choice
+
+    def _make_dialog(self):
+        text = "".join([line + "\n" for line in self._text])
+        return Dialog(self._dialogid, text, self._choices, "\n".join(self._logic))
+
+    def feed(self, line: str):
+        """Parse a single line.
+
+        Parameters
+        ----------
+        line : str
+            A line of markdown without trailing newline
+
+        Returns
+        -------
+        Dialog or None
+            The previous dialog, if it is completed by a new heading in this line
+        """
+        if self._firstline:
+            self._firstline = False
+            if self.single_dialog and not line.startswith("## "):
+                # Without any heading, the first line is the heading of the dialog
+                line = "## " + line
+        if line == "":
+            return None
+        # Dispatch on the first character, so plain text lines need only one comparison
+        first = line[0]
+        if first == "#" and line.startswith("# "):
+            if self.single_dialog:
+                self._titlewarnings += 1
+            else:
+                self.title = line[2:].strip()
+        elif first == "S" and not self.single_dialog and line.startswith("SECRET "):
+            self._secretlines.append(line[7:])
+        elif first == "#" and line.startswith("## "):
+            finished = None
+            if self.single_dialog:
+                # Use only the last heading as dialogid, everything before is discarded
+                self._reset()
+                self._dialogid = line[3:].strip()
+                return None
+            if len(self._nextdialogid) > 0:
+                # a new choice is found, so the previous one is added to the dictionary
+                self._add_choice()
+            if self._dialogid != "":
+                # a new dialog is found, so the previous one is completed
+                finished = self._make_dialog()
+                self.dialogs[finished.dialogid] = finished
+                self._reset()
+            self._dialogid = line[3:].strip()
+            return finished
+        elif first == "L" and line.startswith("LOGIC "):
+            self._logic.append(line[6:])
+        elif first == "-" and line.startswith("- "):
+            if self._nextdialogid != "":
+                # a new choice is found, so the previous one is added to the dictionary
+                self._add_choice()
+            x = CHOICE_PATTERN.match(line)
+            if x is not None:
+                self._nextdialogid = x.group(1).strip()
+                self._choicetext = [x.group(2).strip()]
+                # the following lines are in the choices section, if there is a choice
+                self._buffer = self._choicetext if self._nextdialogid else self._text
+        else:
+            # the line is in the dialog or in the choices section
+            self._buffer.append(line)
+        return None
+
+    def close(self):
+        """Finish parsing and return the last dialog.
+
+        Returns
+        -------
+        Dialog
+            The last dialog of the markdown
+        """
+        for _ in range(self._titlewarnings):
+            print("WARNING! Title given in markdown string. This is ignored.")
+        if len(self._nextdialogid) > 0:
+            self._add_choice()
+        self.secretsummary = "".join(self._secretlines)
+        last = self._make_dialog()
+        self.dialogs[last.dialogid] = last
+        return last
+
+    def parse(self, markdown: str | Iterable[str]) -> dict:
+        """Parse a complete markdown document in a single pass.
+
+        Parameters
+        ----------
+        markdown : str or Iterable[str]
+            A markdown string or an iterable of lines
+
+        Returns
+        -------
+        dict[str, Dialog]
+            The parsed dialogs with the heading of each dialogue as key
+        """
+        for line in iter_lines(markdown):
+            self.feed(line)
+        self.close()
+        return self.dialogs
+
+
+def parse_dialog(markdown: str | Iterable[str]):
+    """Parse markdown and return only the dialog of the last heading.
+
+    Parameters
+    ----------
+    markdown : str or Iterable[str]
+        A markdown string or an iterable of lines
+
+    Returns
+    -------
+    Dialog
+        The dialog of the last heading in the markdown
+    """
+    parser = MarkdownParser(single_dialog=True)
+    for line in iter_lines(markdown):
+        parser.feed(line)
+    return parser.close()
+
+
+HEADING = "heading"
+"""A heading was found, the dialog starts again, only the last heading of a dialog is used"""
+TEXT = "text"
+"""Text was appended to the dialog, possibly a part of a line"""
+LOGIC = "logic"
+"""A line of logic was found"""
+CHOICE_STARTED = "choice_started"
+"""The first line of a choice was found"""
+CHOICE_COMPLETED = "choice_completed"
+"""A choice is complete, because the next choice starts or the dialog is finished"""
+
+# Line prefixes with a meaning in a single dialog, lines which may start with them are held back
+_SPECIAL_PREFIXES = ("# ", "## ", "- ", "LOGIC ")
+
+
+@dataclass
+class DialogEvent:
+    """
+    A structural change of a dialog, which is parsed while it is streamed.
+
+    Attributes
+    ----------
+    kind : str
+        One of HEADING, TEXT, LOGIC, CHOICE_STARTED or CHOICE_COMPLETED
+    text : str
+        The heading, the new text or the logic line
+    choice : Choice, optional
+        The started or completed choice
+    """
+
+    kind: str
+    text: str = ""
+    choice: Optional[Choice] = None
+
+
+class StreamingDialogParser(MarkdownParser):
+    """
+    Incremental parser of a single dialog, which consumes the deltas of a stream.
+
+    Complete lines are parsed like :meth:`Dialog.from_markdown`, so :meth:`finish` returns the
+    same dialog as parsing the whole text. The text of a line is already returned while the
+    line is incomplete, as soon as it cannot be a heading, a choice or logic anymore.
+
+    Attributes
+    ----------
+    dialogid : str
+        The heading of the dialog so far
+    choices : dict[str, Choice]
+        The completed choices so far
+    """
+
+    def __init__(self):
+        super().__init__(single_dialog=True)
+        self._partial = ""
+        # characters of the incomplete line, which were returned as text
+        self._emitted = 0
+        self._events: list[DialogEvent] = []
+        self._finished: Optional[Dialog] = None
+
+    @property
+    def dialogid(self) -> str:
+        return self._dialogid
+
+    @property
+    def choices(self) -> dict[str, Choice]:
+        return self._choices
+
+    @property
+    def text(self) -> str:
+        """The text of the dialog so far, including the returned part of the incomplete line."""
+        return "".join([line + "\n" for line in self._text]) + self._partial[: self._emitted]
+
+    def _add_choice(self):
+        super()._add_choice()
+        self._events.append(DialogEvent(CHOICE_COMPLETED, choice=self._choices[self._nextdialogid]))
+
+    def _feed_line(self, line: str):
+        heading = self._firstline or line.startswith("## ")
+        ntext, nlogic, choicetext = len(self._text), len(self._logic), self._choicetext
+        self.feed(line)
+        if heading:
+            self._events.append(DialogEvent(HEADING, self._dialogid))
+        elif len(self._text) > ntext:
+            self._events.append(DialogEvent(TEXT, (line + "\n")[self._emitted :]))
+        elif len(self._logic) > nlogic:
+            self._events.append(DialogEvent(LOGIC, self._logic[-1]))
+        elif self._choicetext is not choicetext and self._nextdialogid != "":
+            choice = Choice(self._choicetext[0], self._nextdialogid)
+            self._events.append(DialogEvent(CHOICE_STARTED, choice=choice))
+        self._emitted = 0
+
+    def _incomplete_text(self) -> str:
+        """The new text of the incomplete line, if it is dialog text for sure."""
+        partial = self._partial
+        if self._firstline or self._buffer is not self._text or partial == "":
+            return ""
+        for prefix in _SPECIAL_PREFIXES:
+            if prefix.startswith(partial) or partial.startswith(prefix):
+                return ""
+        return partial[self._emitted :]
+
+    def push(self, delta: str) -> list[DialogEvent]:
+        """Parse the next delta of the stream.
+
+        Parameters
+        ----------
+        delta : str
+            The text, which was added to the dialog
+
+        Returns
+        -------
+        list[DialogEvent]
+            The changes of the dialog, in their order
+        """
+        lines = (self._partial + delta).split("\n")
+        self._partial = lines.pop()
+        for line in lines:
+            self._feed_line(line)
+        text = self._incomplete_text()
+        if text != "":
+            self._events.append(DialogEvent(TEXT, text))
+            self._emitted += len(text)
+        events, self._events = self._events, []
+        return events
+
+    def finish(self) -> Dialog:
+        """Parse the incomplete last line and return the dialog.
+
+        The events of the last line and of the last choice are returned by :meth:`pop_events`.
+
+        Returns
+        -------
+        Dialog
+            The same dialog as :meth:`Dialog.from_markdown` of the whole stream
+        """
+        if self._finished is None:
+            if self._partial != "" or self._firstline:
+                self._feed_line(self._partial)
+                self._partial = ""
+            self._finished = self.close()
+        return self._finished
+
+    def pop_events(self) -> list[DialogEvent]:
+        """Return and remove the events, which were not returned by :meth:`push` yet."""
+        events, self._events = self._events, []
+        return events
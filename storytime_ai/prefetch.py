@@ -0,0 +1,205 @@
+"""
+Prefetch
+========
+
+Speculative generation of the next dialogs, while the player is reading.
+
+When a dialog is displayed, the :class:`PrefetchScheduler` starts background generations
+for all of its choices, which lead to dialogs that do not exist yet. At most
+`max_concurrency` generations run at the same time. When the player chooses a branch,
+:meth:`Story.continue_story` attaches to the generation of this branch: it returns
+immediately if the generation is done or streams the rest of it, if it is still running.
+The generations of the other branches are cancelled.
+
+Prefetching is opt-in:
+
+.. code-block:: python
+
+    from storytime_ai import Story
+    story = Story.from_markdown_file("storytime_ai/templates/story.md")
+    story.enable_prefetch(max_concurrency=2)
+
+"""
+import asyncio
+import logging
+from typing import AsyncIterator, Optional
+
+import storytime_ai.messagelog as messagelog
+
+log = logging.getLogger("st." + __name__)
+
+
+class PendingDialog:
+    """
+    A dialog, which is generated in the background.
+
+    Any number of consumers can stream the generation with :meth:`stream`, even after
+    it is finished. Each consumer gets all deltas from the beginning.
+
+    Attributes
+    ----------
+    sourcedialogid : str
+        The heading of the dialog, from which the generation was started
+    nextdialogid : str
+        The heading of the generated dialog
+    messages : list[dict]
+        The messages sent to the model
+    deltas : list[str]
+        The strings received so far
+    finished : bool
+        True, if the generation is finished, failed or was cancelled
+    error : Exception, optional
+        The error, if the generation failed
+    """
+
+    def __init__(self, sourcedialogid: str, nextdialogid: str, messages: list[dict]):
+        self.sourcedialogid = sourcedialogid
+        self.nextdialogid = nextdialogid
+        self.messages = messages
+        self.deltas: list[str] = []
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.task: Optional[asyncio.Task] = None
+        self._condition = asyncio.Condition()
+
+    @property
+    def current_result(self) -> str:
+        return "".join(self.deltas)
+
+    async def add(self, delta: str):
+        """Add a delta and wake up the consumers."""
+        async with self._condition:
+            self.deltas.append(delta)
+            self._condition.notify_all()
+
+    async def finish(self, error: Optional[BaseException] = None):
+        """Mark the generation as finished and wake up the consumers."""
+        async with self._condition:
+            self.finished = True
+            self.error = error
+            self._condition.notify_all()
+
+    async def stream(self) -> AsyncIterator[tuple[str, str]]:
+        """Stream the generation from the beginning.
+
+        Yields
+        ------
+        current_result: str
+            The current result of the generated dialog
+        delta: str
+            The string that was just added
+
+        Raises
+        ------
+        Exception
+            The error of the generation, if it failed
+        """
+        current_result = ""
+        position = 0
+        while True:
+            async with self._condition:
+                await self._condition.wait_for(lambda: len(self.deltas) > position or self.finished)
+                new = self.deltas[position:]
+                finished = self.finished
+            for delta in new:
+                current_result += delta
+                yield current_result, delta
+            position += len(new)
+            if finished and position == len(self.deltas):
+                break
+        if self.error is not None:
+            raise self.error
+
+
+class PrefetchScheduler:
+    """
+    Starts background generations for the choices of the current dialog of a story.
+
+    Parameters
+    ----------
+    story : Story
+        The story to prefetch dialogs for
+    max_concurrency : int, optional
+        The maximum number of generations running at the same time
+
+    Attributes
+    ----------
+    pending : dict[str, PendingDialog]
+        The running and finished generations with the heading of the next dialog as key
+    """
+
+    def __init__(self, story, max_concurrency: int = 2):
+        self.story = story
+        self.max_concurrency = max_concurrency
+        self.pending: dict[str, PendingDialog] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def schedule(self):
+        """Start generations for the choices of the current dialog, which do not exist yet.
+
+        Generations of other dialogs are cancelled. Nothing is done without a running event loop.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        currentdialogid = self.story.currentdialog.dialogid
+        self.cancel(keep_source=currentdialogid)
+        for nextdialogid in self.story.currentdialog.choices:
+            if nextdialogid in self.story.dialogs or nextdialogid in self.pending:
+                continue
+            pending = PendingDialog(currentdialogid, nextdialogid, self.story.build_messages(nextdialogid))
+            pending.task = asyncio.create_task(self._generate(pending))
+            self.pending[nextdialogid] = pending
+
+    def take(self, nextdialogid: str) -> Optional[PendingDialog]:
+        """Take the generation of the chosen dialog and cancel all other generations.
+
+        Parameters
+        ----------
+        nextdialogid : str
+            The heading of the chosen dialog
+
+        Returns
+        -------
+        PendingDialog or None
+            The generation, if it was started from the current dialog
+        """
+        pending = self.pending.pop(nextdialogid, None)
+        if pending is not None and pending.sourcedialogid != self.story.currentdialog.dialogid:
+            self._cancel_one(pending)
+            pending = None
+        self.cancel()
+        return pending
+
+    def cancel(self, keep_source: Optional[str] = None):
+        """Cancel the generations, except those started from the dialog `keep_source`."""
+        for nextdialogid, pending in list(self.pending.items()):
+            if pending.sourcedialogid != keep_source:
+                self._cancel_one(pending)
+                del self.pending[nextdialogid]
+
+    @staticmethod
+    def _cancel_one(pending: PendingDialog):
+        if pending.task is not None and not pending.task.done():
+            log.debug(f"Cancel prefetch of {pending.nextdialogid}")
+            pending.task.cancel()
+
+    async def _generate(self, pending: PendingDialog):
+        assert self._semaphore is not None
+        try:
+            async with self._semaphore:
+                log.debug(f"Prefetch {pending.nextdialogid}")
+                messagelog.messagelog(pending.messages)
+                async for _, delta in self.story.stream_completion(pending.messages, model=self.story.model):
+                    await pending.add(delta)
+        except asyncio.CancelledError as e:
+            await pending.finish(e)
+            raise
+        except Exception as e:
+            log.warning(f"Prefetch of {pending.nextdialogid} failed: {e}")
+            await pending.finish(e)
+        else:
+            await pending.finish()
@@ -0,0 +1,358 @@
+"""
+Resilience
+==========
+
+Timeouts, retries and hedged requests for the streamed completions.
+
+The :class:`RetryPolicy` in the class attribute `Story.retry` wraps each request of
+:meth:`Story.stream_completion`:
+
+- If the first chunk does not arrive within `first_token_timeout` or the time between two
+  chunks exceeds `chunk_timeout`, the stream fails with :class:`StreamTimeout`, instead of
+  blocking the player.
+- A request, which fails with a transient error, see :data:`TRANSIENT_ERRORS`, before its first
+  chunk, is sent again after an exponential backoff, at most `max_retries` times. Once chunks
+  are passed on, a failure is raised, because a new request would not continue the same text.
+  A request, which timed out, is only sent again with `retry_timeouts`, because the slow
+  request may have been processed and paid for anyway.
+- With `hedge_after`, a second request is sent, if the first chunk did not arrive within
+  these seconds. The request, which streams first, is used, the other one is cancelled.
+
+The time to the first token and the duration of the streams are collected in
+:class:`LatencyStats` with percentiles for the tail latency.
+
+The policy is opt-in, by default `Story.retry` is None and the requests are streamed as they are.
+
+.. code-block:: python
+
+    from storytime_ai import Story
+    from storytime_ai.resilience import RetryPolicy
+    Story.retry = RetryPolicy(first_token_timeout=10, chunk_timeout=10, max_retries=2, hedge_after=3)
+    ...
+    print(Story.retry.metrics.ttft.percentiles())
+
+"""
+import asyncio
+import logging
+import math
+import random
+from collections import deque
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable, Iterable, Optional
+
+log = logging.getLogger("st." + __name__)
+
+
+class StreamTimeout(TimeoutError):
+    """A streamed completion did not send its first chunk or the next chunk in time."""
+
+
+TRANSIENT_ERRORS: tuple[type[BaseException], ...] = (ConnectionError, TimeoutError)
+"""The errors, after which a request is sent again"""
+
+try:
+    import openai.error
+except ImportError:
+    pass
+else:
+    TRANSIENT_ERRORS += (
+        openai.error.APIConnectionError,
+        openai.error.RateLimitError,
+        openai.error.ServiceUnavailableError,
+        openai.error.Timeout,
+        openai.error.TryAgain,
+    )
+
+
+class LatencyStats:
+    """
+    The latencies of the last streams.
+
+    Parameters
+    ----------
+    maxlen : int, optional
+        The number of latencies kept for the percentiles
+
+    Attributes
+    ----------
+    count : int
+        The number of all latencies added
+    """
+
+    def __init__(self, maxlen: int = 1000):
+        self.samples: deque[float] = deque(maxlen=maxlen)
+        self.count = 0
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def percentile(self, q: float) -> float:
+        """The nearest-rank percentile `q` between 0 and 100 in seconds, NaN if there are no latencies."""
+        if len(self.samples) == 0:
+            return math.nan
+        ordered = sorted(self.samples)
+        rank = math.ceil(q / 100 * len(ordered))
+        return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+    def percentiles(self, qs: Iterable[float] = (50, 90, 99)) -> dict[float, float]:
+        """The percentiles in seconds by `q`."""
+        return {q: self.percentile(q) for q in qs}
+
+    def __repr__(self):
+        values = ", ".join(f"p{q:g}={value * 1000:.0f} ms" for q, value in self.percentiles().items())
+        return f"LatencyStats(count={self.count}, {values})"
+
+
+@dataclass
+class ResilienceMetrics:
+    """
+    Metrics of a :class:`RetryPolicy`.
+
+    Attributes
+    ----------
+    streams : int
+        The number of streams
+    attempts : int
+        The number of requests sent, including retries and hedged requests
+    retries : int
+        The number of retries after a transient error or timeout
+    hedges : int
+        The number of hedged requests
+    hedge_wins : int
+        The number of hedged requests, which streamed first
+    timeouts : int
+        The number of timeouts of the first chunk or between two chunks
+    failures : int
+        The number of streams, which failed
+    ttft : LatencyStats
+        The time to the first token of the successful streams, including the failed attempts
+    duration : LatencyStats
+        The duration of the successful streams, including the failed attempts
+    """
+
+    streams: int = 0
+    attempts: int = 0
+    retries: int = 0
+    hedges: int = 0
+    hedge_wins: int = 0
+    timeouts: int = 0
+    failures: int = 0
+    ttft: LatencyStats = field(default_factory=LatencyStats)
+    duration: LatencyStats = field(default_factory=LatencyStats)
+
+
+async def _aclose(iterator: AsyncIterator):
+    aclose = getattr(iterator, "aclose", None)
+    if aclose is not None:
+        await aclose()
+
+
+class RetryPolicy:
+    """
+    Timeouts, retries and hedging of streamed completions.
+
+    Parameters
+    ----------
+    first_token_timeout : float, optional
+        The maximum seconds until the first chunk of a request, None to wait forever
+    chunk_timeout : float, optional
+        The maximum seconds between two chunks, None to wait forever
+    max_retries : int, optional
+        The maximum number of retries of a stream
+    backoff : float, optional
+        The delay before the first retry in seconds, it is doubled for each further retry
+    max_backoff : float, optional
+        The maximum delay before a retry in seconds
+    jitter : float, optional
+        The fraction of the delay, which is added at random, so the retries of many players spread out
+    hedge_after : float, optional
+        The seconds without a first chunk, after which a second request is sent, None for no hedging
+    retry_on : tuple[type[BaseException], ...], optional
+        The transient errors, after which a request is sent again
+    retry_timeouts : bool, optional
+        Whether a request is sent again after a :class:`StreamTimeout` of the first chunk
+
+    Attributes
+    ----------
+    metrics : ResilienceMetrics
+        The counts of the requests and the latencies
+    """
+
+    def __init__(
+        self,
+        first_token_timeout: Optional[float] = 30.0,
+        chunk_timeout: Optional[float] = 30.0,
+        max_retries: int = 2,
+        backoff: float = 0.5,
+        max_backoff: float = 8.0,
+        jitter: float = 0.1,
+        hedge_after: Optional[float] = None,
+        retry_on: tuple[type[BaseException], ...] = TRANSIENT_ERRORS,
+        retry_timeouts: bool = False,
+    ):
+        self.first_token_timeout = first_token_timeout
+        self.chunk_timeout = chunk_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.hedge_after = hedge_after
+        self.retry_on = retry_on
+        self.retry_timeouts = retry_timeouts
+        self.metrics = ResilienceMetrics()
+
+    def backoff_delay(self, retry: int) -> float:
+        """The delay before the retry with the index `retry` in seconds."""
+        delay = min(self.max_backoff, self.backoff * 2**retry)
+        return delay * (1 + self.jitter * random.random())
+
+    async def stream(self, request: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """Stream a completion with timeouts, retries and hedging.
+
+        Parameters
+        ----------
+        request : Callable[[], AsyncIterator[str]]
+            Sends a new request and returns its stream of deltas, it is called for each attempt
+
+        Yields
+        ------
+        str
+            The string that was just added to the completion
+
+        Raises
+        ------
+        StreamTimeout
+            If a chunk did not arrive in time and it is not sent again, see `retry_timeouts`
+        Exception
+            The error of the last attempt, if no retry is left or the error is not transient
+        """
+        loop = asyncio.get_running_loop()
+        self.metrics.streams += 1
+        begin = loop.time()
+        retry = 0
+        while True:
+            start = loop.time()
+            try:
+                iterator, first = await self._first_chunk(request, start)
+            except self.retry_on as e:
+                if retry >= self.max_retries or (isinstance(e, StreamTimeout) and not self.retry_timeouts):
+                    self.metrics.failures += 1
+                    raise
+                delay = self.backoff_delay(retry)
+                retry += 1
+                self.metrics.retries += 1
+                log.info(f"Request failed with {e!r}, retry {retry} of {self.max_retries} in {delay:.2f} s")
+                await asyncio.sleep(delay)
+                continue
+            except Exception:
+                self.metrics.failures += 1
+                raise
+            break
+
+        self.metrics.ttft.add(loop.time() - begin)
+        try:
+            if first is None:
+                return
+            yield first
+            while True:
+                # the chunks are awaited in the task of the consumer, like without the policy
+                timeout = asyncio.timeout(self.chunk_timeout)
+                try:
+                    async with timeout:
+                        delta = await anext(iterator)
+                except StopAsyncIteration:
+                    break
+                except TimeoutError:
+                    if not timeout.expired():
+                        raise
+                    self.metrics.timeouts += 1
+                    raise StreamTimeout(f"No chunk within {self.chunk_timeout} seconds") from None
+                yield delta
+        except Exception:
+            self.metrics.failures += 1
+            raise
+        finally:
+            await _aclose(iterator)
+        self.metrics.duration.add(loop.time() - begin)
+
+    async def _first_chunk_of_one(
+        self, request: Callable[[], AsyncIterator[str]]
+    ) -> tuple[AsyncIterator[str], Optional[str]]:
+        """Send the request and wait for the first chunk in the task of the consumer."""
+        self.metrics.attempts += 1
+        iterator = aiter(request())
+        timeout = asyncio.timeout(self.first_token_timeout)
+        try:
+            async with timeout:
+                return iterator, await anext(iterator)
+        except StopAsyncIteration:
+            return iterator, None
+        except TimeoutError:
+            await _aclose(iterator)
+            if not timeout.expired():
+                raise
+            self.metrics.timeouts += 1
+            raise StreamTimeout(f"No first chunk within {self.first_token_timeout} seconds") from None
+        except BaseException:
+            await _aclose(iterator)
+            raise
+
+    async def _first_chunk(
+        self, request: Callable[[], AsyncIterator[str]], start: float
+    ) -> tuple[AsyncIterator[str], Optional[str]]:
+        """Send the request, and the hedged request if it is late, and wait for the first chunk.
+
+        Returns the stream, which sent the first chunk, and the chunk, which is None for an empty stream.
+        """
+        if self.hedge_after is None:
+            return await self._first_chunk_of_one(request)
+        loop = asyncio.get_running_loop()
+        pending: dict[asyncio.Future, tuple[AsyncIterator[str], bool]] = {}
+
+        def send(hedged: bool):
+            self.metrics.attempts += 1
+            iterator = aiter(request())
+            pending[asyncio.ensure_future(anext(iterator))] = (iterator, hedged)
+
+        send(False)
+        hedged = False
+        error: Optional[BaseException] = None
+        try:
+            while True:
+                timeouts = []
+                if self.first_token_timeout is not None:
+                    timeouts.append(start + self.first_token_timeout - loop.time())
+                if self.hedge_after is not None and not hedged:
+                    timeouts.append(start + self.hedge_after - loop.time())
+                timeout = max(0.0, min(timeouts)) if len(timeouts) > 0 else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    iterator, is_hedge = pending.pop(future)
+                    try:
+                        first = future.result()
+                    except StopAsyncIteration:
+                        first = None
+                    except self.retry_on as e:
+                        error = e
+                        continue
+                    if is_hedge:
+                        self.metrics.hedge_wins += 1
+                    return iterator, first
+                if len(pending) == 0 and error is not None:
+                    raise error
+                elapsed = loop.time() - start
+                if self.first_token_timeout is not None and elapsed >= self.first_token_timeout:
+                    self.metrics.timeouts += 1
+                    raise StreamTimeout(f"No first chunk within {self.first_token_timeout} seconds")
+                if self.hedge_after is not None and not hedged and elapsed >= self.hedge_after:
+                    hedged = True
+                    self.metrics.hedges += 1
+                    log.debug(f"No first chunk after {elapsed:.2f} s, send a hedged request")
+                    send(True)
+        finally:
+            for future in pending:
+                future.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            for iterator, _ in pending.values():
+                await _aclose(iterator)
@@ -0,0 +1,219 @@
+"""
+Sessions
+========
+
+Many players of one story in a single process.
+
+A loaded :class:`Story` is the shared definition of the story: the dialogs, their choices
+and their compiled logic. A :class:`StorySession` is the small state of a single player:
+the current dialog, the history of visited dialogs, the properties and the message context.
+It has the same interface as a story for playing, e.g. :meth:`Story.next_dialog` and
+:meth:`Story.continue_story`, but shares the dialogs of the story instead of copying them.
+Dialogs generated or changed in one session are kept in a private copy-on-write overlay,
+see :class:`storytime_ai.dialogstore.LayeredDialogStore`. They can be published to all
+sessions with :meth:`Story.merge`.
+
+The :class:`SessionManager` hosts the sessions of a story in an asyncio application.
+Requests of the same session are processed one after the other, requests of different
+sessions run concurrently.
+
+.. code-block:: python
+
+    from storytime_ai import Story
+    from storytime_ai.session import SessionManager
+    manager = SessionManager(Story.from_markdown_file("storytime_ai/templates/story.md"))
+    session = manager.create()
+    async for current_result, delta in manager.choose(session.sessionid, "Weg nach links"):
+        print(delta, end="")
+
+"""
+import asyncio
+import logging
+import time
+import uuid
+from typing import AsyncIterator, Optional
+
+from .story import Story
+
+log = logging.getLogger("st." + __name__)
+
+
+class StorySession(Story):
+    """
+    The state of a single player of a shared story.
+
+    Parameters
+    ----------
+    story : Story
+        The shared story
+    sessionid : str, optional
+        The id of the session
+
+    Attributes
+    ----------
+    story : Story
+        The shared story
+    sessionid : str
+        The id of the session
+    last_active : float
+        The time of the last request as `time.monotonic`
+    """
+
+    def __init__(self, story: Story, sessionid: str = ""):
+        self.story = story
+        self.sessionid = sessionid
+        self.last_active = time.monotonic()
+        self.lock = asyncio.Lock()
+        super().__init__(story.dialogs.fork(), title=story.title, secretsummary=story.secretsummary)
+        self.markdown_file = story.markdown_file
+
+    def __repr__(self):
+        return f"StorySession({self.sessionid!r}, {self.title!r}, {self.currentdialog.dialogid!r})"
+
+
+class SessionManager:
+    """
+    Hosts the sessions of players of a shared story.
+
+    Parameters
+    ----------
+    story : Story
+        The shared story
+    max_sessions : int, optional
+        The maximum number of sessions, None for no limit
+    idle_timeout : float, optional
+        Seconds after the last request, when a session is removed by :meth:`expire`
+
+    Attributes
+    ----------
+    sessions : dict[str, StorySession]
+        The sessions with the session id as key
+    """
+
+    def __init__(self, story: Story, max_sessions: Optional[int] = None, idle_timeout: Optional[float] = None):
+        self.story = story
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions: dict[str, StorySession] = {}
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, sessionid: str):
+        return sessionid in self.sessions
+
+    def create(self, sessionid: Optional[str] = None) -> StorySession:
+        """Create a new session at the start of the story.
+
+        Parameters
+        ----------
+        sessionid : str, optional
+            The id of the session, by default a random id
+
+        Returns
+        -------
+        StorySession
+            The new session
+
+        Raises
+        ------
+        ValueError
+            If the session exists already
+        RuntimeError
+            If the maximum number of sessions is reached
+        """
+        if sessionid is None:
+            sessionid = uuid.uuid4().hex
+        if sessionid in self.sessions:
+            raise ValueError(f"Session {sessionid} exists already")
+        if self.max_sessions is not None and len(self.sessions) >= self.max_sessions:
+            self.expire()
+            if len(self.sessions) >= self.max_sessions:
+                raise RuntimeError(f"Maximum number of {self.max_sessions} sessions reached")
+        session = StorySession(self.story, sessionid)
+        self.sessions[sessionid] = session
+        return session
+
+    def get(self, sessionid: str) -> StorySession:
+        """Return the session with the id.
+
+        Raises
+        ------
+        KeyError
+            If the session does not exist
+        """
+        return self.sessions[sessionid]
+
+    def close(self, sessionid: str):
+        """Remove a session and cancel its background generations."""
+        session = self.sessions.pop(sessionid, None)
+        if session is not None and session.prefetch is not None:
+            session.prefetch.cancel()
+
+    def expire(self, now: Optional[float] = None) -> list[str]:
+        """Remove the sessions, which are idle for longer than `idle_timeout`.
+
+        Returns
+        -------
+        list[str]
+            The ids of the removed sessions
+        """
+        if self.idle_timeout is None:
+            return []
+        if now is None:
+            now = time.monotonic()
+        expired = [s.sessionid for s in self.sessions.values() if now - s.last_active > self.idle_timeout]
+        for sessionid in expired:
+            log.debug(f"Session {sessionid} expired")
+            self.close(sessionid)
+        return expired
+
+    async def choose(self, sessionid: str, nextdialogid: str, **kwargs) -> AsyncIterator[tuple[str, str]]:
+        """Choose the next dialog in a session, which is generated if it does not exist.
+
+        The generation runs in a task, which holds the lock of the session until it is finished.
+        Closing the generator cancels the generation. If the consumer just stops iterating,
+        e.g. after a disconnect, the generation is finished and the next request of the session
+        is not blocked.
+
+        Parameters
+        ----------
+        sessionid : str
+            The id of the session
+        nextdialogid : str
+            The heading of the next dialog
+        kwargs
+            Keyword arguments for :meth:`Story.continue_story`
+
+        Yields
+        ------
+        current_result: str
+            The current result of the next dialogue
+        delta: str
+            The string that was just added to the story
+        """
+        session = self.get(sessionid)
+        deltas: asyncio.Queue[Optional[tuple[str, str]]] = asyncio.Queue()
+
+        async def generate():
+            # the lock is held by this task, not by the generator, so it is released,
+            # even if the consumer stops iterating without closing the generator
+            try:
+                async with session.lock:
+                    session.last_active = time.monotonic()
+                    async for item in session.continue_story(nextdialogid, override_existing=False, **kwargs):
+                        deltas.put_nowait(item)
+                    session.last_active = time.monotonic()
+            finally:
+                deltas.put_nowait(None)
+
+        task = asyncio.create_task(generate())
+        try:
+            while (item := await deltas.get()) is not None:
+                yield item
+            # raise the error of the generation
+            await task
+        finally:
+            if not task.done():
+                task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
@@ -15,20 +15,29 @@ The Story class is responsible for handling the Story with logic
 """
 import asyncio
 import copy
-import json
+import hashlib
 import logging
-import os
-import re
 import sys
 from importlib.resources import files
 from pathlib import Path
-from typing import List, Optional
+from typing import IO, Iterable, Iterator, List, Mapping, Optional
 
 import storytime_ai.messagelog as messagelog
 
-from .choice import Choice
+from .backends import Backend, FakeBackend, OpenAIBackend, _openai  # noqa: F401
+from .cache import CompletionCache, cache_key, replay
+from .clients import ClientManager
+from .resilience import RetryPolicy
+from .choicetable import ChoiceTable
+from .context import ContextWindow
 from .dialog import Dialog
+from .dialogstore import DialogStore, LayeredDialogStore
+from .graph import LayeredStoryGraph, StoryGraph
+from .integrity import IntegrityReport, check_dialogs
+from .parser import MarkdownParser
+from .prefetch import PrefetchScheduler
 from .require_decorator import Requirement, requires
+from .utils import atomic_open
 
 log = logging.getLogger("st." + __name__)
 try:
@@ -47,27 +56,8 @@ except ImportError:
 else:
     _plot = True
 
-try:
-    import openai
-except ImportError:
-    log.info("No matplotlib support available")
-    _openai = False
-else:
-    _openai = True
-    from dotenv import load_dotenv
-
-    load_dotenv()
-    apikey = os.getenv("OPENAI_API_KEY")
-    if apikey is None:
-        log.warning("OPENAI_API_KEY not available, check .env")
-        _openai = False
-    openai.api_key = apikey
-    log.info(f"OpenAI API key {openai.api_key}")
-
-
 networkx_req = Requirement("networkx", _graph, "Network graph", raise_error=True)
 matplotlib_req = Requirement("matplotlib", _plot, "Plotting the graph", raise_error=True)
-openai_req = Requirement("openai", _openai, "OpenAI API", raise_error=True)
 
 
 class Story:
@@ -78,8 +68,10 @@ class Story:
     ----------
     title : str
         The title of the story
-    dialogs : dict[str, Dialog]
+    dialogs : DialogStore
         A dictionary of Dialog objects with the heading of each dialogue as key
+    graph : StoryGraph or LayeredStoryGraph
+        The graph of the dialogs, which is updated incrementally with the dialogs
     currentdialog : str
         Heading of the current dialog
     prevdialogids : list[str]
@@ -87,13 +79,31 @@ class Story:
     markdown_file : str
         Path to the markdown file where the story was loaded or saved
     messages : list[dict[str, str]]
-        ChatGPT message history, will be modified by the methods, not only appended
+        ChatGPT message history, the system prompt and the recent messages of the context
+    context : ContextWindow
+        The token budgeted message history with a summary of older dialogs, see :mod:`storytime_ai.context`
     properties : dict[str, str]
         A dictionary of properties that can be used in the logic of the story
     secretsummary: str
         A secret summary of the story, not shown in the dialogs
     G: networkx.Graph
-        A networkx graph of the story
+        A networkx graph of the story, only created by create_graph
+    prefetch: PrefetchScheduler
+        Background generation of the next dialogs, None unless enabled with enable_prefetch
+    model: str
+        Class attribute, the model used to continue the story
+    generate_model: str
+        Class attribute, the model used to generate a new story
+    cache: CompletionCache
+        Class attribute, optional cache for the completions, see :mod:`storytime_ai.cache`
+    backend: Backend
+        Class attribute, the language model used for the generation, see :mod:`storytime_ai.backends`
+    clients: ClientManager
+        Class attribute, the limits of the concurrency and the rate of the requests shared by all stories,
+        see :mod:`storytime_ai.clients`
+    retry: RetryPolicy
+        Class attribute, optional timeouts, retries and hedging of the requests, None by default,
+        see :mod:`storytime_ai.resilience`
 
     """
 
@@ -101,6 +111,18 @@ class Story:
 
     defaultprompt = "Eine Geschichte über ein Kind, dass im Wald verloren geht"
 
+    model = "gpt-3.5-turbo"
+
+    generate_model = "gpt-4"
+
+    cache: Optional[CompletionCache] = None
+
+    backend: Backend = OpenAIBackend()
+
+    clients: ClientManager = ClientManager()
+
+    retry: Optional[RetryPolicy] = None
+
     def __init__(self, dialogs: dict[str, Dialog], title: str = "Story", secretsummary: str = ""):
         """
         Parameters
@@ -114,27 +136,95 @@ class Story:
         self.title = title
         self.dialogs = dialogs
         self.secretsummary = secretsummary
-        self.currentdialog = self.dialogs[list(dialogs.keys())[0]]
-        self.prevdialogids = [list(dialogs.keys())[0]]
         self.markdown_file = "story.md"
-        self.messages: List[dict] = []
+        self.G = None
+        # the story, from which this story was copied with fork
+        self._forked_from: Optional["Story"] = None
+        self.prefetch: Optional[PrefetchScheduler] = None
+        self.restart()
+
+    def restart(self):
+        """
+        Start the story again at the first dialog without properties and message history.
+
+        The prefetched dialogs are cancelled and, if prefetching is enabled, the dialogs
+        of the first dialog are prefetched.
+        """
+        if self.prefetch is not None:
+            self.prefetch.cancel()
+        firstdialogid = next(iter(self.dialogs))
+        self.currentdialog = self.dialogs[firstdialogid]
+        self.prevdialogids = [firstdialogid]
+        self.context = ContextWindow()
         self.properties: dict = {}
         self.exec_logic()
-        self.G = None
+        if self.prefetch is not None:
+            self.prefetch.schedule()
+
+    @property
+    def dialogs(self) -> DialogStore:
+        return self._dialogs
+
+    @dialogs.setter
+    def dialogs(self, dialogs: Mapping[str, Dialog]):
+        self._dialogs = dialogs if isinstance(dialogs, DialogStore) else DialogStore(dialogs)
+
+    @property
+    def messages(self) -> List[dict]:
+        return self.context.messages
+
+    @messages.setter
+    def messages(self, messages: List[dict]):
+        self.context.clear()
+        for i, message in enumerate(messages):
+            if i == 0 and message["role"] == "system":
+                self.context.system = message
+            else:
+                self.context.add(message)
+
+    @property
+    def graph(self) -> StoryGraph | LayeredStoryGraph:
+        return self._dialogs.graph
 
     def __repr__(self):
         return self.to_markdown()
 
+    def _normalized_header(self) -> tuple:
+        return (
+            self.title.strip(),
+            tuple(f"SECRET {words}".strip() for words in self.secretsummary.split("\n") if words != ""),
+        )
+
+    def fingerprint(self) -> str:
+        """
+        Stable hash of the title, the secret summary and the dialogs of the story.
+
+        Equal stories have the same fingerprint, e.g. to find duplicates of generated stories.
+        The fingerprints of the dialogs are cached, see :meth:`Dialog.fingerprint` and
+        :meth:`DialogStore.fingerprint`.
+
+        Returns
+        -------
+        str
+            The BLAKE2b hash with 16 bytes in hex
+        """
+        header = repr(self._normalized_header()).encode("utf-8")
+        return hashlib.blake2b(header + self.dialogs.fingerprint().encode("ascii"), digest_size=16).hexdigest()
+
     def __eq__(self, other):
         """Equal operator for the Story object.
 
-        Empty lines are ignored and leading and trailing spaces are removed.
+        Empty lines are ignored and leading and trailing spaces are removed. The dialogs are
+        compared in their order by their cached fingerprints, see :meth:`Dialog.fingerprint`.
         """
-        a = self.to_markdown()
-        b = other.to_markdown()
-        a = os.linesep.join([s.strip() for s in a.splitlines() if s])
-        b = os.linesep.join([s.strip() for s in b.splitlines() if s])
-        return a == b
+        if not isinstance(other, Story):
+            return NotImplemented
+        if self._normalized_header() != other._normalized_header() or len(self.dialogs) != len(other.dialogs):
+            return False
+        return all(a == b for a, b in zip(self.dialogs.values(), other.dialogs.values()))
+
+    # a story is changed while it is played, use fingerprint() as key to find duplicates
+    __hash__ = None
 
     def next_dialog(self, nextdialogid: str):
         """
@@ -167,31 +257,18 @@ class Story:
         They are interpreted such that the properties are set and checked.
         PROPERTY "name" = "value" sets the property "name" to "value".
         NEXTDIALOG "heading" IF "condition" sets the next dialog to "heading" if "condition" is true.
+        The logic is compiled only once per dialog, see :class:`CompiledLogic`.
         """
-        if len(self.currentdialog.logic) <= 1:
-            return
-        # loop over lines of logic and interpret the keywords
-        for strl in self.currentdialog.logic.split("\n"):
-            if strl.startswith("PROPERTY"):
-                x = re.search(r"PROPERTY [\"\'](.*)[\"\'] = (.*)", strl)
-                try:
-                    res = x.group(2)
-                    for key in self.properties:
-                        res = re.sub(f"[\"']{key}[\"']", f"properties['{key}']", res)
-                    self.properties[x.group(1)] = eval(res, {"__builtins__": None}, {"properties": self.properties})
-                except Exception as e:
-                    print(f"Error {e} in logic {strl}")
-            elif strl.startswith("NEXTDIALOG"):
-                x = re.search(r"NEXTDIALOG [\"\'](.*)[\"\'] IF (.*)", strl)
-                try:
-                    cond = x.group(2)
-                    for key in self.properties:
-                        cond = re.sub(f"[\"']{key}[\"']", f"properties['{key}']", cond)
-                    if eval(cond, {"__builtins__": None}, {"properties": self.properties}):
-                        # self.currentdialog.choices = {x.group(1): Choice("Continue", x.group(1))}
-                        self.next_dialog(x.group(1))
-                except Exception as e:
-                    print(f"Error {e} in logic {strl}")
+        # the current dialog can change within the loop by a NEXTDIALOG statement
+        for statement in self.currentdialog.compiled_logic:
+            try:
+                value = statement.evaluate(self.properties)
+                if statement.keyword == "PROPERTY":
+                    self.properties[statement.target] = value
+                elif value:
+                    self.next_dialog(statement.target)
+            except Exception as e:
+                print(f"Error {e} in logic {statement.source}")
 
     async def simpleplay(self):
         """
@@ -242,7 +319,55 @@ class Story:
         nextdialogid : str
             The heading of the next dialog
         """
+        self.currentdialog = self.dialogs.writable(self.currentdialog.dialogid)
         self.currentdialog.addchoice(text, nextdialogid)
+        self.dialogs.changed(self.currentdialog.dialogid)
+
+    def fork(self) -> "Story":
+        """
+        Copy the story with a copy-on-write overlay over its dialogs.
+
+        The copy continues at the current dialog with copies of the history, the properties
+        and the message context. Generated and changed dialogs are kept in the overlay of the
+        copy, see :class:`storytime_ai.dialogstore.LayeredDialogStore`, until :meth:`merge`
+        is called. The memory of the copy is proportional to its changes.
+
+        Returns
+        -------
+        Story
+            The copy of the story
+        """
+        res = copy.copy(self)
+        res.dialogs = self.dialogs.fork()
+        res.currentdialog = res.dialogs[self.currentdialog.dialogid]
+        res.prevdialogids = list(self.prevdialogids)
+        res.properties = dict(self.properties)
+        res.context = self.context.copy()
+        res.prefetch = None
+        res.G = None
+        res._forked_from = self
+        return res
+
+    def merge(self) -> list[str]:
+        """
+        Apply the generated and changed dialogs of a story created with :meth:`fork`
+        to the dialogs of the original story. The current dialogs of this story and of the
+        stories, from which it was forked, are updated to the merged dialogs.
+
+        Returns
+        -------
+        list[str]
+            The headings of the added, replaced and removed dialogs
+        """
+        if not isinstance(self.dialogs, LayeredDialogStore):
+            return []
+        changed = self.dialogs.merge()
+        story: Optional[Story] = self
+        while story is not None:
+            if story.currentdialog.dialogid in story.dialogs:
+                story.currentdialog = story.dialogs[story.currentdialog.dialogid]
+            story = story._forked_from
+        return changed
 
     def back_dialog(self):
         """
@@ -308,6 +433,9 @@ class Story:
         """
         Saves the story to a markdown file.
 
+        The story is streamed to a temporary file, which replaces the file when it is complete,
+        so the file is never left partially written.
+
         Parameters
         ----------
         fname : str, optional
@@ -317,8 +445,42 @@ class Story:
         """
         if fname is not None:
             self.markdown_file = fname
-        with open(Path(self.markdown_file), "w") as f:
-            f.write(self.to_markdown())
+        with atomic_open(Path(self.markdown_file), "w") as f:
+            self.write_markdown(f)
+
+    def _markdown_header(self) -> str:
+        res = f"# {self.title}\n\n"
+        for words in self.secretsummary.split("\n"):
+            res += f"SECRET {words}\n" if words != "" else ""
+        return res
+
+    def _markdown_fragments(self) -> Iterator[str]:
+        """The markdown of the story in parts, which are rendered dialog by dialog."""
+        dialogs = iter(self.dialogs.values())
+        previous = next(dialogs, None)
+        if previous is None:
+            yield self._markdown_header().rstrip()
+            return
+        yield self._markdown_header()
+        for dialog in dialogs:
+            yield previous.to_markdown()
+            yield "\n\n"
+            previous = dialog
+        yield previous.to_markdown().rstrip()
+
+    def write_markdown(self, f: IO[str]):
+        """
+        Writes the story as markdown to a file object, dialog by dialog.
+
+        The result is the same as :meth:`to_markdown`, but the story is not built as one string.
+
+        Parameters
+        ----------
+        f : IO[str]
+            A text file object, e.g. an open file or a StringIO
+        """
+        for fragment in self._markdown_fragments():
+            f.write(fragment)
 
     def to_markdown(self):
         """
@@ -329,84 +491,32 @@ class Story:
         str
             The story as a markdown string
         """
-        res = f"# {self.title}\n\n"
-        for words in self.secretsummary.split("\n"):
-            res += f"SECRET {words}\n" if words != "" else ""
-        res += "\n\n".join([self.dialogs[x].to_markdown() for x in self.dialogs])
-        res = res.strip()
-        return res
+        parts = [dialog.to_markdown() for dialog in self.dialogs.values()]
+        if len(parts) == 0:
+            return self._markdown_header().rstrip()
+        parts[-1] = parts[-1].rstrip()
+        return self._markdown_header() + "\n\n".join(parts)
 
     @classmethod
-    def from_markdown(cls, markdown: str):
+    def from_markdown(cls, markdown: str | Iterable[str]):
         """
         Parse a string with markdown and return an Story object.
         No integrity checks are performed with this method.
 
         Parameters
         ----------
-        markdown : str
-            The markdown string to parse
+        markdown : str or Iterable[str]
+            The markdown string to parse or an iterable of lines, e.g. a file object.
+            The lines are parsed in a single pass with the :class:`MarkdownParser`.
 
         Returns
         -------
         Story
             The story object
         """
-        lines = markdown.split("\n")
-        dialogs = {}
-        dialogid = ""
-        text = ""
-        choices = {}
-        choicetext = ""
-        nextdialogid = ""
-        title = ""
-        logic = ""
-        secretsummary = ""
-        for line in lines:
-            if line == "":
-                pass
-            elif line.startswith("# "):
-                title = line[2:].strip()
-            elif line.startswith("SECRET "):
-                secretsummary += line[7:]
-            elif line.startswith("## "):
-                if len(nextdialogid) > 0:
-                    # a new choice is found, so the previous one is added to the dictionary
-                    choices[nextdialogid] = Choice(choicetext, nextdialogid)
-                if dialogid != "":
-                    # a new dialog is found, so the previous one is added to the dictionary
-                    if len(logic) > 0 and logic[-1] == "\n":
-                        logic = logic[:-1]
-                    dialogs[dialogid] = Dialog(dialogid, text, choices, logic)
-                    text = ""
-                    logic = ""
-                    choices = {}
-                    nextdialogid = ""
-                dialogid = line[3:].strip()
-            elif line.startswith("LOGIC "):
-                logic += line[6:] + "\n"
-            elif line.startswith("- "):
-                if nextdialogid != "":
-                    # a new choice is found, so the previous one is added to the dictionary
-                    choices[nextdialogid] = Choice(choicetext, nextdialogid)
-                x = re.search(r"- (.+): (.+)", line)
-                if x is not None:
-                    # regular expression to find the next dialog id
-                    nextdialogid = x.group(1).strip()
-                    # regular expression to find the choice text
-                    choicetext = x.group(2).strip()
-            elif len(nextdialogid) > 0:
-                # the line is in the choices section
-                choicetext += "\n" + line
-            else:
-                # then line is in the dialog section
-                text += line + "\n"
-        if len(nextdialogid) > 0:
-            choices[nextdialogid] = Choice(choicetext, nextdialogid)
-        if len(logic) > 0 and logic[-1] == "\n":
-            logic = logic[:-1]
-        dialogs[dialogid] = Dialog(dialogid, text, choices, logic)
-        return cls(dialogs, title=title, secretsummary=secretsummary)
+        parser = MarkdownParser()
+        dialogs = parser.parse(markdown)
+        return cls(dialogs, title=parser.title, secretsummary=parser.secretsummary)
 
     @classmethod
     def from_markdown_file(cls, fname: Path | str):
@@ -430,31 +540,51 @@ class Story:
             print(f"from_markdown_file: ERROR: {fname} is not a file")
             raise FileExistsError
         with open(fname, "r") as f:
-            md = f.read()
-            res = cls.from_markdown(md)
+            res = cls.from_markdown(f)
             res.markdown_file = str(fname)
             return res
 
+    @staticmethod
+    def scan_metadata(fname: Path | str):
+        """
+        Read the title and the number of dialogs of a markdown file without parsing it.
+
+        Parameters
+        ----------
+        fname : Path or str
+            The filename of the markdown file
+
+        Returns
+        -------
+        StoryInfo
+            The title and the number of dialogs, see :func:`storytime_ai.library.scan_file`
+        """
+        from .library import scan_file
+
+        return scan_file(fname)
+
+    def choice_table(self) -> ChoiceTable:
+        """
+        Snapshot of the choices of all dialogs in a compact struct-of-arrays table.
+
+        Returns
+        -------
+        ChoiceTable
+            The choices in flat arrays, see :mod:`storytime_ai.choicetable`
+        """
+        return ChoiceTable.from_dialogs(self.dialogs)
+
     @requires(networkx_req)
     def create_graph(self):
         """
-        Create a networkx graph of the story
+        Create a networkx graph of the story from the incrementally updated :attr:`graph`
 
         Parameters
         ----------
         """
         self.G = nx.DiGraph()
-        for dialogid in self.dialogs:
-            self.G.add_node(dialogid)
-            # include logic choices
-            for line in self.dialogs[dialogid].logic.split("\n"):
-                if line.startswith("NEXTDIALOG"):
-                    x = re.search(r"NEXTDIALOG [\"\'](.*)[\"\'] IF", line)
-                    if x is not None:
-                        self.G.add_edge(dialogid, x.group(1))
-            # include normal choices
-            for choiceid in self.dialogs[dialogid].choices:
-                self.G.add_edge(dialogid, choiceid)
+        self.G.add_nodes_from(self.graph.nodes())
+        self.G.add_edges_from(self.graph.edges())
 
     @requires(matplotlib_req, networkx_req)
     def plot_graph(self, graphfname: Optional[str] = None):
@@ -474,30 +604,36 @@ class Story:
         else:
             plt.show()
 
-    @requires(networkx_req)
     def has_subgraphs(self):
         """
         Check if the story has multiple subgraphs, i.e. multiple stories that are not connected to
         each other by a dialog choice.
         """
-        self.create_graph()
         # check if there are subgraphs (i.e. multiple stories)
-        return nx.number_weakly_connected_components(self.G) > 1
+        return self.graph.number_of_components() > 1
+
+    def integrity_report(self) -> IntegrityReport:
+        """
+        Check the integrity of the story without printing.
+
+        Returns
+        -------
+        IntegrityReport
+            Components, dangling choices, unreachable dialogs, dead ends and NEXTDIALOG
+            targets of the story, see :func:`storytime_ai.integrity.check_dialogs`
+        """
+        return check_dialogs(self.dialogs, title=self.title)
 
     def check_integrity(self):
         """
         Check the integrity of the story. This method checks if the story has multiple
-        subgraphs and if all the choices are valid.
+        subgraphs and if all the choices are valid. The result is printed.
         """
-        if _graph and self.has_subgraphs():
-            print("Integrity check failed: The story has multiple subgraphs")
+        report = self.integrity_report()
+        for error in report.errors:
+            print("Integrity check failed: " + error)
+        if not report.ok:
             return False
-        # check if all the choices are valid
-        for dialogid in self.dialogs:
-            for choiceid in self.dialogs[dialogid].choices:
-                if choiceid not in self.dialogs:
-                    print("Integrity check failed: Impossible choice: " + choiceid + " does not exist")
-                    return False
         print("Integrity check passed")
         return True
 
@@ -512,38 +648,32 @@ class Story:
                     choices_to_remove.append((dialogid, choiceid))
         # Remove dangling choices outside the loop
         for dialogid, choiceid in choices_to_remove:
-            self.dialogs[dialogid].choices.pop(choiceid)
+            self.dialogs.writable(dialogid).removechoice(choiceid)
+            self.dialogs.changed(dialogid)
+        if self.currentdialog.dialogid in self.dialogs:
+            self.currentdialog = self.dialogs[self.currentdialog.dialogid]
         return [c[1] for c in choices_to_remove]
 
-    @requires(networkx_req)
     def restrict_to_largest_substory(self):
         """
         Restrict the story to the largest substory. This method removes all the dialogs and choices
         that are not in the largest substory.
         """
-        if _graph and not self.has_subgraphs():
+        if not self.has_subgraphs():
             return
-        self.create_graph()
         # find the largest subgraph
-        largest_subgraph = max(nx.weakly_connected_components(self.G), key=len)
+        largest_subgraph = max(self.graph.components(), key=len)
         # remove all the dialogs that are not in the largest subgraph
         dialogs_to_remove = [d for d in self.dialogs if d not in largest_subgraph]
         for d in dialogs_to_remove:
             self.dialogs.pop(d)
-        # remove all the choices that are not in the largest subgraph
-        choices_to_remove = []
-        for dialogid in self.dialogs:
-            for choiceid in self.dialogs[dialogid].choices:
-                if choiceid not in self.dialogs:
-                    choices_to_remove.append((dialogid, choiceid))
-        # Remove dangling choices outside the loop
-        for dialogid, choiceid in choices_to_remove:
-            self.dialogs[dialogid].choices.pop(choiceid)
+        self.prune_dangling_choices()
 
     @classmethod
     async def generate_story_from_file(cls, fname: str = "./storytime_ai/templates/story.md", sleep_time: float = 0.1):
         """
         Generate a story from a file for testing purposes without using OpenAI.
+        The file is streamed line by line with a :class:`FakeBackend`.
 
         Parameters
         ----------
@@ -559,16 +689,13 @@ class Story:
         delta: str
             The string that was just added to the story
         """
+        backend = FakeBackend(fname, token_rate=1 / sleep_time if sleep_time > 0 else None, split="lines")
         current_result = ""
-        with open(fname, "r") as f:
-            for line in f:
-                await asyncio.sleep(sleep_time)
-                delta = line
-                current_result += delta
-                yield current_result, delta
+        async for delta in backend.stream([]):
+            current_result += delta
+            yield current_result, delta
 
     @classmethod
-    @requires(openai_req)
     async def generate_story(cls, prompt: str = "", **kwargs):
         """
         Generate a story from a prompt.
@@ -587,10 +714,8 @@ class Story:
         """
         if len(prompt) == 0:
             prompt = cls.defaultprompt
-        completion = openai.ChatCompletion.acreate(
-            # model="gpt-3.5-turbo",
-            model="gpt-4",
-            # model="text-ada-001",
+        completion = cls.stream_completion(
+            model=cls.generate_model,
             messages=[
                 {
                     "role": "system",
@@ -603,84 +728,113 @@ class Story:
                 },
                 {"role": "user", "content": prompt},
             ],
-            stream=True,
             **kwargs,
         )
-        current_result = ""
-        async for chunk in await completion:
-            delta = chunk.get("choices", [{}])[0].get("delta", {}).get("content")
-            if delta is None:
-                delta = ""
-            current_result += delta
+        async for current_result, delta in completion:
             yield current_result, delta
 
-    @requires(openai_req)
-    async def continue_story(self, nextdialogid: str, override_existing: bool = True, **kwargs):
+    @classmethod
+    async def stream_completion(cls, messages: list[dict], model: str = "gpt-3.5-turbo", **kwargs):
         """
-        Continue the story with openai starting with the current dialogue and the next choice.
+        Stream a chat completion from the class attribute `backend` within the limits of the class attribute
+        `clients` and with the timeouts and retries of the class attribute `retry`. If the class attribute
+        `cache` is set, a cached completion for the same messages and parameters is replayed instead.
 
         Parameters
         ----------
-        nextdialogid: str
-            The heading of the next dialog
-        override_exists: bool
-            Whether to override the check if the dialog exists
+        messages: list[dict]
+            The messages to send to the model
+        model: str
+            The name of the model
         kwargs:
             Keyword arguments to pass to chatgpt
 
         Yields
         ------
         current_result: str
-            The current result of the next dialogue
+            The current result of the completion
         delta: str
-            The string that was just added to the story
+            The string that was just added to the completion
+        """
+        key = None
+        if cls.cache is not None:
+            key = cache_key(messages, model=model, **kwargs)
+            cached = cls.cache.get(key)
+            if cached is not None:
+                async for current_result, delta in replay(cached):
+                    yield current_result, delta
+                return
+        current_result = ""
+        if cls.retry is not None:
+            deltas = cls.retry.stream(lambda: cls.clients.stream(cls.backend, messages, model=model, **kwargs))
+        else:
+            deltas = cls.clients.stream(cls.backend, messages, model=model, **kwargs)
+        async for delta in deltas:
+            current_result += delta
+            yield current_result, delta
+        if key is not None:
+            cls.cache.set(key, current_result)
+
+    def enable_prefetch(self, max_concurrency: int = 2):
         """
-        if not override_existing and nextdialogid in self.dialogs:
-            self.next_dialog(nextdialogid)
-            return
+        Generate the dialogs of the choices of the current dialog in the background, while the
+        player is reading. See :class:`storytime_ai.prefetch.PrefetchScheduler`.
 
-        next_text = self.currentdialog.choices[nextdialogid].text
-        if next_text.strip() == nextdialogid.strip():
-            next_text = ""
-        if len(next_text) > 0:
-            next_text = ": " + next_text
+        Parameters
+        ----------
+        max_concurrency: int
+            The maximum number of generations running at the same time
+        """
+        self.prefetch = PrefetchScheduler(self, max_concurrency=max_concurrency)
 
+    def _prepare_context(self):
+        """Start the context with the system prompt and a summary of the history so far."""
+        if self.context.system is not None:
+            return
         storytemplate_without_logic = "\n".join([lw for lw in self.storytemplate.split("\n") if "LOGIC" not in lw])
-        if len(self.messages) == 0:
-            # If there are no messages, we need to start with a system message
-            self.messages = [
-                {
-                    "role": "system",
-                    "content": (
-                        """You are an author of a story for a text based role playing game. You 
+        self.context.system = {
+            "role": "system",
+            "content": (
+                """You are an author of a story for a text based role playing game. You 
                     use the structure of the following example to lead through the story. 
                     Each dialogue is identified with its heading. After the heading, the description
                     of the dialogue is given. After that, the choices are given.
                     Each choice starts with a hyphen and the heading of the dialogue to which 
                     the choice leads. After a colon, the description of the choice starts.\n\n```\n"""
-                        + storytemplate_without_logic
-                        + "\n```"
-                    ),
-                }
-            ]
-        # for dia in self.list_from_history():
-        #     self.messages.append(
-        #         {
-        #             "role": "system",
-        #             "content": f"{dia.to_markdown()}",
-        #         }
-        #     )
-        self.messages.append(
-            {
-                "role": "system",
-                "content": f"{self.currentdialog.to_markdown()}",
-            }
-        )
-        sendmessages = copy.deepcopy(self.messages)
-        if len(self.messages) > 5:
-            sendmessages = [sendmessages[0]] + sendmessages[-5:]
+                + storytemplate_without_logic
+                + "\n```"
+            ),
+        }
+        self.context.summarize_history(self.list_from_history()[:-1])
+
+    def build_messages(self, nextdialogid: str) -> list[dict]:
+        """
+        Build the messages for chatgpt to write the next dialog after the current dialog.
+        The messages are trimmed to the token budget of the :attr:`context`, older dialogs
+        are summarised. The messages in the context are not changed.
+
+        Parameters
+        ----------
+        nextdialogid: str
+            The heading of the next dialog, which must be a choice of the current dialog
+
+        Returns
+        -------
+        list[dict]
+            The messages to send
+        """
+        next_text = self.currentdialog.choices[nextdialogid].text
+        if next_text.strip() == nextdialogid.strip():
+            next_text = ""
+        if len(next_text) > 0:
+            next_text = ": " + next_text
+
+        self._prepare_context()
+        extra = []
+        if self.context.last_dialogid != self.currentdialog.dialogid:
+            extra.append({"role": "system", "content": f"{self.currentdialog.to_markdown()}"})
         if self.secretsummary != "":
-            sendmessages.append(
+            extra.append(
                 {
                     "role": "system",
                     "content": (
@@ -689,7 +843,7 @@ class Story:
                     ),
                 },
             )
-        sendmessages.append(
+        extra.append(
             {
                 "role": "user",
                 "content": (
@@ -700,22 +854,81 @@ class Story:
                 ),
             }
         )
+        return self.context.build(extra)
 
+    def _stream_next_dialog(self, nextdialogid: str, **kwargs):
+        """Send the request for the next dialog and return the stream of the completion."""
+        sendmessages = self.build_messages(nextdialogid)
+        # only queued, the message log is written in a background thread
         messagelog.messagelog(sendmessages)
-        log.info(json.dumps(sendmessages, indent=4))
+        log.debug(f"Sending {len(sendmessages)} messages, see message log {messagelog.filename}")
+        return self.stream_completion(sendmessages, model=self.model, **kwargs)
+
+    async def _stream_prefetched(self, pending):
+        """Stream a prefetched dialog. If its generation fails before the first delta, a new request is sent."""
+        streamed = False
+        try:
+            async for current_result, delta in pending.stream():
+                streamed = True
+                yield current_result, delta
+        except BaseException as e:
+            if streamed or e is not pending.error:
+                raise
+            log.debug(f"Prefetch of {pending.nextdialogid} failed, send a new request")
+            async for current_result, delta in self._stream_next_dialog(pending.nextdialogid):
+                yield current_result, delta
+
+    async def continue_story(self, nextdialogid: str, override_existing: bool = True, **kwargs):
+        """
+        Continue the story with the language model starting with the current dialogue and the next choice.
+
+        If prefetching is enabled with :meth:`enable_prefetch` and the next dialog is already
+        generated in the background, the result of this generation is used.
+
+        Parameters
+        ----------
+        nextdialogid: str
+            The heading of the next dialog
+        override_exists: bool
+            Whether to override the check if the dialog exists
+        kwargs:
+            Keyword arguments to pass to chatgpt
+
+        Yields
+        ------
+        current_result: str
+            The current result of the next dialogue
+        delta: str
+            The string that was just added to the story
+        """
+        if not override_existing and nextdialogid in self.dialogs:
+            if self.prefetch is not None:
+                self.prefetch.cancel()
+            self.next_dialog(nextdialogid)
+            if self.prefetch is not None:
+                self.prefetch.schedule()
+            return
+
+        pending = None
+        if self.prefetch is not None:
+            if len(kwargs) > 0:
+                # The prefetched dialogs were generated with other parameters
+                self.prefetch.cancel()
+            else:
+                pending = self.prefetch.take(nextdialogid)
+        if pending is not None and pending.error is not None:
+            log.debug(f"Prefetch of {nextdialogid} failed, send a new request")
+            pending = None
+        if pending is not None:
+            log.debug(f"Use prefetched dialog {nextdialogid}")
+            stream = self._stream_prefetched(pending)
+        else:
+            stream = self._stream_next_dialog(nextdialogid, **kwargs)
+        self._prepare_context()
+        self.context.add_dialog(self.currentdialog)
 
-        completion = openai.ChatCompletion.acreate(
-            model="gpt-3.5-turbo",
-            messages=sendmessages,
-            stream=True,
-            **kwargs,
-        )
         current_result = ""
-        async for chunk in await completion:
-            delta = chunk.get("choices", [{}])[0].get("delta", {}).get("content")
-            if delta is None:
-                delta = ""
-            current_result += delta
+        async for current_result, delta in stream:
             yield current_result, delta
 
         # TODO: check if the outcome is valid
@@ -724,6 +937,8 @@ class Story:
             generated_dialog.dialogid = nextdialogid
         self.dialogs[nextdialogid] = generated_dialog
         self.next_dialog(nextdialogid)
+        if self.prefetch is not None:
+            self.prefetch.schedule()
 
 
 def get_story():
@@ -746,10 +961,12 @@ def simpleplay():
 
 def checkintegrity():
     """
-    Check the integrity of a story from a file.
+    Check the integrity of stories from files and directories.
 
-    This method checks if the story has multiple subgraphs and if all the choices are valid.
-    This method is used to define a command line tool in the python package.
+    This method checks if the stories have multiple subgraphs and if all the choices are valid.
+    This method is used to define a command line tool in the python package,
+    see :func:`storytime_ai.checker.main` for the options.
     """
-    story = get_story()
-    story.check_integrity()
+    from .checker import main
+
+    main()
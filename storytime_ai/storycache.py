@@ -0,0 +1,325 @@
+"""
+Story cache
+===========
+
+Persistent cache of parsed stories for loading and listing story libraries.
+
+The metadata of a story is found by a scan of the headings, see :mod:`storytime_ai.library`.
+Each markdown file is parsed only once, when it is loaded. The parsed story is stored in a compact binary
+form (:mod:`marshal` of plain tuples), addressed by the SHA-256 hash of the content of the
+file, so identical files share one entry. The metadata of each file (title, number of
+dialogs, modification time, size and hash) is kept separately in a small JSON index.
+
+The index is checked by path, modification time and size without reading the file.
+If the file was only touched, the content hash is compared before parsing again.
+
+.. code-block:: python
+
+    from storytime_ai.storycache import StoryCache
+    cache = StoryCache("log/storycache")
+    for meta in cache.scan(["storytime_ai/templates/story.md"]):
+        print(meta.title, meta.ndialogs)
+    story = cache.load("storytime_ai/templates/story.md")
+
+"""
+import hashlib
+import io
+import json
+import logging
+import marshal
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+from .dialog import Dialog
+from .library import scan_bytes
+from .parser import MarkdownParser
+from .story import Story
+from .utils import atomic_open
+
+log = logging.getLogger("st." + __name__)
+
+FORMAT_VERSION = 1
+"""Version of the binary form, entries of other versions are parsed again"""
+
+
+@dataclass
+class StoryMetadata:
+    """
+    Summary of a story file, which is shown in the story lists.
+
+    Attributes
+    ----------
+    path : str
+        The resolved path of the markdown file
+    title : str
+        The title of the story
+    ndialogs : int
+        The number of dialogs
+    mtime_ns : int
+        The modification time of the file in nanoseconds
+    size : int
+        The size of the file in bytes
+    digest : str
+        The SHA-256 hash of the content of the file
+    """
+
+    path: str
+    title: str
+    ndialogs: int
+    mtime_ns: int
+    size: int
+    digest: str
+
+
+def story_to_bytes(title: str, secretsummary: str, dialogs: Iterable[Dialog]) -> bytes:
+    """Serialize a parsed story to the compact binary form."""
+    data = (
+        FORMAT_VERSION,
+        title,
+        secretsummary,
+        [(d.dialogid, d.text, d.logic, [(c.nextdialogid, c.text) for c in d.choices.values()]) for d in dialogs],
+    )
+    return marshal.dumps(data)
+
+
+def story_from_bytes(data: bytes) -> Optional[Story]:
+    """Deserialize a story from the compact binary form, None for an unknown version."""
+    version, title, secretsummary, dialogdata = marshal.loads(data)
+    if version != FORMAT_VERSION:
+        return None
+    dialogs = {}
+    for dialogid, text, logic, choices in dialogdata:
+        dialog = Dialog(dialogid, text, {}, logic)
+        for nextid, choicetext in choices:
+            dialog.addchoice(choicetext, nextid)
+        dialogs[dialog.dialogid] = dialog
+    return Story(dialogs, title=title, secretsummary=secretsummary)
+
+
+def _atomic_write(path: Path, data: bytes):
+    with atomic_open(path, "wb") as f:
+        f.write(data)
+
+
+class StoryCache:
+    """
+    Persistent cache of parsed stories and their metadata.
+
+    Parameters
+    ----------
+    directory : str or Path, optional
+        The directory of the cache with the index and the parsed stories
+
+    Attributes
+    ----------
+    hits : int
+        The number of requests served from the cache without reading the file
+    misses : int
+        The number of files, which were read and scanned or parsed
+    """
+
+    def __init__(self, directory: str | Path = "log/storycache"):
+        self.directory = Path(directory)
+        self.objects = self.directory / "objects"
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.indexfile = self.directory / "index.json"
+        self.hits = 0
+        self.misses = 0
+        self._index: dict[str, StoryMetadata] = {}
+        self._dirty = False
+        # the index is updated by the threads of iter_scan
+        self._lock = threading.RLock()
+        if self.indexfile.is_file():
+            try:
+                index = json.loads(self.indexfile.read_text())
+                if index.get("version") == FORMAT_VERSION:
+                    self._index = {p: StoryMetadata(**m) for p, m in index["files"].items()}
+            except (ValueError, TypeError, KeyError) as e:
+                log.warning(f"Ignore broken story cache index {self.indexfile}: {e}")
+
+    def __len__(self):
+        return len(self._index)
+
+    def _object(self, digest: str) -> Path:
+        return self.objects / f"{digest}.v{FORMAT_VERSION}.bin"
+
+    def _lookup(self, path: Path) -> tuple[str, os.stat_result, Optional[StoryMetadata]]:
+        """The key, the stat of the file and the metadata, if the entry is up to date."""
+        key = str(path.resolve())
+        stat = path.stat()
+        meta = self._index.get(key)
+        if meta is not None and (meta.mtime_ns != stat.st_mtime_ns or meta.size != stat.st_size):
+            meta = None
+        return key, stat, meta
+
+    def _update(self, path: Path, parse: bool = False) -> tuple[StoryMetadata, Optional[MarkdownParser]]:
+        """Read the file and update its metadata.
+
+        The story is parsed and stored, if `parse` is True and its content is not cached.
+        Otherwise only the headings are scanned. Returns the parser, if the story was parsed.
+        """
+        key, stat, _ = self._lookup(path)
+        content = path.read_bytes()
+        digest = hashlib.sha256(content).hexdigest()
+        old = self._index.get(key)
+        parser = None
+        if parse and not self._object(digest).is_file():
+            parser = MarkdownParser()
+            dialogs = parser.parse(io.StringIO(content.decode("utf-8"), newline=None))
+            title, ndialogs = parser.title, len(dialogs)
+            _atomic_write(self._object(digest), story_to_bytes(parser.title, parser.secretsummary, dialogs.values()))
+        elif old is not None and old.digest == digest:
+            # only touched
+            title, ndialogs = old.title, old.ndialogs
+        else:
+            title, ndialogs = scan_bytes(content)
+        meta = StoryMetadata(key, title, ndialogs, stat.st_mtime_ns, stat.st_size, digest)
+        with self._lock:
+            if parser is None and old is not None and old.digest == digest:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self._index[key] = meta
+            self._dirty = True
+        return meta, parser
+
+    def metadata(self, path: str | Path) -> StoryMetadata:
+        """Return the metadata of a story file, the file is only read if it changed.
+
+        Parameters
+        ----------
+        path : str or Path
+            The markdown file
+
+        Returns
+        -------
+        StoryMetadata
+            The title, number of dialogs and the key of the file
+        """
+        path = Path(path)
+        _, _, meta = self._lookup(path)
+        if meta is not None:
+            with self._lock:
+                self.hits += 1
+            return meta
+        meta, _ = self._update(path)
+        self.save()
+        return meta
+
+    def scan(self, paths: Iterable[str | Path], jobs: Optional[int] = None) -> list[StoryMetadata]:
+        """Return the metadata of many story files in their order and save the index once.
+
+        Files, which cannot be read, are skipped with a warning.
+        """
+        paths = [Path(p) for p in paths]
+        found = {meta.path: meta for meta in self.iter_scan(paths, jobs=jobs)}
+        res = []
+        for path in paths:
+            meta = found.get(str(path.resolve()))
+            if meta is not None:
+                res.append(meta)
+        return res
+
+    def iter_scan(self, paths: Iterable[str | Path], jobs: Optional[int] = None) -> Iterator[StoryMetadata]:
+        """Yield the metadata of many story files as soon as it is available.
+
+        The cached metadata is yielded first, the changed and new files are read by a pool of
+        threads. The index is saved, when the iteration is finished or closed. If the
+        iteration is closed early, the reads that did not start yet are cancelled.
+
+        Parameters
+        ----------
+        paths : Iterable[str or Path]
+            The markdown files
+        jobs : int, optional
+            The number of threads, by default chosen by :class:`ThreadPoolExecutor`
+
+        Yields
+        ------
+        StoryMetadata
+            The metadata of each file, which can be read
+        """
+        misses = []
+        executor = None
+        try:
+            for path in paths:
+                path = Path(path)
+                try:
+                    _, _, meta = self._lookup(path)
+                except OSError as e:
+                    log.warning(f"Cannot read story {path}: {e!r}")
+                    continue
+                if meta is None:
+                    misses.append(path)
+                    continue
+                with self._lock:
+                    self.hits += 1
+                yield meta
+            if len(misses) == 0:
+                return
+            executor = ThreadPoolExecutor(max_workers=jobs)
+            futures = {executor.submit(self._update, path): path for path in misses}
+            for future in as_completed(futures):
+                try:
+                    meta, _ = future.result()
+                except Exception as e:
+                    log.warning(f"Cannot read story {futures[future]}: {e!r}")
+                    continue
+                yield meta
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
+            self.save()
+
+    def load(self, path: str | Path) -> Story:
+        """Load a story from the cache or parse it, if it is not cached or changed.
+
+        Parameters
+        ----------
+        path : str or Path
+            The markdown file
+
+        Returns
+        -------
+        Story
+            The story, a new object for each call
+        """
+        path = Path(path)
+        _, _, meta = self._lookup(path)
+        if meta is not None and self._object(meta.digest).is_file():
+            with self._lock:
+                self.hits += 1
+            story = story_from_bytes(self._object(meta.digest).read_bytes())
+        else:
+            meta, parser = self._update(path, parse=True)
+            self.save()
+            if parser is not None:
+                story = Story(parser.dialogs, title=parser.title, secretsummary=parser.secretsummary)
+            else:
+                story = story_from_bytes(self._object(meta.digest).read_bytes())
+        if story is None:
+            raise ValueError(f"Cannot load {path} from the story cache")
+        story.markdown_file = str(path)
+        return story
+
+    def save(self):
+        """Write the index, if it was changed."""
+        with self._lock:
+            if not self._dirty:
+                return
+            index = {"version": FORMAT_VERSION, "files": {k: asdict(m) for k, m in self._index.items()}}
+            _atomic_write(self.indexfile, json.dumps(index, ensure_ascii=False).encode("utf-8"))
+            self._dirty = False
+
+    def clear(self):
+        """Remove all entries of the cache."""
+        for f in self.objects.glob("*.bin"):
+            f.unlink()
+        with self._lock:
+            self._index.clear()
+            self._dirty = True
+        self.save()
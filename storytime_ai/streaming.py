@@ -0,0 +1,176 @@
+"""
+Streaming
+=========
+
+Throttled updates of the user interfaces while a text is streamed.
+
+:meth:`Story.continue_story` and :meth:`Story.generate_story` yield a tuple `(current_result, delta)`
+for each chunk of the language model. Rendering each chunk saturates the user interface at high
+token rates. :class:`CoalescedStream` wraps such a generator and merges the deltas into frames:
+at most `max_fps` frames per second are yielded, or earlier, if `max_bytes` are pending. The
+wrapped generator is read in a background task, so the chunks, which arrive while a frame is
+rendered, are merged into the next frame. The tuples have the same form, the delta of a frame is
+the concatenation of the merged deltas, so the wrapper can replace the generator.
+
+The :class:`StreamMetrics` count the merged frames and the dropped intermediate states.
+
+.. code-block:: python
+
+    from storytime_ai.streaming import CoalescedStream
+    stream = CoalescedStream(story.continue_story(nextdialogid), max_fps=10)
+    async for current_result, delta in stream:
+        render(current_result)
+    print(stream.metrics)
+
+"""
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Optional
+
+log = logging.getLogger("st." + __name__)
+
+DEFAULT_FPS = 20.0
+"""Frames per second of the user interfaces"""
+
+
+@dataclass
+class StreamMetrics:
+    """
+    Metrics of a coalesced stream.
+
+    Attributes
+    ----------
+    deltas : int
+        The number of deltas of the wrapped stream
+    frames : int
+        The number of yielded frames
+    merged : int
+        The number of frames with more than one delta
+    dropped : int
+        The number of intermediate states, which were not yielded as frame of their own
+    max_deltas : int
+        The maximum number of deltas in one frame
+    nbytes : int
+        The number of bytes of all deltas in UTF-8
+    """
+
+    deltas: int = 0
+    frames: int = 0
+    merged: int = 0
+    dropped: int = 0
+    max_deltas: int = 0
+    nbytes: int = 0
+
+
+class CoalescedStream:
+    """
+    Async iterator, which merges the deltas of a stream of `(current_result, delta)` into frames.
+
+    Parameters
+    ----------
+    source : AsyncIterator[tuple[str, str]]
+        The stream, e.g. of :meth:`Story.continue_story`
+    max_fps : float, optional
+        The maximum number of frames per second, None for no limit
+    max_bytes : int, optional
+        A frame is yielded before its time, if the pending deltas have this number of bytes.
+        None for no threshold
+    clock : Callable[[], float], optional
+        The clock in seconds
+
+    Attributes
+    ----------
+    metrics : StreamMetrics
+        The counts of the deltas and frames
+    """
+
+    def __init__(
+        self,
+        source: AsyncIterator[tuple[str, str]],
+        max_fps: Optional[float] = DEFAULT_FPS,
+        max_bytes: Optional[int] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.source = source
+        self.interval = 1.0 / max_fps if max_fps else 0.0
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.metrics = StreamMetrics()
+        self._frames: Optional[AsyncIterator[tuple[str, str]]] = None
+
+    def __aiter__(self):
+        if self._frames is None:
+            self._frames = self._coalesce()
+        return self._frames
+
+    async def aclose(self):
+        """Stop the stream and the wrapped stream."""
+        if self._frames is not None:
+            await self._frames.aclose()
+
+    async def _coalesce(self):
+        pending: list[str] = []
+        state = {"current": "", "nbytes": 0, "done": False, "error": None}
+        available = asyncio.Event()
+        # set, when a frame must be yielded before its time
+        flush = asyncio.Event()
+
+        async def pump():
+            try:
+                async for current_result, delta in self.source:
+                    pending.append(delta)
+                    nbytes = len(delta.encode("utf-8"))
+                    state["current"] = current_result
+                    state["nbytes"] += nbytes
+                    self.metrics.deltas += 1
+                    self.metrics.nbytes += nbytes
+                    available.set()
+                    if self.max_bytes is not None and state["nbytes"] >= self.max_bytes:
+                        flush.set()
+            except Exception as e:
+                state["error"] = e
+            finally:
+                state["done"] = True
+                available.set()
+                flush.set()
+
+        task = asyncio.create_task(pump())
+        last = float("-inf")
+        try:
+            while True:
+                if len(pending) == 0 and not state["done"]:
+                    available.clear()
+                    await available.wait()
+                    continue
+                delay = last + self.interval - self.clock()
+                if len(pending) > 0 and delay > 0 and not flush.is_set():
+                    # wait for the time of the frame, unless the byte threshold or the end is reached
+                    try:
+                        await asyncio.wait_for(flush.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if len(pending) > 0:
+                    delta = "".join(pending)
+                    ndeltas = len(pending)
+                    pending.clear()
+                    state["nbytes"] = 0
+                    if not state["done"]:
+                        flush.clear()
+                    self.metrics.frames += 1
+                    self.metrics.dropped += ndeltas - 1
+                    self.metrics.merged += int(ndeltas > 1)
+                    self.metrics.max_deltas = max(self.metrics.max_deltas, ndeltas)
+                    last = self.clock()
+                    yield state["current"], delta
+                    continue
+                if state["error"] is not None:
+                    raise state["error"]
+                return
+        finally:
+            if not task.done():
+                task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            log.debug(f"Coalesced stream: {self.metrics}")
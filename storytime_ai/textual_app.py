@@ -1,6 +1,9 @@
 """A textual app for storytime_ai."""
+import os
 import re
 import sys
+import time
+from contextlib import closing
 from dataclasses import dataclass
 from importlib.resources import files
 from pathlib import Path
@@ -16,16 +19,23 @@ from textual.reactive import reactive
 from textual.screen import ModalScreen, Screen
 from textual.widgets import (Button, DataTable, DirectoryTree, Footer, Header,
                              Input, Label, ListItem, ListView, Markdown,
-                             RichLog, Static)
-from textual.worker import WorkerState
+                             ProgressBar, RichLog, Static)
+from textual.worker import WorkerState, get_current_worker
 
 from storytime_ai.choice import Choice
+from storytime_ai.discovery import StoryDiscovery
 from storytime_ai.mylog import get_log
+from storytime_ai.parser import CHOICE_COMPLETED, HEADING, TEXT, StreamingDialogParser
+from storytime_ai.resilience import RetryPolicy
 from storytime_ai.story import Story, _openai
-from storytime_ai.utils import getfilelist
+from storytime_ai.storycache import StoryCache
+from storytime_ai.streaming import CoalescedStream
 
 log = get_log("st")
 
+STORY_MAX_DEPTH = 4
+"""The depth of the directories below the story root, which are searched for stories"""
+
 
 class TextLogMessage(Message):
     """A message to write to the text log."""
@@ -57,13 +67,20 @@ class Choices(ListView):
     def watch_choices(self, choices):
         self.clear()
         print(choices)
-        for nextdialogid, content in choices.items():
-            self.append(
-                ListItem(
-                    Markdown(("**" + content.nextdialogid + "**: " + content.text).strip()),
-                    id="choice" + nextdialogid,
-                )
+        for content in choices.values():
+            self.add_choice(content)
+
+    def add_choice(self, content: Choice):
+        """Append a choice to the list, a choice with the same heading is replaced."""
+        for item in self.children:
+            if item.id == "choice" + content.nextdialogid:
+                item.remove()
+        self.append(
+            ListItem(
+                Markdown(("**" + content.nextdialogid + "**: " + content.text).strip()),
+                id="choice" + content.nextdialogid,
             )
+        )
 
     def watch_choicestr(self, choicestr):
         print(choicestr)
@@ -126,8 +143,28 @@ class StoryInterface(Screen):
 
     @work(exclusive=True)
     async def upd_text(self, nextdialogid: str) -> None:
-        async for currentresult, _ in self.app.story.continue_story(nextdialogid, override_existing=False):
-            self.query_one("#text").update(currentresult)
+        # The markdown is only rendered again, when a line is complete, and each
+        # choice is appended to the list, as soon as it is complete.
+        parser = StreamingDialogParser()
+        prompt = self.query_one("#text")
+        choices = self.query_one(Choices)
+        choices.clear()
+        stream = CoalescedStream(self.app.story.continue_story(nextdialogid, override_existing=False))
+        try:
+            async for _, delta in stream:
+                events = parser.push(delta)
+                if any(event.kind == HEADING for event in events):
+                    choices.clear()
+                for event in events:
+                    if event.kind == CHOICE_COMPLETED:
+                        choices.add_choice(event.choice)
+                if any(event.kind == HEADING or event.kind == TEXT and event.text.endswith("\n") for event in events):
+                    prompt.update("## " + parser.dialogid + "\n\n" + parser.text)
+        except Exception as e:
+            # the half-written dialog is not added to the story, the current dialog is shown again
+            self.post_message(TextLogMessage(f"Generation of {nextdialogid} failed: {e!r}"))
+        else:
+            self.post_message(TextLogMessage(f"Streamed {nextdialogid}: {stream.metrics}"))
         self.display_currentdialog()
 
     def on_mount(self) -> None:
@@ -175,7 +212,7 @@ class StoryInterface(Screen):
         """Load the story from a file."""
         if not fname.is_file():
             raise FileNotFoundError
-        self.app.story = Story.from_markdown_file(fname)
+        self.app.story = self.app.storycache.load(fname)
         self.post_message(TextLogMessage(f"Loaded Title: \n {self.app.story.title} from {fname}"))
         if not self.app.story.check_integrity() and not _openai:
             errors = self.app.story.prune_dangling_choices()
@@ -265,16 +302,21 @@ class ListStories(ListView):
         Binding("l", "select_cursor", "Select", show=False),
     ]
 
-    stories = reactive(
-        [
-            StoryItem(
-                title="The Story",
-                filename="story.md",
-                stats="0 dialogues",
-                fullpath=Path("story.md"),
-            )
-        ]
-    )
+    class StoriesFound(Message):
+        """Stories found by the worker, which loads the library."""
+
+        def __init__(self, items: list[StoryItem], done: int, total: int) -> None:
+            self.items = items
+            self.done = done
+            self.total = total
+            super().__init__()
+
+    stories = reactive([])
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.loaded = False
+        self.cancelled = False
 
     async def watch_stories(self, stories):
         await self.clear()
@@ -283,23 +325,58 @@ class ListStories(ListView):
             await self.append(listitem)
             listitem.contents = story
 
-    def on_mount(self) -> None:
-        storyfiles = getfilelist("./", "md", withpath=True)
-        stories = [
-            Story.from_markdown_file(fname=f)
-            for f in storyfiles
-            if (f.name if isinstance(f, Path) else f) != "README.md"
-        ]
-        storyitems = [
-            StoryItem(
-                title=s.title,
-                filename=Path(s.markdown_file).name,
-                stats=f"{len(s.dialogs)} dialogues",
-                fullpath=Path(s.markdown_file),
-            )
-            for s in stories
-        ]
-        self.stories = storyitems
+    async def on_mount(self) -> None:
+        await self.reload()
+
+    async def reload(self) -> None:
+        """Clear the list and load the library again in the background."""
+        await self.clear()
+        self.loaded = False
+        self.cancelled = False
+        self.load_library()
+
+    @work(thread=True, exclusive=True)
+    def load_library(self) -> None:
+        """Load the metadata of the stories in a thread and stream them into the list.
+
+        Only the metadata is read from the story cache by a pool of threads, the story
+        is loaded when it is selected. The worker stops, when it is cancelled.
+        """
+        worker = get_current_worker()
+        # incremental rescan of the directory tree with the persistent index
+        self.app.discovery.scan()
+        storyfiles = self.app.discovery.paths()
+        total = len(storyfiles)
+        self.post_message(self.StoriesFound([], 0, total))
+        batch: list[StoryItem] = []
+        done = 0
+        last = time.monotonic()
+        with closing(self.app.storycache.iter_scan(storyfiles)) as metadata:
+            for m in metadata:
+                if worker.is_cancelled:
+                    return
+                done += 1
+                batch.append(
+                    StoryItem(
+                        title=m.title,
+                        filename=Path(m.path).name,
+                        stats=f"{m.ndialogs} dialogues",
+                        fullpath=Path(m.path),
+                    )
+                )
+                if len(batch) >= 50 or time.monotonic() - last > 0.1:
+                    self.post_message(self.StoriesFound(batch, done, total))
+                    batch = []
+                    last = time.monotonic()
+        # files, which can not be read, are skipped
+        self.post_message(self.StoriesFound(batch, total, total))
+        self.loaded = True
+
+    async def on_list_stories_stories_found(self, message: StoriesFound) -> None:
+        for story in message.items:
+            listitem = StoryListItem()
+            await self.append(listitem)
+            listitem.contents = story
 
 
 class LoadScreen(ModalScreen):
@@ -313,6 +390,7 @@ class LoadScreen(ModalScreen):
         yield Header()
         yield Vertical(
             Label("Load story", classes="titlelabel"),
+            ProgressBar(id="libraryprogress", show_eta=False),
             ListStories(id="storylist"),
             FilteredDirectoryTree("./", id="directorytree"),
             Button("Pick file from directory", id="pickfile"),
@@ -327,6 +405,23 @@ class LoadScreen(ModalScreen):
         self.set_focus(self.query_one("#storylist"))
         self.query_one("#directorytree").styles.display = "none"
 
+    def on_list_stories_stories_found(self, message: ListStories.StoriesFound) -> None:
+        progress = self.query_one("#libraryprogress", ProgressBar)
+        progress.update(total=message.total, progress=message.done)
+        progress.styles.display = "none" if message.done >= message.total else "block"
+
+    def on_screen_suspend(self) -> None:
+        # stop loading the library, when the screen is left
+        storylist = self.query_one("#storylist", ListStories)
+        if not storylist.loaded:
+            self.app.workers.cancel_node(storylist)
+            storylist.cancelled = True
+
+    async def on_screen_resume(self) -> None:
+        storylist = self.query_one("#storylist", ListStories)
+        if storylist.cancelled:
+            await storylist.reload()
+
     def on_button_pressed(self, event: Button.Pressed) -> None:
         self.log("button pressed")
         self.log(event.button.id)
@@ -410,7 +505,9 @@ class GenerateScreen(ModalScreen):
     @work(exclusive=True)
     async def upd_gptout(self, prompt: str = "A story about a pirate") -> None:
         # sg = StoryGenerator(prompt=prompt)
-        async for cur, _ in self.app.story.generate_story(prompt=prompt):
+        # the whole output is written again for each frame, so at most 10 per second
+        stream = CoalescedStream(self.app.story.generate_story(prompt=prompt), max_fps=10)
+        async for cur, _ in stream:
             # async for cur, _ in self.app.story.generate_story_from_file(fname="./storytime_ai/templates/minimal.md"):
             self.query_one("#gptout").gptout = cur
 
@@ -632,6 +729,13 @@ class Storytime(App):
     }
     CSS_PATH = "templates/app.css"
 
+    def __init__(self, story_root: str | Path = ".", **kwargs):
+        super().__init__(**kwargs)
+        # created with the app, not on import
+        self.storycache = StoryCache()
+        # incremental search of the stories below the story root with a persistent index
+        self.discovery = StoryDiscovery(story_root, indexfile="log/storyindex.json", max_depth=STORY_MAX_DEPTH)
+
     def on_mount(self) -> None:
         """Start all Screens"""
         self.push_screen("Load")
@@ -664,7 +768,9 @@ def startapp():
         if not fname.is_file():
             print(f"File not found. Exiting. Given filename: {fname}")
             sys.exit(1)
-    app = Storytime()
+    if Story.retry is None:
+        Story.retry = RetryPolicy()
+    app = Storytime(story_root=os.getenv("STORYTIME_STORIES", "."))
     app.run()
 
 
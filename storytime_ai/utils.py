@@ -1,12 +1,67 @@
+import os
+import stat
+import tempfile
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Sequence
+from typing import IO, Iterator, Sequence
 
 
 def getfilelist(mypath: str, suffix: str, withpath: bool = False) -> Sequence[str | Path]:
-    """Find all files in folders and subfolders given a specific extension"""
+    """Find all files in a folder given a specific extension
+
+    Only the folder itself is searched, use :class:`storytime_ai.discovery.StoryDiscovery`
+    for a recursive search of stories.
+    """
     p = Path(mypath).glob("*." + suffix)
     file_list = [x for x in p if x.is_file()]
     file_list = [x for x in file_list if not x.name.startswith(".")]
     if not withpath:
         return [f.name for f in file_list]
     return file_list
+
+
+@contextmanager
+def atomic_open(path: str | Path, mode: str = "w", **kwargs) -> Iterator[IO]:
+    """Open a temporary file next to `path`, which replaces `path` when the block succeeds.
+
+    Readers never see a partially written file. If the block raises, the temporary file
+    is removed and `path` is unchanged. The file keeps the permissions of an existing `path`,
+    a new file is readable by all and writable by the owner.
+
+    Parameters
+    ----------
+    path : str or Path
+        The file to write
+    mode : str, optional
+        "w" for text or "wb" for bytes
+    **kwargs
+        Further arguments of :func:`open`, e.g. the encoding
+    """
+    path = Path(path)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix=".tmp")
+    try:
+        f = os.fdopen(fd, mode, **kwargs)
+    except BaseException:
+        try:
+            os.close(fd)
+        except OSError:
+            # already closed by open
+            pass
+        os.unlink(tmp)
+        raise
+    try:
+        with f:
+            # mkstemp creates the file readable only by the owner
+            try:
+                permissions = stat.S_IMODE(os.stat(path).st_mode)
+            except FileNotFoundError:
+                permissions = 0o644
+            os.chmod(tmp, permissions)
+            yield f
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
@@ -0,0 +1,31 @@
+import pytest
+
+import storytime_ai.messagelog as messagelog
+from storytime_ai import Story
+from storytime_ai.backends import FakeBackend
+
+
+@pytest.fixture
+def messagelog_file(tmp_path):
+    """Write the message log into the temporary directory and restore the previous file afterwards."""
+    previous = messagelog.filename
+    messagelog.set_filename(tmp_path / "messagelog.html")
+    yield messagelog.filename
+    messagelog.set_filename(previous)
+
+
+@pytest.fixture
+def use_fake_backend(messagelog_file, monkeypatch):
+    """Set a :class:`FakeBackend` with the given parameters as `Story.backend` for the test."""
+
+    def use(fname="storytime_ai/templates/story.md", **kwargs) -> FakeBackend:
+        backend = FakeBackend(fname, **kwargs)
+        monkeypatch.setattr(Story, "backend", backend)
+        return backend
+
+    return use
+
+
+@pytest.fixture
+def fake_backend(use_fake_backend):
+    return use_fake_backend()
@@ -0,0 +1,46 @@
+import pytest
+
+from storytime_ai import Story
+from storytime_ai.backends import Backend, FakeBackend, OpenAIBackend
+
+
+def test_default_backend():
+    assert isinstance(Story.backend, OpenAIBackend)
+    with pytest.raises(TypeError):
+        Backend()
+
+
+@pytest.mark.asyncio
+async def test_fake_backend_deterministic():
+    backend = FakeBackend("storytime_ai/templates/story.md")
+    messages = [{"role": "user", "content": "Write the next dialogue with the heading 'Cave'."}]
+    first = "".join([delta async for delta in backend.stream(messages)])
+    second = "".join([delta async for delta in backend.stream(messages)])
+    assert first == second
+    assert first.startswith("## Cave\n")
+    assert backend.requests == 2
+
+
+@pytest.mark.asyncio
+async def test_fake_backend_whole_template():
+    backend = FakeBackend("storytime_ai/templates/minimal.md", split="lines")
+    deltas = [delta async for delta in backend.stream([{"role": "user", "content": "A story"}])]
+    assert "".join(deltas) == backend.template
+    assert all(delta.endswith("\n") for delta in deltas[:-1])
+
+
+@pytest.mark.asyncio
+async def test_generate_story_with_fake_backend(fake_backend):
+    results = [cur async for cur, _ in Story.generate_story("A story")]
+    story = Story.from_markdown(results[-1])
+    assert len(story.dialogs) > 1
+
+
+@pytest.mark.asyncio
+async def test_continue_story_with_fake_backend(fake_backend):
+    story = Story.from_markdown_file("storytime_ai/templates/minimal.md")
+    story.addchoice("Into the unknown", "Unknown")
+    results = [cur async for cur, _ in story.continue_story("Unknown")]
+    assert results[-1].startswith("## Unknown\n")
+    assert story.currentdialog.dialogid == "Unknown"
+    assert fake_backend.requests == 1
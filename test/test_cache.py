@@ -0,0 +1,52 @@
+import time
+
+import pytest
+
+from storytime_ai.cache import CompletionCache, LRUCompletionCache, SQLiteCompletionCache, cache_key, replay
+
+
+def test_cache_key():
+    messages = [{"role": "user", "content": "Hello"}]
+    assert cache_key(messages, model="a") == cache_key([dict(messages[0])], model="a")
+    assert cache_key(messages, model="a") != cache_key(messages, model="b")
+    assert cache_key(messages, model="a", temperature=1) != cache_key(messages, model="a")
+
+
+def test_abstract_cache():
+    with pytest.raises(TypeError):
+        CompletionCache()
+
+
+@pytest.mark.parametrize("cache", [LRUCompletionCache(maxsize=2), SQLiteCompletionCache(":memory:", maxsize=2)])
+def test_lru_eviction(cache):
+    cache.set("a", "A")
+    cache.set("b", "B")
+    assert cache.get("a") == "A"
+    cache.set("c", "C")
+    assert cache.get("b") is None
+    assert cache.get("a") == "A"
+    assert cache.get("c") == "C"
+    assert len(cache) == 2
+    assert cache.hits == 3 and cache.misses == 1
+
+
+@pytest.mark.parametrize("cache", [LRUCompletionCache(ttl=0.01), SQLiteCompletionCache(":memory:", ttl=0.01)])
+def test_ttl(cache):
+    cache.set("a", "A")
+    assert cache.get("a") == "A"
+    time.sleep(0.02)
+    assert cache.get("a") is None
+
+
+def test_sqlite_persistent(tmp_path):
+    cache = SQLiteCompletionCache(tmp_path / "cache.sqlite")
+    cache.set("a", "A")
+    cache.close()
+    assert SQLiteCompletionCache(tmp_path / "cache.sqlite").get("a") == "A"
+
+
+@pytest.mark.asyncio
+async def test_replay():
+    results = [x async for x in replay("## Heading\nText\n- a: b")]
+    assert results[-1][0] == "## Heading\nText\n- a: b"
+    assert [delta for _, delta in results] == ["## Heading\n", "Text\n", "- a: b"]
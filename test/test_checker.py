@@ -0,0 +1,48 @@
+import json
+
+import pytest
+
+from storytime_ai.checker import check_files, find_story_files, main
+
+
+def test_find_story_files():
+    files = find_story_files(["./storytime_ai/templates"])
+    assert sorted(f.name for f in files) == ["broken.md", "minimal.md", "minimal2.md", "story.md"]
+
+
+def test_check_files_parallel():
+    files = find_story_files(["./storytime_ai/templates"])
+    results = {r["file"]: r for r in check_files(files, jobs=2)}
+    assert len(results) == 4
+    assert not results["storytime_ai/templates/broken.md"]["ok"]
+    assert results["storytime_ai/templates/minimal.md"]["ok"]
+    assert results["storytime_ai/templates/minimal.md"]["ndialogs"] == 4
+
+
+def test_main_json(capsys):
+    with pytest.raises(SystemExit) as e:
+        main(["--json", "-j", "1", "./storytime_ai/templates/minimal.md", "./storytime_ai/templates/broken.md"])
+    assert e.value.code == 1
+    captured = capsys.readouterr()
+    results = [json.loads(line) for line in captured.out.splitlines()]
+    assert [r["ok"] for r in results] == [True, False]
+    summary = json.loads(captured.err)["summary"]
+    assert summary["files"] == 2
+    assert summary["failed"] == 1
+
+
+def test_main_missing_file(capsys):
+    with pytest.raises(SystemExit):
+        main(["./does_not_exist.md"])
+    assert "Cannot read story" in capsys.readouterr().out
+
+
+def test_main_json_broken_logic(capsys, tmp_path):
+    fname = tmp_path / "broken_logic.md"
+    fname.write_text("# Broken logic\n\n## Start\n\nThe beginning\n\nLOGIC PROPERTY 'a' = (\n\n- End: The end\n")
+    with pytest.raises(SystemExit):
+        main(["--json", "-j", "1", str(fname), "./storytime_ai/templates/minimal.md"])
+    lines = capsys.readouterr().out.splitlines()
+    results = [json.loads(line) for line in lines]
+    assert len(results) == 2
+    assert any("never closed" in warning for warning in results[0]["warnings"])
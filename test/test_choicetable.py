@@ -0,0 +1,58 @@
+import pytest
+
+from storytime_ai import Choice, Dialog, Story
+from storytime_ai.choicetable import ChoiceTable
+
+
+@pytest.fixture
+def story():
+    return Story.from_markdown_file("storytime_ai/templates/story.md")
+
+
+def test_slots():
+    dialog = Dialog("Dialog " + str(1), "text", {}, "PROPERTY 'a' = 1")
+    dialog.addchoice("Go on", "Dialog " + str(1))
+    choice = dialog.choices["Dialog 1"]
+    assert not hasattr(dialog, "__dict__")
+    assert not hasattr(choice, "__dict__")
+    with pytest.raises(AttributeError):
+        dialog.other = 1
+    # interned ids share the same string
+    assert choice.nextdialogid is dialog.dialogid
+    assert dialog.compiled_logic is not None
+    # the rendered markdown is not kept per dialog
+    dialog.to_markdown()
+    assert set(Dialog.__slots__) == {"_dialogid", "_text", "_choices", "_logic", "_compiled_logic", "_fingerprint"}
+
+
+def test_parsed_ids_interned(story):
+    for dialog in story.dialogs.values():
+        for key, choice in dialog.choices.items():
+            assert key is choice.nextdialogid
+            if key in story.dialogs:
+                assert key is story.dialogs[key].dialogid
+
+
+def test_choice_table(story):
+    table = story.choice_table()
+    assert table.ndialogs == len(story.dialogs)
+    assert list(table) == list(story.dialogs)
+    assert len(table) == sum(len(d.choices) for d in story.dialogs.values())
+    for dialogid, dialog in story.dialogs.items():
+        assert dialogid in table
+        assert table.successors(dialogid) == list(dialog.choices)
+        assert table.choices(dialogid) == dialog.choices
+    assert table.nbytes() > 0
+    with pytest.raises(KeyError):
+        table.successors("unknown")
+
+
+def test_choice_table_dangling():
+    dialogs = {"A": Dialog("A", "text", {"B": Choice("to B", "B"), "C": Choice("to C", "C")}), "B": Dialog("B", "", {})}
+    table = ChoiceTable.from_dialogs(dialogs)
+    assert table.ndialogs == 2
+    assert table.ids == ["A", "B", "C"]
+    assert list(table.offsets) == [0, 2, 2]
+    assert "C" not in table
+    assert table.successors("A") == ["B", "C"]
+    assert table.choices("B") == {}
@@ -0,0 +1,132 @@
+import asyncio
+import threading
+
+import pytest
+
+from storytime_ai import Story
+from storytime_ai.backends import FakeBackend
+from storytime_ai.clients import ClientManager, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, burst=3, clock=clock)
+    assert [bucket.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    # the waiting requests are served in order
+    assert bucket.reserve() == pytest.approx(0.5)
+    assert bucket.reserve() == pytest.approx(1.0)
+    clock.now = 10.0
+    assert bucket.tokens == -2
+    assert bucket.reserve() == 0.0
+    assert bucket.tokens == pytest.approx(2)
+    with pytest.raises(ValueError):
+        TokenBucket(rate=0)
+
+
+def test_shared_by_threads():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=1, burst=100, clock=clock)
+    clients = ClientManager(max_in_flight=4)
+
+    async def requests():
+        for _ in range(200):
+            async with clients.slot("fake"):
+                await asyncio.sleep(0)
+
+    def run():
+        for _ in range(100):
+            bucket.reserve()
+        asyncio.run(requests())
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # no reservation and no count is lost
+    assert bucket.tokens == pytest.approx(100 - 400)
+    assert (clients.metrics.requests, clients.metrics.in_flight, clients.metrics.queued) == (800, 0, 0)
+
+
+@pytest.mark.asyncio
+async def test_max_in_flight():
+    clients = ClientManager(max_in_flight=2)
+    backend = FakeBackend("storytime_ai/templates/minimal.md", latency=0.02, split="lines")
+    running = []
+    maximum = 0
+
+    async def request():
+        nonlocal maximum
+        async for _ in clients.stream(backend, [], model="fake"):
+            running.append(1)
+            maximum = max(maximum, clients.metrics.in_flight)
+        return True
+
+    assert all(await asyncio.gather(*[request() for _ in range(6)]))
+    metrics = clients.metrics
+    assert maximum == 2
+    assert metrics.requests == 6
+    assert metrics.max_in_flight == 2
+    assert metrics.max_queued >= 4
+    assert metrics.in_flight == 0 and metrics.queued == 0
+    assert metrics.max_wait >= 0.03
+    assert metrics.mean_wait > 0
+
+
+@pytest.mark.asyncio
+async def test_rate_limit():
+    clients = ClientManager(rate_limits={"slow": 20})
+    clients.set_rate_limit("slow", 20, burst=1)
+    start = asyncio.get_running_loop().time()
+    for _ in range(4):
+        async with clients.slot("slow"):
+            pass
+        async with clients.slot("fast"):
+            pass
+    assert asyncio.get_running_loop().time() - start >= 0.14
+    assert clients.metrics.rate_limited == 3
+    clients.set_rate_limit("slow", None)
+    assert "slow" not in clients.buckets
+
+
+@pytest.mark.asyncio
+async def test_cancel_queued():
+    clients = ClientManager(max_in_flight=1)
+    async with clients.slot("fake"):
+        waiting = asyncio.create_task(clients.slot("fake").__aenter__())
+        await asyncio.sleep(0.01)
+        assert clients.metrics.queued == 1
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+    assert clients.metrics.queued == 0
+    # the place of the cancelled request is free
+    async with clients.slot("fake"):
+        assert clients.metrics.in_flight == 1
+
+
+@pytest.mark.asyncio
+async def test_story_uses_clients(use_fake_backend, monkeypatch):
+    use_fake_backend(token_rate=2000)
+    clients = ClientManager(max_in_flight=1)
+    monkeypatch.setattr(Story, "clients", clients)
+
+    async def play(nextdialogid):
+        story = Story.from_markdown_file("storytime_ai/templates/minimal.md")
+        story.addchoice("Into the unknown", nextdialogid)
+        async for _ in story.continue_story(nextdialogid):
+            assert clients.metrics.in_flight == 1
+        return story.currentdialog.dialogid
+
+    assert await asyncio.gather(play("Cave"), play("Forest")) == ["Cave", "Forest"]
+    assert clients.metrics.requests == 2
+    # the second generation waited for the first one
+    assert clients.metrics.max_wait > 0.01
@@ -0,0 +1,51 @@
+import pytest
+
+from storytime_ai import Story
+from storytime_ai.context import ContextWindow, estimate_tokens, summarize_dialog
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("Hello, world!") == 4
+    assert estimate_tokens("a" * 16) == 3
+
+
+def test_summarize_dialog():
+    story = Story.from_markdown_file("storytime_ai/templates/minimal.md")
+    line = summarize_dialog(story.currentdialog)
+    assert line.startswith(f"- {story.currentdialog.dialogid}")
+    assert "\n" not in line
+
+
+def test_context_window_budget():
+    context = ContextWindow(budget=200, max_recent=2, summary_budget=50)
+    context.system = {"role": "system", "content": "You write stories."}
+    story = Story.from_markdown_file("storytime_ai/templates/story.md")
+    dialogs = list(story.dialogs.values())
+    for dialog in dialogs:
+        context.add_dialog(dialog)
+        assert len(context) <= 2
+    assert context.last_dialogid == dialogs[-1].dialogid
+    assert len(context.summary) > 0
+    extra = [{"role": "user", "content": "Continue"}]
+    messages = context.build(extra)
+    assert messages[0] is context.system
+    assert messages[1]["content"].startswith(ContextWindow.summary_header)
+    assert messages[-1] is extra[0]
+    assert context.tokens(messages) <= context.budget
+
+
+@pytest.mark.asyncio
+async def test_prompt_size_flat(fake_backend):
+    story = Story.from_markdown_file("storytime_ai/templates/minimal.md")
+    story.context.summary_budget = 100
+    sizes = []
+    for i in range(60):
+        nextdialogid = f"Generated {i}"
+        story.addchoice("Continue", nextdialogid)
+        sizes.append(story.context.tokens(story.build_messages(nextdialogid)))
+        async for _ in story.continue_story(nextdialogid):
+            pass
+    assert len(story.messages) <= story.context.max_recent + 1
+    assert max(sizes) <= story.context.budget
+    assert max(sizes[30:]) <= max(sizes[:30])
@@ -0,0 +1,134 @@
+import pytest
+
+from storytime_ai import Choice, Dialog, Story
+from storytime_ai.dialogstore import DialogStore, LayeredDialogStore
+from storytime_ai.graph import StoryGraph
+
+
+def get_store():
+    story = Story.from_markdown_file("storytime_ai/templates/story.md")
+    return story.dialogs
+
+
+def test_overlay_falls_through():
+    base = get_store()
+    overlay = base.fork()
+    assert isinstance(overlay, LayeredDialogStore)
+    assert list(overlay) == list(base)
+    assert len(overlay) == len(base)
+    firstid = next(iter(base))
+    assert overlay[firstid] is base[firstid]
+    assert overlay.nbytes() < base.nbytes()
+
+
+def test_overlay_copy_on_write():
+    base = get_store()
+    overlay = base.fork()
+    firstid, secondid = list(base)[:2]
+    overlay["New"] = Dialog("New", "Generated text", {})
+    overlay.writable(firstid).addchoice("Go to the new dialog", "New")
+    overlay.changed(firstid)
+    del overlay[secondid]
+    assert "New" not in base
+    assert "New" not in base[firstid].choices
+    assert "New" in overlay[firstid].choices
+    assert secondid in base
+    assert secondid not in overlay
+    assert list(overlay) == [d for d in base if d != secondid] + ["New"]
+    assert len(overlay) == len(base)
+    assert (firstid, "New") in list(overlay.graph.edges())
+
+
+def test_fork_and_merge():
+    base = get_store()
+    overlay = base.fork()
+    firstid = next(iter(base))
+    overlay.writable(firstid).addchoice("Go on", "New")
+    fork = overlay.fork()
+    fork.writable(firstid).addchoice("Other", "Other")
+    assert "Other" not in overlay[firstid].choices
+    assert "New" in fork[firstid].choices
+    overlay["New"] = Dialog("New", "Generated text", {})
+    changed = overlay.merge()
+    assert sorted(changed) == sorted([firstid, "New"])
+    assert "New" in base
+    assert "New" in base[firstid].choices
+    assert len(overlay.overlay) == 0
+    assert overlay[firstid] is base[firstid]
+
+
+def test_story_fork():
+    story = Story.from_markdown_file("storytime_ai/templates/story.md")
+    fork = story.fork()
+    fork.addchoice("A new way", "New")
+    assert "New" not in story.currentdialog.choices
+    assert "New" in fork.currentdialog.choices
+    assert isinstance(story.dialogs, DialogStore)
+    fork.merge()
+    assert "New" in story.currentdialog.choices
+    assert story.currentdialog is story.dialogs[story.currentdialog.dialogid]
+    assert fork.currentdialog is story.currentdialog
+
+
+def test_story_fork_of_fork():
+    template = Story.from_markdown_file("storytime_ai/templates/story.md")
+    story = template.fork()
+    story.addchoice("A new way", "New")
+    fork = story.fork()
+    fork.addchoice("Another way", "Other")
+    assert fork.dialogs.base is story.dialogs
+    assert "Other" not in story.currentdialog.choices
+    assert_same_graph(fork.dialogs.graph, fork.dialogs)
+    assert sorted(fork.merge()) == [story.currentdialog.dialogid]
+    # the changes are applied to the story, from which the fork was created, not to the template
+    assert {"New", "Other"} <= set(story.currentdialog.choices)
+    assert story.currentdialog is story.dialogs[story.currentdialog.dialogid]
+    assert "New" not in template.currentdialog.choices and "Other" not in template.currentdialog.choices
+    assert_same_graph(fork.dialogs.graph, fork.dialogs)
+    assert_same_graph(story.dialogs.graph, story.dialogs)
+    story.merge()
+    assert {"New", "Other"} <= set(template.currentdialog.choices)
+    assert_same_graph(fork.dialogs.graph, fork.dialogs)
+
+
+def assert_same_graph(graph, dialogs):
+    reference = StoryGraph(dict(dialogs.items()))
+    assert set(graph.nodes()) == set(reference.nodes())
+    assert len(graph) == len(reference)
+    assert set(graph.edges()) == set(reference.edges())
+    for node in reference.nodes():
+        assert set(graph.predecessors(node)) == set(reference.predecessors(node))
+        assert set(graph.successors(node)) == set(reference.successors(node))
+    assert graph.number_of_components() == reference.number_of_components()
+
+
+def test_overlay_graph_shares_base():
+    base = get_store()
+    overlay = base.fork()
+    firstid, secondid, thirdid = list(base)[:3]
+    assert overlay.graph.base is base.graph
+    assert_same_graph(overlay.graph, overlay)
+
+    overlay["New"] = Dialog("New", "Generated text", {"Unknown": Choice("Go on", "Unknown")})
+    overlay.writable(firstid).addchoice("Go to the new dialog", "New")
+    overlay.changed(firstid)
+    del overlay[secondid]
+    assert_same_graph(overlay.graph, overlay)
+    assert "Unknown" in overlay.graph and "Unknown" not in base.graph
+    # only the edges of the dialogs in the overlay are kept
+    assert set(overlay.graph._successors) == {firstid, secondid, "New"}
+
+    # changes of the shared store are seen by the overlay
+    base[thirdid] = Dialog(thirdid, "Replaced text", {"Elsewhere": Choice("Elsewhere", "Elsewhere")})
+    assert_same_graph(overlay.graph, overlay)
+    del overlay["New"]
+    assert_same_graph(overlay.graph, overlay)
+    with pytest.raises(KeyError):
+        overlay.graph.predecessors("Unknown")
+
+    # a fork rebuilds its graph from the overlay only
+    fork = overlay.fork()
+    assert_same_graph(fork.graph, fork)
+    overlay.merge()
+    assert_same_graph(overlay.graph, overlay)
+    assert_same_graph(base.graph, base)
@@ -0,0 +1,111 @@
+import os
+import threading
+
+from storytime_ai.discovery import Changes, StoryDiscovery, find_story_files
+
+
+def write(path, text="# Story\n## Start\nText\n"):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+    return path
+
+
+def names(paths, root):
+    return sorted(os.path.relpath(p, root) for p in paths)
+
+
+def test_discovery_recursive_ignore(tmp_path):
+    write(tmp_path / "a.md")
+    write(tmp_path / "README.md")
+    write(tmp_path / "notes.txt")
+    write(tmp_path / "sub" / "b.md")
+    write(tmp_path / "sub" / "deep" / "c.md")
+    write(tmp_path / ".hidden" / "d.md")
+    write(tmp_path / "node_modules" / "e.md")
+    write(tmp_path / "drafts" / "f.md")
+    discovery = StoryDiscovery(tmp_path, ignore=[".*", "README.md", "node_modules", "drafts/*"])
+    changes = discovery.scan()
+    expected = ["a.md", os.path.join("sub", "b.md"), os.path.join("sub", "deep", "c.md")]
+    assert names(changes.added, tmp_path) == expected
+    assert names(discovery.paths(), tmp_path) == expected
+    assert len(discovery) == 3
+
+
+def test_discovery_incremental(tmp_path):
+    a = write(tmp_path / "a.md")
+    b = write(tmp_path / "sub" / "b.md")
+    discovery = StoryDiscovery(tmp_path)
+    discovery.scan()
+    assert not discovery.scan()
+
+    c = write(tmp_path / "sub" / "c.md")
+    a.write_text("# Story\n## Start\nLonger text\n")
+    stat = os.stat(a)
+    os.utime(a, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    b.unlink()
+    changes = discovery.scan()
+    assert changes == Changes(added=[str(c)], modified=[str(a)], removed=[str(b)])
+    assert not discovery.scan()
+
+
+def test_discovery_index(tmp_path):
+    root = tmp_path / "stories"
+    a = write(root / "a.md")
+    indexfile = tmp_path / "index" / "storyindex.json"
+    discovery = StoryDiscovery(root, indexfile=indexfile)
+    discovery.scan()
+    assert indexfile.is_file()
+
+    discovery = StoryDiscovery(root, indexfile=indexfile)
+    assert discovery.paths() == [a]
+    assert not discovery.scan()
+    b = write(root / "b.md")
+    assert StoryDiscovery(root, indexfile=indexfile).scan().added == [str(b)]
+
+    # other settings do not use the index
+    assert len(StoryDiscovery(root, ignore=["b.md"], indexfile=indexfile)) == 0
+    indexfile.write_text("{broken")
+    assert len(StoryDiscovery(root, indexfile=indexfile)) == 0
+
+
+def test_discovery_watch(tmp_path):
+    discovery = StoryDiscovery(tmp_path)
+    discovery.scan()
+    found = []
+    event = threading.Event()
+
+    def callback(changes):
+        found.extend(changes.added)
+        event.set()
+
+    watcher = discovery.watch(callback, interval=0.01)
+    try:
+        a = write(tmp_path / "a.md")
+        assert event.wait(5)
+    finally:
+        watcher.stop()
+    assert not watcher.is_alive()
+    assert found == [str(a)]
+
+
+def test_find_story_files(tmp_path):
+    write(tmp_path / "a.md")
+    write(tmp_path / "sub" / "b.md")
+    write(tmp_path / "README.md")
+    single = write(tmp_path / "other" / "README.md")
+    assert find_story_files([tmp_path, single]) == [tmp_path / "a.md", tmp_path / "sub" / "b.md", single]
+
+
+def test_discovery_max_depth_and_default_ignore(tmp_path):
+    write(tmp_path / "a.md")
+    write(tmp_path / "sub" / "b.md")
+    write(tmp_path / "sub" / "deep" / "c.md")
+    for tool in [".git", ".venv", "venv", "node_modules"]:
+        write(tmp_path / tool / "x.md")
+    assert names(StoryDiscovery(tmp_path).scan().added, tmp_path) == [
+        "a.md",
+        os.path.join("sub", "b.md"),
+        os.path.join("sub", "deep", "c.md"),
+    ]
+    assert names(StoryDiscovery(tmp_path, max_depth=1).scan().added, tmp_path) == ["a.md", os.path.join("sub", "b.md")]
+    assert names(StoryDiscovery(tmp_path, max_depth=0).scan().added, tmp_path) == ["a.md"]
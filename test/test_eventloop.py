@@ -0,0 +1,83 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from storytime_ai import Story
+from storytime_ai.eventloop import BackgroundLoop, get_background_loop
+from storytime_ai.streaming import CoalescedStream
+
+
+@pytest.fixture
+def loop():
+    loop = BackgroundLoop().start()
+    yield loop
+    loop.stop()
+
+
+async def numbers(n, closed=None, fail=False):
+    try:
+        for i in range(n):
+            await asyncio.sleep(0.001)
+            yield i
+        if fail:
+            raise ValueError("failed")
+    finally:
+        if closed is not None:
+            closed.set()
+
+
+def test_run(loop):
+    async def thread_name():
+        return threading.current_thread().name
+
+    assert loop.run(thread_name()) == "storytime-loop"
+    # the same loop for all calls
+    assert loop.run(asyncio.sleep(0, asyncio.get_running_loop)) is loop.run(asyncio.sleep(0, asyncio.get_running_loop))
+
+
+def test_iterate(loop):
+    assert list(loop.iterate(numbers(20))) == list(range(20))
+    with pytest.raises(ValueError):
+        list(loop.iterate(numbers(3, fail=True)))
+
+
+def test_iterate_stop_early(loop):
+    closed = threading.Event()
+    for i in loop.iterate(numbers(1000, closed=closed)):
+        if i == 2:
+            break
+    assert closed.wait(5)
+
+
+def test_stop():
+    loop = BackgroundLoop().start()
+    future = loop.submit(asyncio.sleep(100))
+    loop.stop(5)
+    assert not loop.running
+    assert future.cancelled()
+    with pytest.raises(RuntimeError):
+        loop.start()
+    coro = asyncio.sleep(0)
+    with pytest.raises(RuntimeError):
+        loop.submit(coro)
+
+
+def test_get_background_loop():
+    assert get_background_loop() is get_background_loop()
+    assert get_background_loop().running
+
+
+def test_continue_story_in_background(loop, use_fake_backend):
+    backend = use_fake_backend(token_rate=1000)
+    story = Story.from_markdown_file("storytime_ai/templates/minimal.md")
+    story.addchoice("Into the unknown", "Unknown")
+    loop.run(backend.open())
+    start = time.monotonic()
+    stream = CoalescedStream(story.continue_story("Unknown", override_existing=False), max_fps=20)
+    frames = list(loop.iterate(stream))
+    assert "".join(delta for _, delta in frames) == frames[-1][0]
+    assert stream.metrics.frames <= (time.monotonic() - start) * 20 + 2
+    assert story.currentdialog.dialogid == "Unknown"
+    loop.run(backend.aclose())
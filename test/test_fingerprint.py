@@ -0,0 +1,90 @@
+import pytest
+
+from storytime_ai import Choice, Dialog, Story
+
+
+def make_dialog():
+    return Dialog("Start", "First line\nSecond line\n", {"Next": Choice("Go on", "Next")}, "PROPERTY 'a' = 1")
+
+
+def test_dialog_equality_normalized():
+    a = make_dialog()
+    b = Dialog("Start", "  First line\n\n\nSecond line  ", {"Next": Choice("Go on", "Next")}, "PROPERTY 'a' = 1")
+    assert a == b
+    assert hash(a) == hash(b)
+    assert a.fingerprint() == b.fingerprint()
+    assert a != Dialog("Start", "Other text\n", {"Next": Choice("Go on", "Next")}, "PROPERTY 'a' = 1")
+    assert a != "Start"
+    assert Dialog.from_markdown(a.to_markdown()) == a
+
+
+def test_dialog_fingerprint_invalidated():
+    dialog = make_dialog()
+    fingerprints = [dialog.fingerprint()]
+    dialog.addchoice("Go back", "Start")
+    fingerprints.append(dialog.fingerprint())
+    dialog.removechoice("Start")
+    assert dialog.fingerprint() == fingerprints[0]
+    dialog.text = "Changed text\n"
+    fingerprints.append(dialog.fingerprint())
+    dialog.logic = ""
+    fingerprints.append(dialog.fingerprint())
+    dialog.choices["Start"] = Choice("Go back", "Start")
+    dialog.changed()
+    fingerprints.append(dialog.fingerprint())
+    assert len(set(fingerprints)) == len(fingerprints)
+    assert dialog.copy().fingerprint() == dialog.fingerprint()
+
+
+def test_dialog_hash_stable():
+    dialog = make_dialog()
+    dialogs = {dialog}
+    dialog.text = "Changed text\n"
+    dialog.addchoice("Go back", "Start")
+    # the dialog is still found after the change
+    assert dialog in dialogs
+    assert hash(dialog) == hash(Dialog("Start ", "Other text\n", {}))
+
+
+def test_choice_equality():
+    assert Choice("Go on", "Next") == Choice("Go on", "Next")
+    assert Choice("Go on", "Next") != Choice("Go on", "Other")
+    assert len({Choice("Go on", "Next"), Choice("Go on", "Next")}) == 1
+
+
+def test_story_fingerprint():
+    story = Story.from_markdown_file("storytime_ai/templates/story.md")
+    same = Story.from_markdown(story.to_markdown())
+    assert story == same
+    assert story.fingerprint() == same.fingerprint()
+    # dedup of stories
+    assert len({story.fingerprint(), same.fingerprint()}) == 1
+    with pytest.raises(TypeError):
+        hash(story)
+
+    fingerprint = story.fingerprint()
+    story.addchoice("A new choice", "Nowhere")
+    assert story.fingerprint() != fingerprint
+    assert story != same
+    story.currentdialog.removechoice("Nowhere")
+    assert story.fingerprint() == fingerprint
+    story.currentdialog.addchoice("Another choice", "Elsewhere")
+    assert story.fingerprint() != fingerprint
+    story.currentdialog.removechoice("Elsewhere")
+    story.currentdialog.text = "Changed text\n"
+    assert story.fingerprint() != fingerprint
+    assert story != same
+
+    story.title = "Other title"
+    assert story.fingerprint() != fingerprint
+    assert story != same
+
+
+def test_story_fingerprint_layered():
+    story = Story.from_markdown_file("storytime_ai/templates/story.md")
+    fork = story.fork()
+    fingerprint = fork.fingerprint()
+    assert fingerprint == story.fingerprint()
+    dialogid = next(iter(story.dialogs))
+    story.dialogs[dialogid] = Dialog(dialogid, "Replaced text\n", {})
+    assert fork.fingerprint() != fingerprint
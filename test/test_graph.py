@@ -39,3 +39,38 @@ def test_restriction_to_largest_substory():
     st.dialogs["nonsense"] = story.Dialog("nonsense", "nonsense", {})
     st.restrict_to_largest_substory()
     assert not st.has_subgraphs()
+
+
+def test_incremental_graph():
+    st = get_test_story()
+    graph = st.graph
+    assert set(graph.successors("eins")) == {"drei", "zwei"}
+    assert set(graph.predecessors("zwei")) == {"Coole IDß", "eins"}
+    assert graph.number_of_components() == 1
+    st.dialogs["nonsense"] = story.Dialog("nonsense", "nonsense", {})
+    assert graph.number_of_components() == 2
+    st.dialogs["nonsense"].addchoice("back", "zwei")
+    st.dialogs.changed("nonsense")
+    assert graph.number_of_components() == 1
+    del st.dialogs["nonsense"]
+    assert "nonsense" not in graph
+    assert set(graph.predecessors("zwei")) == {"Coole IDß", "eins"}
+
+
+def test_graph_after_addchoice_and_prune():
+    st = get_test_story()
+    st.addchoice("new text", "vier")
+    assert "vier" in st.graph.successors("Coole IDß")
+    st.prune_dangling_choices()
+    assert "vier" not in st.graph
+    assert "drei" not in st.graph
+    assert not st.has_subgraphs()
+
+
+def test_create_graph():
+    if not story._graph:
+        pytest.skip("graph not available")
+    st = get_test_story()
+    st.create_graph()
+    assert set(st.G.nodes) == set(st.graph.nodes())
+    assert set(st.G.edges) == set(st.graph.edges())
@@ -0,0 +1,29 @@
+import pytest
+
+from storytime_ai import Story
+from storytime_ai.library import scan_bytes, scan_directory
+
+
+@pytest.mark.parametrize("name", ["story.md", "minimal.md", "minimal2.md", "broken.md"])
+def test_scan_metadata(name):
+    fname = f"storytime_ai/templates/{name}"
+    info = Story.scan_metadata(fname)
+    story = Story.from_markdown_file(fname)
+    assert info.title == story.title
+    assert info.ndialogs == len(story.dialogs)
+
+
+def test_scan_bytes_edge_cases():
+    assert scan_bytes(b"") == ("", 1)
+    assert scan_bytes(b"# Title\r\n## A\r\ntext\r\n## B\n## A\n") == ("Title", 2)
+    assert scan_bytes(b"## A\n## \ntext") == ("", 2)
+
+
+def test_scan_directory(tmp_path):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "a.md").write_text("# A\n## One\n## Two\n")
+    (tmp_path / "b.md").write_text("# B\n## One\n")
+    (tmp_path / "README.md").write_text("# Readme\n")
+    (tmp_path / ".hidden.md").write_text("# Hidden\n")
+    infos = scan_directory(tmp_path, jobs=2)
+    assert [(i.title, i.ndialogs) for i in infos] == [("B", 1), ("A", 2)]
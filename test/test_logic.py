@@ -0,0 +1,30 @@
+from storytime_ai import Dialog
+from storytime_ai.logic import CompiledLogic
+
+
+def test_compile_property():
+    logic = CompiledLogic.compile('PROPERTY "Health Points" = "Health Points" - 10')
+    properties = {"Health Points": 100}
+    for statement in logic:
+        properties[statement.target] = statement.evaluate(properties)
+    assert properties["Health Points"] == 90
+
+
+def test_unknown_property_is_string():
+    logic = CompiledLogic.compile("PROPERTY 'name' = 'unknown'")
+    assert logic.statements[0].evaluate({}) == "unknown"
+
+
+def test_nextdialogids():
+    logic = CompiledLogic.compile("NEXTDIALOG 'zwei' IF 'test' == 1\nPROPERTY 'test' = 2\nNEXTDIALOG broken")
+    assert logic.nextdialogids == ["zwei"]
+    assert logic.statements[2].error is not None
+
+
+def test_compiled_logic_is_cached():
+    dialog = Dialog("id", "text", {}, "PROPERTY 'test' = 1")
+    compiled = dialog.compiled_logic
+    assert dialog.compiled_logic is compiled
+    dialog.logic = "PROPERTY 'test' = 2"
+    assert dialog.compiled_logic is not compiled
+    assert dialog.compiled_logic.statements[0].evaluate({}) == 2
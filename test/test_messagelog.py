@@ -1,28 +1,24 @@
-from pathlib import Path
-from tempfile import TemporaryDirectory
+import pytest
 
 import storytime_ai.messagelog as messagelog
 
 
-def test_messagelog():
-    temp_dir = TemporaryDirectory()
-    temp_file = Path(temp_dir.name) / "temp_file.html"
-    messagelog.set_filename(temp_file)
+def test_messagelog(messagelog_file):
+    temp_file = messagelog_file
     messagelog.log([{"heading": "unique heading", "content": "log content"}])
     messagelog.log([{"heading": "unique heading2 ", "content": "log content"}])
+    messagelog.flush()
     with temp_file.open() as f:
         assert f.read().strip() != ""
         f.seek(0)
         assert "unique heading" in f.read()
-    temp_dir.cleanup()
 
 
-def test_messagelog_message():
-    temp_dir = TemporaryDirectory()
-    temp_file = Path(temp_dir.name) / "temp_file.html"
-    messagelog.set_filename(temp_file)
+def test_messagelog_message(messagelog_file):
+    temp_file = messagelog_file
     messagelog.messagelog([{"role": "Wurst", "content": "Testxt"}, {"role": "Wurst", "content": "Test2"}])
     messagelog.messagelog([{"role": "Wurst", "content": "Testxt"}])
+    messagelog.flush()
     # import os
     # import time
     # os.system("xdg-open " + str(temp_file))
@@ -31,8 +27,39 @@ def test_messagelog_message():
         assert f.read().strip() != ""
         f.seek(0)
         assert "Test2" in f.read()
-    temp_dir.cleanup()
+
+
+def test_messagelog_bounded(messagelog_file, monkeypatch, tmp_path):
+    temp_file = messagelog_file
+    # restore the ring buffer with the default length after the test
+    monkeypatch.setattr(messagelog, "entry_storage", messagelog.entry_storage)
+    messagelog.set_maxlen(3)
+    for i in range(10):
+        messagelog.log({"heading": f"entry {i}", "content": [{"role": "user", "content": f"message {i}"}]})
+    assert [e["heading"] for e in messagelog.entry_storage] == ["entry 7", "entry 8", "entry 9"]
+    messagelog.flush()
+    content = temp_file.read_text()
+    assert content.count("<!doctype html>") == 1
+    assert "message 0" in content and "message 9" in content
+    html = messagelog.render_log()
+    assert "message 0" not in html and "message 9" in html
+    messagelog.write_log(tmp_path / "recent.html")
+    assert "message 9" in (tmp_path / "recent.html").read_text()
+
+
+def test_messagelog_truncated_and_rotated(tmp_path):
+    temp_file = tmp_path / "temp_file.html"
+    temp_file.write_text("<p>log of an earlier process</p>")
+    writer = messagelog.LogWriter(batch_size=1, max_bytes=2000)
+    for i in range(20):
+        writer.put(temp_file, {"heading": f"entry {i}", "content": [{"role": "user", "content": "x" * 100}]})
+    writer.flush()
+    backup = tmp_path / "temp_file.1.html"
+    content = temp_file.read_text()
+    assert "earlier process" not in content and "earlier process" not in backup.read_text()
+    assert content.count("<!doctype html>") == 1 and "entry 19" in content
+    assert temp_file.stat().st_size < 4000 and backup.stat().st_size < 4000
 
 
 if __name__ == "__main__":
-    test_messagelog()
+    pytest.main([__file__])
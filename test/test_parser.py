@@ -0,0 +1,138 @@
+import random
+
+from storytime_ai import Dialog, Story
+from storytime_ai.parser import (
+    CHOICE_COMPLETED,
+    CHOICE_STARTED,
+    HEADING,
+    LOGIC,
+    TEXT,
+    MarkdownParser,
+    StreamingDialogParser,
+    iter_lines,
+)
+
+
+def test_iter_lines():
+    assert list(iter_lines("a\nb\n")) == ["a", "b", ""]
+    assert list(iter_lines(["a\n", "b"])) == ["a", "b"]
+
+
+def test_parse_from_file_object():
+    fname = "./storytime_ai/templates/story.md"
+    with open(fname) as f:
+        story = Story.from_markdown(f)
+    with open(fname) as f:
+        assert story == Story.from_markdown(f.read())
+
+
+def test_parse_from_generator():
+    def lines():
+        yield "# Generated"
+        yield "## First"
+        yield "LOGIC PROPERTY 'a' = 1"
+        yield "Text"
+        yield "- Second: Go on"
+        yield "over two lines"
+        yield "## Second"
+        yield "The end"
+
+    story = Story.from_markdown(lines())
+    assert story.title == "Generated"
+    assert list(story.dialogs) == ["First", "Second"]
+    assert story.dialogs["First"].logic == "PROPERTY 'a' = 1"
+    assert story.dialogs["First"].choices["Second"].text == "Go on\nover two lines"
+    assert story.dialogs["Second"].text == "The end\n"
+
+
+def test_feed_returns_completed_dialogs():
+    parser = MarkdownParser()
+    assert parser.feed("## First") is None
+    assert parser.feed("Text") is None
+    completed = parser.feed("## Second")
+    assert completed.dialogid == "First"
+    assert parser.close().dialogid == "Second"
+
+
+def test_dialog_uses_last_heading():
+    dialog = Dialog.from_markdown("Some preamble\n## First\nText\n## Second\nOther text\n- First: Back")
+    assert dialog.dialogid == "Second"
+    assert dialog.text == "Other text\n"
+    assert list(dialog.choices) == ["First"]
+
+
+def test_dialog_without_heading():
+    dialog = Dialog.from_markdown(iter(["Heading\n", "Text\n"]))
+    assert dialog.dialogid == "Heading"
+    assert dialog.text == "Text\n"
+
+
+def stream(markdown, sizes):
+    parser = StreamingDialogParser()
+    events = []
+    pos = 0
+    for size in sizes:
+        events += parser.push(markdown[pos : pos + size])
+        pos += size
+    events += parser.push(markdown[pos:])
+    dialog = parser.finish()
+    return dialog, events + parser.pop_events()
+
+
+def test_streaming_parser_events():
+    markdown = (
+        "## Start\nLOGIC PROPERTY 'a' = 1\nFirst line\n\nSecond line\n\n- Left: Go left\nfar away\n- Right: Go right"
+    )
+    dialog, events = stream(markdown, [3] * 40)
+    assert dialog == Dialog.from_markdown(markdown)
+    kinds = [e.kind for e in events if e.kind != TEXT]
+    assert kinds == [HEADING, LOGIC, CHOICE_STARTED, CHOICE_COMPLETED, CHOICE_STARTED, CHOICE_COMPLETED]
+    assert events[0].text == "Start"
+    assert "".join(e.text for e in events if e.kind == TEXT) == dialog.text
+    completed = [e.choice for e in events if e.kind == CHOICE_COMPLETED]
+    assert completed == list(dialog.choices.values())
+    assert completed[0].text == "Go left\nfar away"
+
+
+def test_streaming_parser_incomplete_text():
+    parser = StreamingDialogParser()
+    assert [e.kind for e in parser.push("## Head")] == []
+    assert [e.kind for e in parser.push("ing\nSome te")] == [HEADING, TEXT]
+    assert parser.text == "Some te"
+    # may be the start of a choice
+    assert [(e.kind, e.text) for e in parser.push("xt\n-")] == [(TEXT, "xt\n")]
+    assert [e.kind for e in parser.push(" Next: Go on\n")] == [CHOICE_STARTED]
+    assert parser.finish().choices["Next"].text == "Go on"
+    assert [e.kind for e in parser.pop_events()] == [CHOICE_COMPLETED]
+
+
+def test_streaming_parser_matches_from_markdown():
+    rng = random.Random(7)
+    pieces = [
+        "## A",
+        "## B",
+        "# Title",
+        "Text",
+        "  indented",
+        "### Sub",
+        "LOGIC x",
+        "LOG",
+        "- C: choice",
+        "- D: other",
+        "- broken",
+        "-x",
+        "SECRET s",
+        "",
+        "",
+        "more text",
+    ]
+    for _ in range(300):
+        markdown = "\n".join(rng.choice(pieces) for _ in range(rng.randint(0, 12)))
+        sizes = [rng.randint(1, 5) for _ in range(len(markdown))]
+        dialog, events = stream(markdown, sizes)
+        expected = Dialog.from_markdown(markdown)
+        assert dialog == expected
+        assert dialog.dialogid == expected.dialogid
+        # the text events after the last heading are the text of the dialog
+        last = max(i for i, e in enumerate(events) if e.kind == HEADING)
+        assert "".join(e.text for e in events[last:] if e.kind == TEXT) == expected.text
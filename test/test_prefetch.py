@@ -0,0 +1,143 @@
+import asyncio
+
+import pytest
+
+from storytime_ai import Choice, Dialog, Story
+
+
+def get_branching_story():
+    return Story(
+        {
+            "Start": Dialog(
+                "Start",
+                "The beginning",
+                {"Left": Choice("Go left", "Left"), "Right": Choice("Go right", "Right")},
+            ),
+        },
+        "Branches",
+    )
+
+
+@pytest.fixture
+def fake_completion(messagelog_file, monkeypatch):
+    requests = []
+
+    async def stream_completion(cls, messages, model="", **kwargs):
+        heading = messages[-1]["content"].split("with the heading '")[1].split("'")[0]
+        requests.append(heading)
+        current_result = ""
+        for delta in [f"## {heading}\n", "Generated text\n"]:
+            await asyncio.sleep(0.01)
+            current_result += delta
+            yield current_result, delta
+
+    monkeypatch.setattr(Story, "stream_completion", classmethod(stream_completion))
+    return requests
+
+
+@pytest.mark.asyncio
+async def test_prefetch_finished(fake_completion):
+    story = get_branching_story()
+    story.enable_prefetch(max_concurrency=2)
+    story.prefetch.schedule()
+    assert set(story.prefetch.pending) == {"Left", "Right"}
+    await asyncio.gather(*[p.task for p in story.prefetch.pending.values()])
+    results = [cur async for cur, _ in story.continue_story("Left")]
+    assert results[-1] == "## Left\nGenerated text\n"
+    assert story.currentdialog.dialogid == "Left"
+    assert story.currentdialog.text == "Generated text\n"
+    assert sorted(fake_completion) == ["Left", "Right"]
+    assert story.prefetch.pending == {}
+
+
+@pytest.mark.asyncio
+async def test_prefetch_attach_and_cancel(fake_completion):
+    story = get_branching_story()
+    story.enable_prefetch(max_concurrency=1)
+    story.prefetch.schedule()
+    right = story.prefetch.pending["Right"]
+    await asyncio.sleep(0)
+    results = [cur async for cur, _ in story.continue_story("Left")]
+    assert results[-1] == "## Left\nGenerated text\n"
+    assert story.currentdialog.dialogid == "Left"
+    # The generation of the other branch never started, because of the concurrency limit
+    await asyncio.sleep(0.05)
+    assert right.task.cancelled()
+    assert fake_completion == ["Left"]
+
+
+@pytest.mark.asyncio
+async def test_prefetch_restart(fake_completion):
+    story = get_branching_story()
+    story.enable_prefetch(max_concurrency=2)
+    prefetch = story.prefetch
+    prefetch.schedule()
+    old = [p.task for p in prefetch.pending.values()]
+    await asyncio.sleep(0)
+    story.restart()
+    await asyncio.gather(*old, return_exceptions=True)
+    assert all(task.cancelled() for task in old)
+    # prefetching stays enabled and starts again at the first dialog
+    assert story.prefetch is prefetch
+    assert set(prefetch.pending) == {"Left", "Right"}
+    assert not any(p.task in old for p in prefetch.pending.values())
+    prefetch.cancel()
+
+
+@pytest.mark.asyncio
+async def test_pending_dialog_stream_error():
+    from storytime_ai.prefetch import PendingDialog
+
+    pending = PendingDialog("Start", "Left", [])
+    await pending.add("## Left\n")
+    await pending.finish(ValueError("broken"))
+    with pytest.raises(ValueError):
+        async for _ in pending.stream():
+            pass
+
+
+@pytest.mark.asyncio
+async def test_prefetch_cancelled_with_kwargs(fake_completion):
+    story = get_branching_story()
+    story.enable_prefetch(max_concurrency=2)
+    story.prefetch.schedule()
+    left = story.prefetch.pending["Left"]
+    await asyncio.sleep(0)
+    results = [cur async for cur, _ in story.continue_story("Left", temperature=0.5)]
+    assert results[-1] == "## Left\nGenerated text\n"
+    # the prefetch of the chosen branch is cancelled, too
+    assert left.task.cancelled()
+
+
+@pytest.mark.asyncio
+async def test_prefetch_failed_fallback(fake_completion, monkeypatch):
+    failing = Story.stream_completion.__func__
+    calls = []
+
+    async def stream_completion(cls, messages, model="", **kwargs):
+        calls.append(1)
+        if len(calls) == 1:
+            raise ConnectionError("prefetch failed")
+        async for item in failing(cls, messages, model, **kwargs):
+            yield item
+
+    monkeypatch.setattr(Story, "stream_completion", classmethod(stream_completion))
+    story = get_branching_story()
+    story.enable_prefetch(max_concurrency=1)
+    story.prefetch.schedule()
+    pending = story.prefetch.pending["Left"]
+    # attached to the running prefetch, which fails
+    results = [cur async for cur, _ in story.continue_story("Left")]
+    assert isinstance(pending.error, ConnectionError)
+    assert results[-1] == "## Left\nGenerated text\n"
+    assert story.currentdialog.dialogid == "Left"
+
+    # the prefetch failed already, before the dialog was chosen
+    calls.clear()
+    story.currentdialog.addchoice("Go on", "Next")
+    story.prefetch.schedule()
+    pending = story.prefetch.pending["Next"]
+    await asyncio.gather(pending.task)
+    results = [cur async for cur, _ in story.continue_story("Next")]
+    assert results[-1] == "## Next\nGenerated text\n"
+    assert len(calls) == 2
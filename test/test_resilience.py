@@ -0,0 +1,154 @@
+import asyncio
+import math
+
+import pytest
+
+from storytime_ai import Story
+from storytime_ai.backends import FakeBackend
+from storytime_ai.clients import ClientManager
+from storytime_ai.resilience import LatencyStats, RetryPolicy, StreamTimeout
+
+MESSAGES = [{"role": "user", "content": "Write the next dialogue with the heading 'Cave'."}]
+
+
+def make_backend(**kwargs):
+    return FakeBackend("storytime_ai/templates/story.md", **kwargs)
+
+
+async def collect(policy, backend, clients=None):
+    if clients is None:
+        return "".join([delta async for delta in policy.stream(lambda: backend.stream(MESSAGES))])
+    request = lambda: clients.stream(backend, MESSAGES, model="fake")  # noqa: E731
+    return "".join([delta async for delta in policy.stream(request)])
+
+
+def test_latency_stats():
+    stats = LatencyStats(maxlen=100)
+    assert math.isnan(stats.percentile(50))
+    for i in range(1, 201):
+        stats.add(i / 1000)
+    assert stats.count == 200
+    # only the last 100 latencies are kept
+    assert stats.percentile(0) == 0.101
+    assert stats.percentile(50) == 0.150
+    assert stats.percentiles((90, 99, 100)) == {90: 0.190, 99: 0.199, 100: 0.200}
+    assert "p99=199 ms" in repr(stats)
+
+
+@pytest.mark.asyncio
+async def test_retry_transient_error():
+    backend = make_backend(faults=["error", "stall"])
+    policy = RetryPolicy(first_token_timeout=0.05, max_retries=2, backoff=0.001, retry_timeouts=True)
+    text = await collect(policy, backend)
+    assert text == backend.completion(MESSAGES)
+    assert backend.requests == 3
+    assert backend.injected == ["error", "stall"]
+    metrics = policy.metrics
+    assert (metrics.streams, metrics.attempts, metrics.retries, metrics.timeouts) == (1, 3, 2, 1)
+    assert metrics.failures == 0
+    assert metrics.ttft.count == metrics.duration.count == 1
+
+
+@pytest.mark.asyncio
+async def test_retries_exhausted():
+    backend = make_backend(faults=["stall", "error"])
+    policy = RetryPolicy(first_token_timeout=0.05, max_retries=1, backoff=0.001, retry_timeouts=True)
+    with pytest.raises(ConnectionError):
+        await collect(policy, backend)
+    assert policy.metrics.failures == 1
+    assert policy.metrics.ttft.count == 0
+
+    policy = RetryPolicy(first_token_timeout=0.05, max_retries=0)
+    with pytest.raises(StreamTimeout):
+        await collect(policy, make_backend(faults=["stall"]))
+
+
+@pytest.mark.asyncio
+async def test_no_retry_after_timeout():
+    assert Story.retry is None
+    backend = make_backend(faults=["stall"])
+    policy = RetryPolicy(first_token_timeout=0.05, backoff=0.001)
+    with pytest.raises(StreamTimeout):
+        await collect(policy, backend)
+    assert backend.requests == 1
+    assert (policy.metrics.retries, policy.metrics.timeouts, policy.metrics.failures) == (0, 1, 1)
+
+
+@pytest.mark.asyncio
+async def test_no_retry_after_first_chunk():
+    policy = RetryPolicy(chunk_timeout=0.05, backoff=0.001)
+    backend = make_backend(faults=["hang"])
+    with pytest.raises(StreamTimeout):
+        await collect(policy, backend)
+    backend = make_backend(faults=["drop"])
+    with pytest.raises(ConnectionError):
+        await collect(policy, backend)
+    assert backend.requests == 1
+    assert policy.metrics.failures == 2
+    assert policy.metrics.timeouts == 1
+
+
+@pytest.mark.asyncio
+async def test_no_retry_other_error():
+    def request():
+        raise ValueError("invalid request")
+
+    policy = RetryPolicy(backoff=0.001)
+    with pytest.raises(ValueError):
+        async for _ in policy.stream(request):
+            pass
+    assert policy.metrics.retries == 0
+
+
+@pytest.mark.asyncio
+async def test_hedged_request():
+    clients = ClientManager()
+    backend = make_backend(faults=["stall"])
+    policy = RetryPolicy(first_token_timeout=5, hedge_after=0.02)
+    start = asyncio.get_running_loop().time()
+    text = await collect(policy, backend, clients)
+    assert asyncio.get_running_loop().time() - start < 1
+    assert text == backend.completion(MESSAGES)
+    assert backend.requests == 2
+    assert (policy.metrics.hedges, policy.metrics.hedge_wins, policy.metrics.retries) == (1, 1, 0)
+    # the stalled request was cancelled
+    assert clients.metrics.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_hedged_request_primary_wins():
+    backend = make_backend(latency=0.05)
+    policy = RetryPolicy(hedge_after=0.01)
+    assert await collect(policy, backend) == backend.completion(MESSAGES)
+    assert (policy.metrics.hedges, policy.metrics.hedge_wins) == (1, 0)
+
+
+def test_fake_backend_random_faults():
+    first = make_backend(fault_rates={"error": 0.3, "stall": 0.2}, seed=1)
+    second = make_backend(fault_rates={"error": 0.3, "stall": 0.2}, seed=1)
+    faults = [first.next_fault() for _ in range(100)]
+    assert faults == [second.next_fault() for _ in range(100)]
+    assert 10 < faults.count("error") < 50
+    assert 5 < faults.count("stall") < 40
+    with pytest.raises(ValueError):
+        make_backend(faults=["crash"])
+
+
+@pytest.mark.asyncio
+async def test_continue_story_resilient(use_fake_backend, monkeypatch):
+    policy = RetryPolicy(first_token_timeout=0.05, chunk_timeout=0.05, backoff=0.001, retry_timeouts=True)
+    monkeypatch.setattr(Story, "retry", policy)
+    use_fake_backend(faults=["error", "stall", None, "hang"])
+    story = Story.from_markdown_file("storytime_ai/templates/minimal.md")
+    story.addchoice("Into the cave", "Cave")
+    results = [cur async for cur, _ in story.continue_story("Cave")]
+    assert results[-1].startswith("## Cave\n")
+    assert story.currentdialog.dialogid == "Cave"
+
+    # a stalled stream fails instead of blocking, the half-written dialog is not added
+    story.addchoice("Into the forest", "Forest")
+    with pytest.raises(StreamTimeout):
+        async for _ in story.continue_story("Forest"):
+            pass
+    assert "Forest" not in story.dialogs
+    assert story.currentdialog.dialogid == "Cave"
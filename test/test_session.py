@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+
+from storytime_ai import Story
+from storytime_ai.session import SessionManager, StorySession
+
+
+@pytest.fixture
+def story(fake_backend):
+    return Story.from_markdown_file("storytime_ai/templates/story.md")
+
+
+def test_session_shares_dialogs(story):
+    a = StorySession(story, "a")
+    b = StorySession(story, "b")
+    assert a.dialogs.base is story.dialogs
+    assert b.currentdialog is story.currentdialog
+    nextdialogid = next(iter(a.currentdialog.choices))
+    a.next_dialog(nextdialogid)
+    assert a.currentdialog.dialogid == nextdialogid
+    assert b.currentdialog.dialogid == story.currentdialog.dialogid
+    assert a.prevdialogids is not b.prevdialogids
+    a.properties["x"] = 1
+    assert b.properties == {}
+
+
+def test_session_manager(story):
+    manager = SessionManager(story, max_sessions=2, idle_timeout=10)
+    a = manager.create("a")
+    manager.create()
+    assert len(manager) == 2
+    assert manager.get("a") is a
+    with pytest.raises(ValueError):
+        manager.create("a")
+    with pytest.raises(RuntimeError):
+        manager.create()
+    assert manager.expire(now=a.last_active + 11) != []
+    assert len(manager) == 0
+
+
+@pytest.mark.asyncio
+async def test_many_concurrent_sessions(story):
+    manager = SessionManager(story)
+    sessions = [manager.create() for _ in range(1000)]
+
+    async def play(session, step):
+        nextdialogid = f"Generated {step % 10}"
+        session.addchoice("Continue", nextdialogid)
+        async for _ in manager.choose(session.sessionid, nextdialogid):
+            pass
+
+    await asyncio.gather(*[play(s, i) for i, s in enumerate(sessions)])
+    assert all(s.currentdialog.dialogid == f"Generated {i % 10}" for i, s in enumerate(sessions))
+    assert story.currentdialog.dialogid == story.prevdialogids[0]
+    assert not any(f"Generated {i}" in story.dialogs for i in range(10))
+    assert all(len(s.dialogs.overlay) == 2 for s in sessions)
+    sessions[0].merge()
+    assert "Generated 0" in story.dialogs
+
+
+@pytest.mark.asyncio
+async def test_choose_abandoned(story):
+    manager = SessionManager(story)
+    session = manager.create()
+    session.addchoice("Continue", "Generated")
+    stream = manager.choose(session.sessionid, "Generated")
+    async for _ in stream:
+        # the consumer stops without closing the generator, which is still referenced
+        break
+
+    async def choose_again():
+        return [delta async for _, delta in manager.choose(session.sessionid, "Generated")]
+
+    await asyncio.wait_for(choose_again(), 5)
+    assert session.currentdialog.dialogid == "Generated"
+    assert not session.lock.locked()
+    await stream.aclose()
+
+    stream = manager.choose(session.sessionid, "Generated")
+    await stream.aclose()
+    assert not session.lock.locked()
+
+
+def test_session_initialized_like_story(story):
+    session = StorySession(story, "a")
+    reference = Story(story.dialogs.fork(), story.title, story.secretsummary)
+    # all attributes of a story are set, none is shared with the template
+    assert set(vars(reference)) <= set(vars(session))
+    assert session.context is not story.context
+    assert session.prefetch is None
+    assert session.markdown_file == story.markdown_file
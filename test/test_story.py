@@ -1,8 +1,11 @@
+import io
 import os
+import stat
 
 import pytest
 
 from storytime_ai import Choice, Dialog, Story
+from storytime_ai.utils import atomic_open
 
 
 def assert_only_non_empty_lines(a, b):
@@ -309,3 +312,94 @@ zweiter text
 - drei: vierter text
 """,
     )
+
+
+def test_integrity_report():
+    story = Story.from_markdown_file("./storytime_ai/templates/broken.md")
+    report = story.integrity_report()
+    assert not report.ok
+    assert report.dangling_choices == [("And so it begins ...", "Bad choice")]
+    assert report.unreachable == []
+    assert report.dead_ends == []
+    story = get_test_story()
+    report = story.integrity_report()
+    assert report.nextdialog_targets == {"eins": ["zwei"]}
+    assert report.dead_ends == ["zwei"]
+    assert len(report.logic_errors) == 1
+    story.dialogs["nonsense"] = Dialog("nonsense", "nonsense", {"zwei": Choice("to zwei", "zwei")})
+    report = story.integrity_report()
+    assert report.unreachable == ["nonsense"]
+    assert not report.has_subgraphs
+
+
+def reference_markdown(story):
+    """The markdown of a story built as one string like before the render cache."""
+    res = f"# {story.title}\n\n"
+    for words in story.secretsummary.split("\n"):
+        res += f"SECRET {words}\n" if words != "" else ""
+    res += "\n\n".join([story.dialogs[x].to_markdown() for x in story.dialogs])
+    return res.strip()
+
+
+@pytest.mark.parametrize(
+    "file",
+    [
+        "./storytime_ai/templates/story.md",
+        "./storytime_ai/templates/minimal.md",
+        "./storytime_ai/templates/broken.md",
+    ],
+)
+def test_write_markdown(file, tmp_path):
+    story = Story.from_markdown_file(file)
+    expected = reference_markdown(story)
+    assert story.to_markdown() == expected
+    f = io.StringIO()
+    story.write_markdown(f)
+    assert f.getvalue() == expected
+    story.save_markdown(tmp_path / "saved.md")
+    assert (tmp_path / "saved.md").read_text() == expected
+    assert os.listdir(tmp_path) == ["saved.md"]
+
+
+def test_markdown_cache_invalidated():
+    story = Story.from_markdown_file("./storytime_ai/templates/story.md")
+    before = story.to_markdown()
+    story.addchoice("new text", "eins")
+    assert "- eins: new text" in story.to_markdown()
+    story.currentdialog.text = "Changed text\n"
+    assert "Changed text" in story.to_markdown()
+    assert story.to_markdown() == reference_markdown(story)
+    assert story.to_markdown() != before
+
+
+def test_save_markdown_atomic(tmp_path):
+    story = Story.from_markdown_file("./storytime_ai/templates/story.md")
+    fname = tmp_path / "story.md"
+    fname.write_text("old content")
+
+    class Broken:
+        def to_markdown(self):
+            raise RuntimeError("broken dialog")
+
+    story.dialogs["broken"] = Broken()
+    with pytest.raises(RuntimeError):
+        story.save_markdown(str(fname))
+    assert fname.read_text() == "old content"
+    assert os.listdir(tmp_path) == ["story.md"]
+
+
+def test_atomic_open_permissions(tmp_path):
+    fname = tmp_path / "new.md"
+    with atomic_open(fname) as f:
+        f.write("new")
+    assert stat.S_IMODE(os.stat(fname).st_mode) == 0o644
+    os.chmod(fname, 0o600)
+    with atomic_open(fname) as f:
+        f.write("changed")
+    assert stat.S_IMODE(os.stat(fname).st_mode) == 0o600
+    assert fname.read_text() == "changed"
+    # invalid arguments of open
+    with pytest.raises(LookupError):
+        with atomic_open(fname, "w", encoding="no such encoding"):
+            pass
+    assert os.listdir(tmp_path) == ["new.md"]
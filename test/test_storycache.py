@@ -0,0 +1,68 @@
+import os
+import shutil
+
+from storytime_ai import Story
+from storytime_ai.storycache import StoryCache
+
+
+def copy_templates(tmp_path):
+    library = tmp_path / "library"
+    library.mkdir()
+    for name in ["story.md", "minimal.md", "broken.md"]:
+        shutil.copy(f"storytime_ai/templates/{name}", library / name)
+    shutil.copy("storytime_ai/templates/story.md", library / "copy.md")
+    return sorted(library.glob("*.md"))
+
+
+def test_scan_and_load(tmp_path):
+    files = copy_templates(tmp_path)
+    cache = StoryCache(tmp_path / "cache")
+    metadata = cache.scan(files)
+    assert cache.misses == len(files)
+    assert [m.ndialogs for m in metadata] == [len(Story.from_markdown_file(f).dialogs) for f in files]
+    assert len(list(cache.objects.glob("*.bin"))) == 0
+
+    cache = StoryCache(tmp_path / "cache")
+    assert len(cache) == len(files)
+    assert cache.scan(files) == metadata
+    assert cache.misses == 0
+    for f in files:
+        story = cache.load(f)
+        assert story == Story.from_markdown_file(f)
+        assert story.markdown_file == str(f)
+    # identical files share one parsed story
+    assert len(list(cache.objects.glob("*.bin"))) == len(files) - 1
+
+    cache = StoryCache(tmp_path / "cache")
+    for f in files:
+        assert cache.load(f) == Story.from_markdown_file(f)
+    assert cache.misses == 0
+
+
+def test_changed_file(tmp_path):
+    files = copy_templates(tmp_path)
+    cache = StoryCache(tmp_path / "cache")
+    cache.scan(files)
+    fname = files[0]
+    # touched, but unchanged
+    stat = fname.stat()
+    os.utime(fname, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    cache.metadata(fname)
+    assert cache.misses == len(files)
+    with open(fname, "a") as f:
+        f.write("\n## A new dialog\nWith text\n")
+    meta = cache.metadata(fname)
+    assert cache.misses == len(files) + 1
+    assert cache.load(fname).dialogs.keys() == Story.from_markdown_file(fname).dialogs.keys()
+    assert meta.ndialogs == len(Story.from_markdown_file(fname).dialogs)
+
+
+def test_iter_scan_closed_early(tmp_path):
+    files = copy_templates(tmp_path)
+    cache = StoryCache(tmp_path / "cache")
+    metadata = cache.iter_scan(files, jobs=1)
+    first = next(metadata)
+    metadata.close()
+    assert first.path in [str(f.resolve()) for f in files]
+    # the index of the files read so far is saved
+    assert 1 <= len(StoryCache(tmp_path / "cache")) <= len(files)
@@ -0,0 +1,80 @@
+import asyncio
+import time
+
+import pytest
+
+from storytime_ai.streaming import CoalescedStream
+
+
+async def source(n=200, rate=None, fail=False, closed=None):
+    current = ""
+    try:
+        for i in range(n):
+            if rate is not None:
+                await asyncio.sleep(1 / rate)
+            delta = f"token{i} "
+            current += delta
+            yield current, delta
+        if fail:
+            raise RuntimeError("stream failed")
+    finally:
+        if closed is not None:
+            closed.append(True)
+
+
+@pytest.mark.asyncio
+async def test_coalesce_frames():
+    stream = CoalescedStream(source(200, rate=2000), max_fps=20)
+    start = time.monotonic()
+    frames = [frame async for frame in stream]
+    duration = time.monotonic() - start
+    assert "".join(delta for _, delta in frames) == frames[-1][0]
+    assert frames[-1][0].endswith("token199 ")
+    metrics = stream.metrics
+    assert metrics.deltas == 200
+    assert metrics.frames == len(frames)
+    assert metrics.frames <= duration * 20 + 2
+    assert metrics.dropped == metrics.deltas - metrics.frames
+    assert metrics.merged > 0
+    assert metrics.nbytes == len(frames[-1][0])
+
+
+@pytest.mark.asyncio
+async def test_coalesce_without_limit():
+    stream = CoalescedStream(source(50, rate=500), max_fps=None)
+    frames = [frame async for frame in stream]
+    assert frames[-1][0] == "".join(f"token{i} " for i in range(50))
+    assert stream.metrics.frames == len(frames)
+
+
+@pytest.mark.asyncio
+async def test_coalesce_byte_threshold():
+    # one frame each ten seconds, so only the byte threshold and the end flush frames
+    stream = CoalescedStream(source(100, rate=2000), max_fps=0.1, max_bytes=100)
+    start = time.monotonic()
+    frames = [frame async for frame in stream]
+    assert time.monotonic() - start < 5
+    assert len(frames) > 2
+    assert all(len(delta) >= 100 for _, delta in frames[1:-1])
+    assert "".join(delta for _, delta in frames) == frames[-1][0]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_error():
+    stream = CoalescedStream(source(10, fail=True), max_fps=20)
+    frames = []
+    with pytest.raises(RuntimeError):
+        async for frame in stream:
+            frames.append(frame)
+    assert frames[-1][0].endswith("token9 ")
+
+
+@pytest.mark.asyncio
+async def test_coalesce_close():
+    closed = []
+    stream = CoalescedStream(source(1000, rate=1000, closed=closed), max_fps=50)
+    async for _ in stream:
+        break
+    await stream.aclose()
+    assert closed == [True]
+    assert stream.metrics.deltas < 1000